@@ -97,7 +97,10 @@ def list_testing_datafiles():
 #
 # So screw it, lets just use an env var.
 bst_install_entry_points = {
-    "console_scripts": ["bst-artifact-server = buildstream._cas.casserver:server_main"],
+    "console_scripts": [
+        "bst-artifact-server = buildstream._cas.casserver:server_main",
+        "bst-artifact-server-migrate-refs = buildstream._cas.refstorage:migrate_main",
+    ],
 }
 
 if not os.environ.get("BST_ARTIFACTS_ONLY", ""):
@@ -28,6 +28,7 @@ artifact composite interaction away from Element class
 
 """
 
+import itertools
 import os
 
 from ._protos.buildstream.v2.artifact_pb2 import Artifact as ArtifactProto
@@ -216,6 +217,8 @@ class Artifact:
             with utils.save_file_atomic(path, mode="wb") as f:
                 f.write(artifact.SerializeToString())
 
+        self._context.artifactcache.add_refs([element.get_artifact_name(key=key) for key in keys], size=size)
+
         return size
 
     # cached_buildtree()
@@ -237,6 +240,22 @@ class Artifact:
         else:
             return False
 
+    # cached_files()
+    #
+    # Check if the artifact is cached with the contents of all its files,
+    # which may not be the case for artifacts pulled without their files.
+    #
+    # Returns:
+    #     (bool): True if the contents of all files are cached
+    #
+    def cached_files(self):
+
+        files_digest = self._get_field_digest("files")
+        if files_digest:
+            return self._cas.contains_directory(files_digest, with_files=True)
+        else:
+            return True
+
     # buildtree_exists()
     #
     # Check if artifact was created with a buildtree. This does not check
@@ -398,40 +417,66 @@ class Artifact:
     #
     def cached(self):
 
-        if self._cached is not None:
-            return self._cached
+        if self._cached is None:
+            Artifact.query_cached([self])
 
-        context = self._context
+        return self._cached
 
-        artifact = self._load_proto()
-        if not artifact:
-            self._cached = False
-            return False
+    # query_cached():
+    #
+    # Determine whether the specified artifacts are cached, as described
+    # in `cached()`.
+    #
+    # The local cache is queried for all artifacts at once, which is much
+    # faster than querying artifacts one by one. The results are stored
+    # in the Artifact objects.
+    #
+    # Args:
+    #     artifacts (list): The Artifact objects to query
+    #
+    @staticmethod
+    def query_cached(artifacts):
+        artifacts = [artifact for artifact in artifacts if artifact._cached is None]
+        if not artifacts:
+            return
+
+        context = artifacts[0]._context
+        cas = artifacts[0]._cas
+
+        candidates = []
+        for artifact in artifacts:
+            proto = artifact._load_proto()
+            if proto:
+                candidates.append((artifact, proto))
+            else:
+                artifact._cached = False
+
+        # Check whether 'files' subdirectories are available, with or without file contents
+        if context.require_artifact_directories:
+            with_directories = [(artifact, proto) for artifact, proto in candidates if str(proto.files)]
+            requests = [
+                (proto.files, context.require_artifact_files or artifact._element._artifact_files_required())
+                for artifact, proto in with_directories
+            ]
+            for (artifact, _), available in zip(with_directories, cas.contains_directories(requests)):
+                if not available:
+                    artifact._cached = False
 
-        # Determine whether directories are required
-        require_directories = context.require_artifact_directories
-        # Determine whether file contents are required as well
-        require_files = context.require_artifact_files or self._element._artifact_files_required()
-
-        # Check whether 'files' subdirectory is available, with or without file contents
-        if (
-            require_directories
-            and str(artifact.files)
-            and not self._cas.contains_directory(artifact.files, with_files=require_files)
-        ):
-            self._cached = False
-            return False
+            candidates = [(artifact, proto) for artifact, proto in candidates if artifact._cached is None]
 
         # Check whether public data and logs are available
-        logfile_digests = [logfile.digest for logfile in artifact.logs]
-        digests = [artifact.public_data] + logfile_digests
-        if not self._cas.contains_files(digests):
-            self._cached = False
-            return False
-
-        self._proto = artifact
-        self._cached = True
-        return True
+        digests = {
+            artifact: [proto.public_data] + [logfile.digest for logfile in proto.logs]
+            for artifact, proto in candidates
+        }
+        missing = {digest.hash for digest in cas.missing_files(list(itertools.chain(*digests.values())))}
+
+        for artifact, proto in candidates:
+            if any(digest.hash in missing for digest in digests[artifact]):
+                artifact._cached = False
+            else:
+                artifact._proto = proto
+                artifact._cached = True
 
     # cached_logs()
     #
@@ -479,7 +524,15 @@ class Artifact:
 
         pull_key = self.get_extract_key()
 
-        if not artifacts.pull(self._element, pull_key, pull_buildtrees=pull_buildtrees):
+        # Artifacts whose files are not required are only pulled with their
+        # file contents if these are not pulled on demand
+        pull_files = (
+            not self._context.pull_files_on_demand
+            or self._context.require_artifact_files
+            or self._element._artifact_files_required()
+        )
+
+        if not artifacts.pull(self._element, pull_key, pull_buildtrees=pull_buildtrees, pull_files=pull_files):
             return False
 
         self.set_cached()
@@ -499,7 +552,8 @@ class Artifact:
     def _load_proto(self):
         key = self.get_extract_key()
 
-        proto_path = os.path.join(self._artifactdir, self._element.get_artifact_name(key=key))
+        ref = self._element.get_artifact_name(key=key)
+        proto_path = os.path.join(self._artifactdir, ref)
         artifact = ArtifactProto()
         try:
             with open(proto_path, mode="r+b") as f:
@@ -507,7 +561,7 @@ class Artifact:
         except FileNotFoundError:
             return None
 
-        os.utime(proto_path)
+        self._context.artifactcache.update_mtime(ref)
 
         return artifact
 
@@ -18,18 +18,27 @@
 #  Authors:
 #        Tristan Maat <tristan.maat@codethink.co.uk>
 
+import contextlib
+import hashlib
 import os
+import time
 import grpc
 
+from ._artifactindex import ArtifactIndex
 from ._assetcache import AssetCache
 from ._cas.casremote import BlobNotFound
 from ._exceptions import ArtifactError, AssetCacheError, CASError, CASRemoteError
+from ._message import MessageType
 from ._protos.buildstream.v2 import artifact_pb2
 
 from . import utils
 
 REMOTE_ASSET_ARTIFACT_URN_TEMPLATE = "urn:fdc:buildstream.build:2020:artifact:{}"
 
+# Maximum number of remote queries in flight when checking the remotes
+# for many artifacts at once.
+_MAX_CONCURRENT_QUERIES = 256
+
 
 # An ArtifactCache manages artifacts.
 #
@@ -48,12 +57,48 @@ class ArtifactCache(AssetCache):
         self._basedir = context.artifactdir
         os.makedirs(self._basedir, exist_ok=True)
 
+        self._remote_misses = _RemoteMissCache(
+            os.path.join(context.cachedir, "artifacts", "remote-misses"), context.remote_miss_ttl
+        )
+
+        self._index = ArtifactIndex(os.path.join(context.cachedir, "artifacts", "index.db"), self._basedir)
+
+    # release_resources():
+    #
+    # Release resources used by ArtifactCache.
+    #
+    def release_resources(self):
+        super().release_resources()
+        self._index.close()
+
+    # prepare_fork():
+    #
+    # Close the artifact index before fork, SQLite connections must not
+    # be inherited by the jobs.
+    #
+    def prepare_fork(self):
+        self._index.close()
+
     def update_mtime(self, ref):
         try:
             os.utime(os.path.join(self._basedir, ref))
         except FileNotFoundError as e:
             raise ArtifactError("Couldn't find artifact: {}".format(ref)) from e
 
+        self._index.touch(ref)
+
+    # add_refs():
+    #
+    # Record artifact protos written to the local cache in the artifact
+    # index.
+    #
+    # Args:
+    #     refs (list): The artifact names
+    #     size (int): The size of the artifact contents in bytes, if known
+    #
+    def add_refs(self, refs, *, size=None):
+        self._index.add(refs, size=size)
+
     # preflight():
     #
     # Preflight check.
@@ -81,6 +126,9 @@ class ArtifactCache(AssetCache):
     #
     # List artifacts in this cache in LRU order.
     #
+    # The artifacts are listed from the artifact index rather than the
+    # refs directory.
+    #
     # Args:
     #     glob (str): An option glob expression to be used to list artifacts satisfying the glob
     #
@@ -88,7 +136,7 @@ class ArtifactCache(AssetCache):
     #     ([str]) - A list of artifact names as generated in LRU order
     #
     def list_artifacts(self, *, glob=None):
-        return [ref for _, ref in sorted(list(self._list_refs_mtimes(self._basedir, glob_expr=glob)))]
+        return [ref for _, ref in self._index.list_refs(glob=glob)]
 
     # remove():
     #
@@ -104,6 +152,67 @@ class ArtifactCache(AssetCache):
             self._remove_ref(ref)
         except AssetCacheError as e:
             raise ArtifactError("{}".format(e)) from e
+        finally:
+            # Also drops refs which were found missing
+            self._index.remove([ref])
+
+    # remove_artifacts():
+    #
+    # Removes many artifacts from the local artifact cache in one pass.
+    #
+    # Args:
+    #     refs (iterable): The names of the artifacts to remove
+    #
+    # Returns:
+    #     (list): The names of the removed artifacts
+    #     (list): (name, ArtifactError) tuples of the artifacts which could not be removed
+    #
+    def remove_artifacts(self, refs):
+        try:
+            removed, failed = self._remove_refs(refs)
+        except AssetCacheError as e:
+            # Refs may have been removed before the error, let the index
+            # notice when it next scans their directories
+            raise ArtifactError("{}".format(e)) from e
+
+        # Also drop the refs which were found missing, the refs which could
+        # not be removed are still on disk
+        self._index.remove(removed + [ref for ref, e in failed if e.reason == "ref-not-found"])
+
+        return removed, [(ref, ArtifactError("{}".format(e))) for ref, e in failed]
+
+    # remove_orphans():
+    #
+    # Removes the artifacts whose contents were evicted from the local
+    # CAS, and which are therefore not cached anymore.
+    #
+    # Artifacts may be pulled without their file blobs, e.g. for remote
+    # execution or with `pull-files-on-demand`, so only the directory
+    # objects of the files tree are required to be present.
+    #
+    # Returns:
+    #     (list): The names of the removed artifacts
+    #
+    def remove_orphans(self):
+        require_directories = self.context.require_artifact_directories
+
+        def get_contents(data):
+            artifact = artifact_pb2.Artifact()
+            artifact.ParseFromString(data)
+
+            directories = []
+            if require_directories and str(artifact.files):
+                directories.append((artifact.files, False))
+
+            blobs = [log.digest for log in artifact.logs]
+            if str(artifact.public_data):
+                blobs.append(artifact.public_data)
+
+            return directories, blobs
+
+        orphans = self._find_orphaned_refs(self.list_artifacts(), get_contents)
+        removed, _ = self.remove_artifacts(orphans)
+        return removed
 
     # push():
     #
@@ -112,14 +221,18 @@ class ArtifactCache(AssetCache):
     # Args:
     #     element (Element): The Element whose artifact is to be pushed
     #     artifact (Artifact): The artifact being pushed
+    #     push_references (bool): Whether to push the artifact references to the
+    #                             index remotes, otherwise only the blobs are pushed
+    #                             and the references are left to push_references()
     #
     # Returns:
-    #   (bool): True if any remote was updated, False if no pushes were required
+    #   (bool): True if any remote was updated, False if no pushes were required,
+    #           always True if the references are left to push_references()
     #
     # Raises:
     #   (ArtifactError): if there was an error
     #
-    def push(self, element, artifact):
+    def push(self, element, artifact, *, push_references=True):
         project = element._get_project()
         display_key = element._get_brief_display_key()
 
@@ -137,7 +250,17 @@ class ArtifactCache(AssetCache):
             remote.init()
             element.status("Pushing data from artifact {} -> {}".format(display_key, remote))
 
-            if self._push_artifact_blobs(artifact, artifact_digest, remote):
+            pushed_blobs, skipped_blobs, skipped_bytes = self._push_artifact_blobs(
+                artifact, artifact_digest, remote, on_batch=self._batch_reporter(element, "Pushed", "to", remote)
+            )
+            if skipped_blobs:
+                element.info(
+                    "Skipped {} blobs ({}) of artifact {} already pushed to {}".format(
+                        skipped_blobs, utils._pretty_size(skipped_bytes, dec_places=1), display_key, remote
+                    )
+                )
+
+            if pushed_blobs:
                 element.info("Pushed data from artifact {} -> {}".format(display_key, remote))
             else:
                 element.info(
@@ -146,6 +269,9 @@ class ArtifactCache(AssetCache):
                     )
                 )
 
+        if not push_references:
+            return True
+
         for remote in index_remotes:
             remote.init()
             element.status("Pushing artifact {} -> {}".format(display_key, remote))
@@ -160,6 +286,82 @@ class ArtifactCache(AssetCache):
 
         return pushed
 
+    # push_references():
+    #
+    # Push the references of many artifacts to the index remotes at once,
+    # after their blobs have been pushed with push(push_references=False).
+    #
+    # The remotes are first queried for all references and the missing
+    # references are then pushed, keeping many requests in flight instead
+    # of waiting for the round trips of each artifact.
+    #
+    # Args:
+    #     elements (list [Element]): The Elements whose artifacts to push the references of
+    #
+    # Returns:
+    #   (list): (Element, ArtifactError) tuples for the elements whose
+    #           references could not be pushed
+    #
+    def push_references(self, elements):
+        requests = []
+        for element in elements:
+            artifact_proto = element._get_artifact()._get_proto()
+            artifact_digest = self.cas.add_object(buffer=artifact_proto.SerializeToString())
+            reference = self._artifact_reference(element, artifact_proto)
+            for remote in self._index_remotes[element._get_project()]:
+                if remote.push:
+                    requests.append((element, remote, artifact_digest, reference))
+
+        failed = {}
+        for offset in range(0, len(requests), _MAX_CONCURRENT_QUERIES):
+            batch = requests[offset : offset + _MAX_CONCURRENT_QUERIES]
+
+            futures = []
+            for element, remote, _, (artifact_names, uris, _, _) in batch:
+                remote.init()
+                # The artifact is either already on the remote or about to be pushed
+                for artifact_name in artifact_names:
+                    self._remote_misses.remove(remote, artifact_name)
+                futures.append(remote.fetch_blob_future(uris))
+
+            missing = []
+            for request, future in zip(batch, futures):
+                element, remote, artifact_digest, _ = request
+                try:
+                    response = remote.fetch_blob_result(future)
+                except AssetCacheError as e:
+                    failed.setdefault(element, ArtifactError("Error checking artifact cache: {}".format(e)))
+                    continue
+
+                if response and response.blob_digest == artifact_digest:
+                    element.info(
+                        "Remote ({}) already has artifact {} cached".format(remote, element._get_brief_display_key())
+                    )
+                else:
+                    missing.append(request)
+
+            futures = []
+            for element, remote, artifact_digest, (_, uris, referenced_blobs, referenced_directories) in missing:
+                futures.append(
+                    remote.push_blob_future(
+                        uris,
+                        artifact_digest,
+                        references_blobs=referenced_blobs,
+                        references_directories=referenced_directories,
+                    )
+                )
+
+            for (element, remote, _, _), future in zip(missing, futures):
+                try:
+                    remote.push_blob_result(future)
+                except AssetCacheError as e:
+                    failed.setdefault(element, ArtifactError("Failed to push artifact: {}".format(e)))
+                    continue
+
+                element.info("Pushed artifact {} -> {}".format(element._get_brief_display_key(), remote))
+
+        return list(failed.items())
+
     # pull():
     #
     # Pull artifact from one of the configured remote repositories.
@@ -168,39 +370,40 @@ class ArtifactCache(AssetCache):
     #     element (Element): The Element whose artifact is to be fetched
     #     key (str): The cache key to use
     #     pull_buildtrees (bool): Whether to pull buildtrees or not
+    #     pull_files (bool): Whether to pull the file contents or only the directories
     #
     # Returns:
     #   (bool): True if pull was successful, False if artifact was not available
     #
-    def pull(self, element, key, *, pull_buildtrees=False):
+    def pull(self, element, key, *, pull_buildtrees=False, pull_files=True):
         artifact_digest = None
         display_key = key[: self.context.log_key_length]
         project = element._get_project()
 
         artifact_name = element.get_artifact_name(key=key)
-        uri = REMOTE_ASSET_ARTIFACT_URN_TEMPLATE.format(artifact_name)
 
-        errors = []
-        # Start by pulling our artifact proto, so that we know which
-        # blobs to pull
-        for remote in self._index_remotes[project]:
-            remote.init()
-            try:
-                element.status("Pulling artifact {} <- {}".format(display_key, remote))
-                response = remote.fetch_blob([uri])
-                if response:
-                    artifact_digest = response.blob_digest
-                    break
-
-                element.info("Remote ({}) does not have artifact {} cached".format(remote, display_key))
-            except AssetCacheError as e:
-                element.warn("Could not pull from remote {}: {}".format(remote, e))
-                errors.append(e)
+        def on_missing(remote):
+            element.info("Remote ({}) does not have artifact {} cached".format(remote, display_key))
 
-        if errors and not artifact_digest:
-            raise ArtifactError(
-                "Failed to pull artifact {}".format(display_key), detail="\n".join(str(e) for e in errors)
+        # Start by pulling our artifact proto, so that we know which
+        # blobs to pull. All index remotes are queried concurrently.
+        index_remotes = self._index_remotes[project]
+        if index_remotes:
+            element.status(
+                "Pulling artifact {} <- {}".format(display_key, ", ".join(str(remote) for remote in index_remotes))
             )
+        response, errors = self._query_index_remotes(project, artifact_name, on_missing=on_missing)
+        if response:
+            artifact_digest = response.blob_digest
+        else:
+            for remote, error in errors:
+                element.warn("Could not pull from remote {}: {}".format(remote, error))
+
+            if errors:
+                raise ArtifactError(
+                    "Failed to pull artifact {}".format(display_key),
+                    detail="\n".join(str(error) for _, error in errors),
+                )
 
         # If we don't have an artifact, we can't exactly pull our
         # artifact
@@ -208,24 +411,28 @@ class ArtifactCache(AssetCache):
             return False
 
         errors = []
-        # If we do, we can pull it!
-        for remote in self._storage_remotes[project]:
-            remote.init()
-            try:
-                element.status("Pulling data for artifact {} <- {}".format(display_key, remote))
-
-                if self._pull_artifact_storage(element, key, artifact_digest, remote, pull_buildtrees=pull_buildtrees):
-                    element.info("Pulled artifact {} <- {}".format(display_key, remote))
-                    return True
-
-                element.info("Remote ({}) does not have artifact {} cached".format(remote, display_key))
-            except BlobNotFound as e:
-                # Not all blobs are available on this remote
-                element.info("Remote cas ({}) does not have blob {} cached".format(remote, e.blob))
-                continue
-            except CASError as e:
-                element.warn("Could not pull from remote {}: {}".format(remote, e))
-                errors.append(e)
+        # If we do, we can pull it! Try the storage remotes which confirm
+        # having the artifact proto first, fastest first.
+        storage_remotes = self.cas.remotes_by_response_time(self._storage_remotes[project], artifact_digest)
+        with contextlib.closing(storage_remotes):
+            for remote in storage_remotes:
+                try:
+                    element.status("Pulling data for artifact {} <- {}".format(display_key, remote))
+
+                    if self._pull_artifact_storage(
+                        element, key, artifact_digest, remote, pull_buildtrees=pull_buildtrees, pull_files=pull_files,
+                    ):
+                        element.info("Pulled artifact {} <- {}".format(display_key, remote))
+                        return True
+
+                    element.info("Remote ({}) does not have artifact {} cached".format(remote, display_key))
+                except BlobNotFound as e:
+                    # Not all blobs are available on this remote
+                    element.info("Remote cas ({}) does not have blob {} cached".format(remote, e.blob))
+                    continue
+                except CASError as e:
+                    element.warn("Could not pull from remote {}: {}".format(remote, e))
+                    errors.append(e)
 
         if errors:
             raise ArtifactError(
@@ -299,6 +506,7 @@ class ArtifactCache(AssetCache):
             return
 
         utils.safe_link(os.path.join(self._basedir, oldref), os.path.join(self._basedir, newref))
+        self._index.add([newref])
 
     # fetch_missing_blobs():
     #
@@ -309,7 +517,7 @@ class ArtifactCache(AssetCache):
     #     missing_blobs (list): The Digests of the blobs to fetch
     #
     def fetch_missing_blobs(self, project, missing_blobs):
-        for remote in self._index_remotes[project]:
+        for remote in self._storage_remotes[project]:
             if not missing_blobs:
                 break
 
@@ -368,18 +576,187 @@ class ArtifactCache(AssetCache):
 
         project = element._get_project()
         ref = element.get_artifact_name()
-        for remote in self._index_remotes[project]:
-            remote.init()
 
-            if self._query_remote(ref, remote):
-                return True
+        response, errors = self._query_index_remotes(project, ref)
+        if not response and errors:
+            _, error = errors[0]
+            raise ArtifactError("Error when querying remotes: {}".format(error)) from error
 
-        return False
+        return bool(response)
+
+    # check_remotes_for_artifacts()
+    #
+    # Check which artifacts are available in the index remotes.
+    #
+    # This queries the remotes for many artifacts concurrently, instead
+    # of waiting for a round trip per artifact and remote.
+    #
+    # Args:
+    #    queries (list): (Project, [str]) tuples, each listing alternative
+    #                    names of a single artifact, e.g. for the strong
+    #                    and weak cache keys of an element
+    #    on_missing (callable): Optional callback invoked with the index of
+    #                           each query no remote has an artifact for,
+    #                           and each of the remotes
+    #
+    # Returns:
+    #    (list): For each query, True if a remote has one of the names,
+    #            False if no remote has any of them, or None if this is
+    #            unknown because a remote could not be queried
+    #
+    def check_remotes_for_artifacts(self, queries, *, on_missing=None):
+        results = self._query_artifacts(queries)
+
+        if on_missing:
+            for index, ((project, _), result) in enumerate(zip(queries, results)):
+                if result is False:
+                    for remote in self._index_remotes.get(project, []):
+                        on_missing(index, remote)
+
+        return [bool(result) if result is not None else None for result in results]
+
+    # prefetch()
+    #
+    # Pull the artifacts of many elements at once, as used to warm the
+    # local cache before a build.
+    #
+    # Instead of pulling each artifact separately, the artifact names of
+    # all elements are resolved with a single bulk query of the index
+    # remotes, and the contents of all artifacts found are then fetched
+    # from each storage remote together, keeping as many batch requests
+    # in flight as configured.
+    #
+    # Args:
+    #    elements (list [Element]): The elements whose artifacts to pull
+    #    pull_buildtrees (bool): Whether to pull buildtrees as well
+    #
+    # Returns:
+    #    (list [Element]): The elements whose artifacts were pulled
+    #
+    def prefetch(self, elements, *, pull_buildtrees=False):
+        names = [(element, name) for element in elements for name in element._get_pull_artifact_names()]
+        results = self._query_artifacts([(element._get_project(), [name]) for element, name in names])
+
+        # Group the artifacts found by project, preferring the first
+        # name of each element, i.e. the strict artifact
+        resolved = set()
+        artifacts = {}
+        for (element, name), result in zip(names, results):
+            if result and element not in resolved:
+                resolved.add(element)
+                artifacts.setdefault(element._get_project(), []).append((element, name, result.blob_digest))
+
+        pulled = []
+        for project, remaining in artifacts.items():
+            for remote in self._storage_remotes[project]:
+                if not remaining:
+                    break
+
+                try:
+                    fetched = self._prefetch_artifacts_storage(remote, remaining, pull_buildtrees=pull_buildtrees)
+                except (grpc.RpcError, CASError) as e:
+                    self._message(MessageType.WARN, "Could not pull from remote {}: {}".format(remote, e))
+                    continue
+
+                pulled.extend(fetched)
+                remaining = [artifact for artifact in remaining if artifact[0] not in fetched]
+
+        return pulled
 
     ################################################
     #             Local Private Methods            #
     ################################################
 
+    # _query_artifacts()
+    #
+    # Query the index remotes for many artifacts concurrently, instead of
+    # waiting for a round trip per artifact and remote.
+    #
+    # Args:
+    #    queries (list): (Project, [str]) tuples, each listing alternative
+    #                    names of a single artifact
+    #
+    # Returns:
+    #    (list): For each query, the FetchBlobResponse of a remote which has
+    #            one of the names, False if no remote has any of them, or None
+    #            if this is unknown because a remote could not be queried
+    #
+    def _query_artifacts(self, queries):
+        requests = []
+        for index, (project, artifact_names) in enumerate(queries):
+            uris = [REMOTE_ASSET_ARTIFACT_URN_TEMPLATE.format(artifact_name) for artifact_name in artifact_names]
+            for remote in self._index_remotes.get(project, []):
+                if all(self._remote_misses.contains(remote, artifact_name) for artifact_name in artifact_names):
+                    continue
+                requests.append((index, remote, uris))
+
+        found = {}
+        failed = set()
+        failed_remotes = set()
+        for offset in range(0, len(requests), _MAX_CONCURRENT_QUERIES):
+            batch = [
+                request for request in requests[offset : offset + _MAX_CONCURRENT_QUERIES] if request[0] not in found
+            ]
+
+            futures = []
+            for _, remote, uris in batch:
+                remote.init()
+                futures.append(remote.fetch_blob_future(uris))
+
+            for (index, remote, _), future in zip(batch, futures):
+                try:
+                    response = remote.fetch_blob_result(future)
+                    if response:
+                        found.setdefault(index, response)
+                    else:
+                        _, artifact_names = queries[index]
+                        for artifact_name in artifact_names:
+                            self._remote_misses.add(remote, artifact_name)
+                except AssetCacheError as e:
+                    failed.add(index)
+                    if remote not in failed_remotes:
+                        failed_remotes.add(remote)
+                        self._message(MessageType.WARN, "Failed to query remote {}: {}".format(remote, e))
+
+        return [found.get(index, None if index in failed else False) for index in range(len(queries))]
+
+    # _query_index_remotes()
+    #
+    # Resolve an artifact name to the digest of its artifact proto,
+    # querying the index remotes of the project concurrently.
+    #
+    # Remotes which recently did not have the artifact are skipped, and
+    # remotes which do not have it are remembered.
+    #
+    # Args:
+    #    project (Project): The project of the artifact
+    #    artifact_name (str): The artifact name
+    #    on_missing (callable): Optional callback invoked with each remote
+    #                           which does not have the artifact
+    #
+    # Returns:
+    #    (FetchBlobResponse|None): The response of the remote which has the artifact
+    #    (list): (AssetRemote, AssetCacheError) tuples for failed remotes
+    #
+    def _query_index_remotes(self, project, artifact_name, *, on_missing=None):
+        remotes = []
+        for remote in self._index_remotes[project]:
+            if self._remote_misses.contains(remote, artifact_name):
+                if on_missing:
+                    on_missing(remote)
+            else:
+                remotes.append(remote)
+
+        def record_missing(remote):
+            self._remote_misses.add(remote, artifact_name)
+            if on_missing:
+                on_missing(remote)
+
+        uri = REMOTE_ASSET_ARTIFACT_URN_TEMPLATE.format(artifact_name)
+        _, response, errors = self._fetch_blob_from_remotes(remotes, [uri], on_missing=record_missing)
+
+        return response, errors
+
     # _push_artifact_blobs()
     #
     # Push the blobs that make up an artifact to the remote server.
@@ -387,24 +764,33 @@ class ArtifactCache(AssetCache):
     # Args:
     #    artifact (Artifact): The artifact whose blobs to push.
     #    remote (CASRemote): The remote to push the blobs to.
+    #    on_batch (callable): Called for each batch of blobs pushed
     #
     # Returns:
     #    (bool) - True if we uploaded anything, False otherwise.
+    #    (int) - The number of blobs skipped as already pushed in this session
+    #    (int) - The number of bytes skipped as already pushed in this session
     #
     # Raises:
     #    ArtifactError: If we fail to push blobs (*unless* they're
     #    already there or we run out of space on the server).
     #
-    def _push_artifact_blobs(self, artifact, artifact_digest, remote):
+    def _push_artifact_blobs(self, artifact, artifact_digest, remote, *, on_batch=None):
         artifact_proto = artifact._get_proto()
+        skipped_blobs = 0
+        skipped_bytes = 0
 
         try:
             if str(artifact_proto.files):
-                self.cas._send_directory(remote, artifact_proto.files)
+                skipped = self.cas._send_directory(remote, artifact_proto.files, on_batch=on_batch)
+                skipped_blobs += skipped[0]
+                skipped_bytes += skipped[1]
 
             if str(artifact_proto.buildtree):
                 try:
-                    self.cas._send_directory(remote, artifact_proto.buildtree)
+                    skipped = self.cas._send_directory(remote, artifact_proto.buildtree, on_batch=on_batch)
+                    skipped_blobs += skipped[0]
+                    skipped_bytes += skipped[1]
                 except FileNotFoundError:
                     pass
 
@@ -416,20 +802,50 @@ class ArtifactCache(AssetCache):
             for log_file in artifact_proto.logs:
                 digests.append(log_file.digest)
 
-            self.cas.send_blobs(remote, digests)
+            self.cas.send_blobs(remote, digests, on_batch=on_batch)
 
         except CASRemoteError as cas_error:
             if cas_error.reason != "cache-too-full":
                 raise ArtifactError("Failed to push artifact blobs: {}".format(cas_error))
-            return False
+            return False, skipped_blobs, skipped_bytes
         except grpc.RpcError as e:
             if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED:
                 raise ArtifactError(
                     "Failed to push artifact blobs with status {}: {}".format(e.code().name, e.details())
                 )
-            return False
+            return False, skipped_blobs, skipped_bytes
 
-        return True
+        return True, skipped_blobs, skipped_bytes
+
+    # _batch_reporter()
+    #
+    # Create a callback reporting the throughput of each batch of blobs
+    # transferred for an element as a debug message.
+    #
+    # Args:
+    #    element (Element): The element
+    #    action (str): "Pushed" or "Pulled"
+    #    preposition (str): "to" or "from"
+    #    remote (CASRemote): The remote
+    #
+    # Returns:
+    #    (callable): The callback for CASCache transfers
+    #
+    def _batch_reporter(self, element, action, preposition, remote):
+        def report(n_blobs, n_bytes, seconds):
+            element.debug(
+                "{} batch of {} blobs ({}) {} {} in {:.2f}s ({}/s)".format(
+                    action,
+                    n_blobs,
+                    utils._pretty_size(n_bytes, dec_places=1),
+                    preposition,
+                    remote,
+                    seconds,
+                    utils._pretty_size(n_bytes / max(seconds, 0.001), dec_places=1),
+                )
+            )
+
+        return report
 
     # _push_artifact_proto()
     #
@@ -450,10 +866,13 @@ class ArtifactCache(AssetCache):
     def _push_artifact_proto(self, element, artifact, artifact_digest, remote):
 
         artifact_proto = artifact._get_proto()
+        artifact_names, uris, referenced_blobs, referenced_directories = self._artifact_reference(
+            element, artifact_proto
+        )
 
-        keys = list(utils._deduplicate([artifact_proto.strong_key, artifact_proto.weak_key]))
-        artifact_names = [element.get_artifact_name(key=key) for key in keys]
-        uris = [REMOTE_ASSET_ARTIFACT_URN_TEMPLATE.format(artifact_name) for artifact_name in artifact_names]
+        # The artifact is either already on the remote or about to be pushed
+        for artifact_name in artifact_names:
+            self._remote_misses.remove(remote, artifact_name)
 
         try:
             response = remote.fetch_blob(uris)
@@ -466,16 +885,6 @@ class ArtifactCache(AssetCache):
                     "Error checking artifact cache with status {}: {}".format(e.code().name, e.details())
                 )
 
-        referenced_directories = []
-        if artifact_proto.files:
-            referenced_directories.append(artifact_proto.files)
-        if artifact_proto.buildtree:
-            referenced_directories.append(artifact_proto.buildtree)
-        if artifact_proto.sources:
-            referenced_directories.append(artifact_proto.sources)
-
-        referenced_blobs = [log_file.digest for log_file in artifact_proto.logs]
-
         try:
             remote.push_blob(
                 uris,
@@ -488,6 +897,37 @@ class ArtifactCache(AssetCache):
 
         return True
 
+    # _artifact_reference():
+    #
+    # Get the Remote Asset reference of an artifact.
+    #
+    # Args:
+    #    element (Element): The element
+    #    artifact_proto (Artifact): The artifact proto
+    #
+    # Returns:
+    #    (list): The artifact names
+    #    (list): The URIs of the artifact names
+    #    (list): The digests of the blobs referenced by the artifact
+    #    (list): The digests of the directories referenced by the artifact
+    #
+    def _artifact_reference(self, element, artifact_proto):
+        keys = list(utils._deduplicate([artifact_proto.strong_key, artifact_proto.weak_key]))
+        artifact_names = [element.get_artifact_name(key=key) for key in keys]
+        uris = [REMOTE_ASSET_ARTIFACT_URN_TEMPLATE.format(artifact_name) for artifact_name in artifact_names]
+
+        referenced_directories = []
+        if artifact_proto.files:
+            referenced_directories.append(artifact_proto.files)
+        if artifact_proto.buildtree:
+            referenced_directories.append(artifact_proto.buildtree)
+        if artifact_proto.sources:
+            referenced_directories.append(artifact_proto.sources)
+
+        referenced_blobs = [log_file.digest for log_file in artifact_proto.logs]
+
+        return artifact_names, uris, referenced_blobs, referenced_directories
+
     # _pull_artifact_storage():
     #
     # Pull artifact blobs from the given remote.
@@ -497,6 +937,7 @@ class ArtifactCache(AssetCache):
     #    key (str): The specific key for the artifact to pull
     #    remote (CASRemote): remote to pull from
     #    pull_buildtree (bool): whether to pull buildtrees or not
+    #    pull_files (bool): whether to pull the file contents or only the directories
     #
     # Returns:
     #    (bool): True if we pulled any blobs.
@@ -505,14 +946,7 @@ class ArtifactCache(AssetCache):
     #    ArtifactError: If the pull failed for any reason except the
     #    blobs not existing on the server.
     #
-    def _pull_artifact_storage(self, element, key, artifact_digest, remote, pull_buildtrees=False):
-        def __pull_digest(digest):
-            self.cas._fetch_directory(remote, digest)
-            required_blobs = self.cas.required_blobs_for_directory(digest)
-            missing_blobs = self.cas.local_missing_blobs(required_blobs)
-            if missing_blobs:
-                self.cas.fetch_blobs(remote, missing_blobs)
-
+    def _pull_artifact_storage(self, element, key, artifact_digest, remote, pull_buildtrees=False, pull_files=True):
         artifact_name = element.get_artifact_name(key=key)
 
         try:
@@ -527,12 +961,19 @@ class ArtifactCache(AssetCache):
             os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
             with utils.save_file_atomic(artifact_path, mode="wb") as f:
                 f.write(artifact.SerializeToString())
+            self._index.add([artifact_name])
 
+            # Fetch the trees and the remaining blobs of the artifact together
+            directories = []
+            without_files = []
             if str(artifact.files):
-                __pull_digest(artifact.files)
+                if pull_files:
+                    directories.append(artifact.files)
+                else:
+                    without_files.append(artifact.files)
 
             if pull_buildtrees and str(artifact.buildtree):
-                __pull_digest(artifact.buildtree)
+                directories.append(artifact.buildtree)
 
             digests = []
             if str(artifact.public_data):
@@ -541,7 +982,13 @@ class ArtifactCache(AssetCache):
             for log_digest in artifact.logs:
                 digests.append(log_digest.digest)
 
-            self.cas.fetch_blobs(remote, digests)
+            self.cas._fetch_trees(
+                remote,
+                directories,
+                blobs=digests,
+                without_files=without_files,
+                on_batch=self._batch_reporter(element, "Pulled", "from", remote),
+            )
         except grpc.RpcError as e:
             if e.code() != grpc.StatusCode.NOT_FOUND:
                 raise ArtifactError("Failed to pull artifact with status {}: {}".format(e.code().name, e.details()))
@@ -549,22 +996,194 @@ class ArtifactCache(AssetCache):
 
         return True
 
-    # _query_remote()
+    # _prefetch_artifacts_storage()
+    #
+    # Pull the contents of many artifacts from a storage remote together.
+    #
+    # If the remote misses blobs of some of the artifacts, the artifacts
+    # are fetched again one by one, which only transfers the blobs which
+    # are still missing locally, to find out which artifacts are complete.
     #
     # Args:
-    #    ref (str): The artifact ref
-    #    remote (AssetRemote): The remote we want to check
+    #    remote (CASRemote): The remote to pull from
+    #    artifacts (list): (Element, artifact name, artifact proto digest) tuples
+    #    pull_buildtrees (bool): Whether to pull buildtrees as well
     #
     # Returns:
-    #    (bool): True if the ref exists in the remote, False otherwise.
+    #    (list [Element]): The elements whose artifacts were pulled
     #
-    def _query_remote(self, ref, remote):
-        uri = REMOTE_ASSET_ARTIFACT_URN_TEMPLATE.format(ref)
+    def _prefetch_artifacts_storage(self, remote, artifacts, *, pull_buildtrees=False):
+        missing = self.cas.fetch_blobs(remote, [digest for _, _, digest in artifacts], allow_partial=True)
+        missing = {digest.hash for digest in missing}
+
+        contents = []
+        for element, artifact_name, artifact_digest in artifacts:
+            if artifact_digest.hash in missing:
+                continue
+
+            artifact = artifact_pb2.Artifact()
+            with open(self.cas.objpath(artifact_digest), "rb") as f:
+                artifact.ParseFromString(f.read())
 
+            directories = []
+            if str(artifact.files):
+                directories.append(artifact.files)
+            if pull_buildtrees and str(artifact.buildtree):
+                directories.append(artifact.buildtree)
+
+            digests = [log_digest.digest for log_digest in artifact.logs]
+            if str(artifact.public_data):
+                digests.append(artifact.public_data)
+
+            contents.append((element, artifact_name, artifact, directories, digests))
+
+        on_batch = self._prefetch_reporter(remote)
         try:
-            response = remote.fetch_blob([uri])
-            return bool(response)
-        except grpc.RpcError as e:
-            if e.code() != grpc.StatusCode.NOT_FOUND:
-                raise ArtifactError("Error when querying with status {}: {}".format(e.code().name, e.details()))
+            self.cas._fetch_trees(
+                remote,
+                [digest for _, _, _, directories, _ in contents for digest in directories],
+                blobs=[digest for _, _, _, _, digests in contents for digest in digests],
+                on_batch=on_batch,
+            )
+            complete = contents
+        except BlobNotFound:
+            complete = []
+            for content in contents:
+                _, _, _, directories, digests = content
+                try:
+                    self.cas._fetch_trees(remote, directories, blobs=digests, on_batch=on_batch)
+                    complete.append(content)
+                except BlobNotFound:
+                    pass
+
+        # Only store the artifact protos once all of their blobs are cached
+        pulled = []
+        for element, artifact_name, artifact, _, _ in complete:
+            artifact_path = os.path.join(self._basedir, artifact_name)
+            os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+            with utils.save_file_atomic(artifact_path, mode="wb") as f:
+                f.write(artifact.SerializeToString())
+
+            refs = [artifact_name]
+            for key in (artifact.strong_key, artifact.weak_key):
+                link_ref = element.get_artifact_name(key)
+                if link_ref not in refs:
+                    utils.safe_link(artifact_path, os.path.join(self._basedir, link_ref))
+                    refs.append(link_ref)
+
+            self._index.add(refs)
+            pulled.append(element)
+
+        return pulled
+
+    # _prefetch_reporter()
+    #
+    # Create a callback reporting the throughput of each batch of blobs
+    # prefetched from a remote as a debug message.
+    #
+    # Args:
+    #    remote (CASRemote): The remote
+    #
+    # Returns:
+    #    (callable): The callback for CASCache transfers
+    #
+    def _prefetch_reporter(self, remote):
+        def report(n_blobs, n_bytes, seconds):
+            self._message(
+                MessageType.DEBUG,
+                "Prefetched batch of {} blobs ({}) from {} in {:.2f}s ({}/s)".format(
+                    n_blobs,
+                    utils._pretty_size(n_bytes, dec_places=1),
+                    remote,
+                    seconds,
+                    utils._pretty_size(n_bytes / max(seconds, 0.001), dec_places=1),
+                ),
+            )
+
+        return report
+
+
+# _RemoteMissCache
+#
+# Remembers artifacts which were found missing from remotes, so that
+# the remotes are not queried for them again for a while.
+#
+# Each miss is recorded as an empty file named after the artifact, in
+# a directory per remote, with the time of the miss as its mtime. This
+# allows the cache to be shared between jobs and invocations.
+#
+# Args:
+#    basedir (str): The directory to record misses in
+#    ttl (int): Number of seconds to remember misses for, 0 to disable
+#
+class _RemoteMissCache:
+    def __init__(self, basedir, ttl):
+        self._basedir = basedir
+        self._ttl = ttl
+
+    # contains():
+    #
+    # Args:
+    #    remote (AssetRemote): The remote
+    #    artifact_name (str): The artifact name
+    #
+    # Returns:
+    #    (bool): Whether the artifact recently was missing from the remote
+    #
+    def contains(self, remote, artifact_name):
+        if not self._ttl:
+            return False
+
+        path = self._path(remote, artifact_name)
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
             return False
+
+        if age < self._ttl:
+            return True
+
+        # Expired
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        return False
+
+    # add():
+    #
+    # Record that an artifact is missing from a remote.
+    #
+    # Args:
+    #    remote (AssetRemote): The remote
+    #    artifact_name (str): The artifact name
+    #
+    def add(self, remote, artifact_name):
+        if not self._ttl:
+            return
+
+        path = self._path(remote, artifact_name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w"):
+                pass
+            os.utime(path)
+        except OSError:
+            # This is only an optimization, the remote will simply be
+            # queried again next time.
+            pass
+
+    # remove():
+    #
+    # Forget that an artifact was missing from a remote, e.g. because
+    # it has been pushed.
+    #
+    # Args:
+    #    remote (AssetRemote): The remote
+    #    artifact_name (str): The artifact name
+    #
+    def remove(self, remote, artifact_name):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self._path(remote, artifact_name))
+
+    def _path(self, remote, artifact_name):
+        remote_id = "{}\n{}".format(remote.spec.url, remote.spec.instance_name or "")
+        return os.path.join(self._basedir, hashlib.sha256(remote_id.encode()).hexdigest(), artifact_name)
@@ -0,0 +1,367 @@
+#
+#  Copyright (C) 2020 Bloomberg Finance LP
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	 See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import os
+import sqlite3
+import time
+from fnmatch import fnmatch
+
+
+# Maximum number of refs per SQLite statement, SQLite limits the
+# number of host parameters to 999 by default.
+_MAX_REFS_PER_STATEMENT = 500
+
+# Access times are only written to the index in batches, once this many
+# are pending or this many seconds have passed.
+_MTIME_FLUSH_COUNT = 1024
+_MTIME_FLUSH_INTERVAL = 10
+
+# Seconds to wait for other processes holding the database lock
+_LOCK_TIMEOUT = 60
+
+# Upper bound of the names starting with a given prefix
+_MAX_CHAR = "\U0010ffff"
+
+
+# ArtifactIndex
+#
+# A persistent index of the artifact refs in the local cache, with the
+# project, element and cache key of each ref, its last access time and
+# the size of the artifact contents if known.
+#
+# The artifact protos in the refs directory, which is laid out as
+# `<project>/<element>/<key>`, remain the source of truth. The index
+# allows listing refs and ordering them by last access without walking
+# the directory and stat()ing every ref.
+#
+# The index also records the modification time of each element
+# directory. Before refs are listed, only the element directories are
+# stat()ed, and those which changed without the index being updated,
+# e.g. by an older version of BuildStream, are scanned again. This also
+# populates a new index.
+#
+# The index is a SQLite database which is shared by the jobs of a
+# session and concurrent sessions using the same cache directory. The
+# connection is opened on first use in each process, as it cannot be
+# used across fork.
+#
+# Access times are authoritative in the index, touching a ref file does
+# not change the modification time of its directory. The main process
+# writes them in batches and when it closes the index before fork. Job
+# processes exit without closing the index, so they write them through.
+#
+# Args:
+#     path (str): Path to the database
+#     refdir (str): Path to the directory of artifact refs
+#
+class ArtifactIndex:
+    def __init__(self, path, refdir):
+        self._path = path
+        self._refdir = refdir
+        self._db = None
+        self._pid = None
+        self._main_pid = os.getpid()
+        self._pending_mtimes = {}
+        self._last_flush = time.monotonic()
+
+    # add():
+    #
+    # Add refs written to the refs directory to the index, or update
+    # them if they exist.
+    #
+    # Args:
+    #     refs (iterable): The artifact names
+    #     size (int): The size of the artifact contents in bytes, if known
+    #
+    def add(self, refs, *, size=None):
+        now = time.time()
+        rows = [(ref, *_split_ref(ref), now, size) for ref in refs]
+        for ref, *_ in rows:
+            self._pending_mtimes.pop(ref, None)
+
+        with self._transaction() as db:
+            if size is None:
+                # Keep the size of refs which are known already
+                db.executemany("INSERT OR IGNORE INTO refs VALUES (?, ?, ?, ?, ?, ?)", rows)
+                db.executemany("UPDATE refs SET mtime = ? WHERE ref = ?", [(now, ref) for ref, *_ in rows])
+            else:
+                db.executemany("INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+            self._update_directories(db, {_directory(ref) for ref, *_ in rows})
+
+    # touch():
+    #
+    # Record an access of a ref. Accesses are written in batches, except
+    # in job processes.
+    #
+    # Args:
+    #     ref (str): The artifact name
+    #
+    def touch(self, ref):
+        if os.getpid() != self._main_pid:
+            with self._transaction() as db:
+                db.execute("UPDATE refs SET mtime = ? WHERE ref = ?", (time.time(), ref))
+            return
+
+        self._pending_mtimes[ref] = time.time()
+
+        if (
+            len(self._pending_mtimes) >= _MTIME_FLUSH_COUNT
+            or time.monotonic() - self._last_flush >= _MTIME_FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    # remove():
+    #
+    # Remove refs removed from the refs directory from the index, refs
+    # which aren't indexed are ignored.
+    #
+    # Args:
+    #     refs (iterable): The artifact names
+    #
+    def remove(self, refs):
+        refs = list(refs)
+        for ref in refs:
+            self._pending_mtimes.pop(ref, None)
+
+        with self._transaction() as db:
+            db.executemany("DELETE FROM refs WHERE ref = ?", [(ref,) for ref in refs])
+            self._update_directories(db, {_directory(ref) for ref in refs})
+
+    # list_refs():
+    #
+    # List the indexed refs in LRU order.
+    #
+    # Args:
+    #     glob (str): An optional glob expression the refs must match
+    #
+    # Returns:
+    #     (list [(float, str)]): The last access time and name of each ref
+    #
+    def list_refs(self, *, glob=None):
+        # Only refs starting with the literal prefix of the glob can
+        # match it, which narrows the query to a range of the primary key
+        prefix = ""
+        if glob is not None:
+            prefix = glob
+            for i, c in enumerate(glob):
+                if c in "*?[":
+                    prefix = glob[:i]
+                    break
+
+        self.flush()
+        self._validate(prefix)
+
+        rows = self._get_db().execute(
+            "SELECT mtime, ref FROM refs WHERE ref >= ? AND ref < ?", (prefix, prefix + _MAX_CHAR)
+        )
+        if glob is not None:
+            rows = [row for row in rows if fnmatch(row[1], glob)]
+
+        return sorted(rows)
+
+    # get_refs():
+    #
+    # Get the index entries of refs.
+    #
+    # Args:
+    #     refs (iterable): The artifact names
+    #
+    # Returns:
+    #     (dict): (project, element, key, mtime, size) tuples of the indexed refs, by ref
+    #
+    def get_refs(self, refs):
+        self.flush()
+        db = self._get_db()
+        refs = list(refs)
+        entries = {}
+
+        for i in range(0, len(refs), _MAX_REFS_PER_STATEMENT):
+            batch = refs[i : i + _MAX_REFS_PER_STATEMENT]
+            rows = db.execute(
+                "SELECT ref, project, element, key, mtime, size FROM refs WHERE ref IN ({})".format(
+                    ",".join("?" * len(batch))
+                ),
+                batch,
+            )
+            for ref, *entry in rows:
+                entries[ref] = tuple(entry)
+
+        return entries
+
+    # flush():
+    #
+    # Write pending access times to the index.
+    #
+    def flush(self):
+        if self._pending_mtimes:
+            pending = self._pending_mtimes
+            self._pending_mtimes = {}
+            with self._transaction() as db:
+                db.executemany("UPDATE refs SET mtime = ? WHERE ref = ?", [(t, ref) for ref, t in pending.items()])
+
+        self._last_flush = time.monotonic()
+
+    # close():
+    #
+    # Write pending access times and close the database.
+    #
+    def close(self):
+        if self._db is not None and self._pid == os.getpid():
+            self.flush()
+            self._db.close()
+        self._db = None
+
+    # Scan the element directories which may contain refs starting with
+    # the prefix again, if they changed since they were last indexed.
+    def _validate(self, prefix):
+        project_prefix, project_sep, rest = prefix.partition("/")
+        element_prefix, element_sep, _ = rest.partition("/")
+
+        on_disk = {}
+        for project in _scandir(self._refdir):
+            if not _name_matches(project.name, project_prefix, exact=bool(project_sep)):
+                continue
+            for element in _scandir(project.path):
+                if not _name_matches(element.name, element_prefix, exact=bool(element_sep)):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    on_disk[project.name + "/" + element.name] = element.stat().st_mtime_ns
+
+        indexed = {}
+        for directory, mtime in self._get_db().execute("SELECT directory, mtime FROM directories"):
+            project, _, element = directory.partition("/")
+            if _name_matches(project, project_prefix, exact=bool(project_sep)) and _name_matches(
+                element, element_prefix, exact=bool(element_sep)
+            ):
+                indexed[directory] = mtime
+
+        changed = [d for d in on_disk.keys() | indexed.keys() if on_disk.get(d) != indexed.get(d)]
+        if not changed:
+            return
+
+        with self._transaction() as db:
+            for directory in changed:
+                rows = []
+                for entry in _scandir(os.path.join(self._refdir, directory)):
+                    ref = directory + "/" + entry.name
+                    with contextlib.suppress(FileNotFoundError):
+                        rows.append((ref, *_split_ref(ref), entry.stat().st_mtime, None))
+
+                # Drop the refs which were removed
+                found = {ref for ref, *_ in rows}
+                stale = db.execute(
+                    "SELECT ref FROM refs WHERE ref >= ? AND ref < ?", (directory + "/", directory + "/" + _MAX_CHAR)
+                ).fetchall()
+                db.executemany("DELETE FROM refs WHERE ref = ?", [row for row in stale if row[0] not in found])
+
+                # Add the refs which were added, and keep the later access time
+                # of the ref file and the index for the others
+                db.executemany("INSERT OR IGNORE INTO refs VALUES (?, ?, ?, ?, ?, ?)", rows)
+                db.executemany(
+                    "UPDATE refs SET mtime = max(mtime, ?) WHERE ref = ?", [(mtime, ref) for ref, *_, mtime, _ in rows]
+                )
+
+            self._update_directories(db, changed)
+
+    # Record the current modification times of element directories
+    def _update_directories(self, db, directories):
+        for directory in directories:
+            try:
+                mtime = os.stat(os.path.join(self._refdir, directory)).st_mtime_ns
+            except FileNotFoundError:
+                db.execute("DELETE FROM directories WHERE directory = ?", (directory,))
+            else:
+                db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)", (directory, mtime))
+
+    # Get the connection of this process, creating the database if it
+    # doesn't exist yet.
+    def _get_db(self):
+        pid = os.getpid()
+        if self._db is not None and self._pid == pid:
+            return self._db
+
+        if pid != self._main_pid:
+            # The connection of the main process must not be used, access
+            # times pending in the main process will be written by it
+            self._pending_mtimes = {}
+
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        db = sqlite3.connect(self._path, timeout=_LOCK_TIMEOUT, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS refs ("
+                "ref TEXT PRIMARY KEY, project TEXT NOT NULL, element TEXT NOT NULL, key TEXT NOT NULL, "
+                "mtime REAL NOT NULL, size INTEGER"
+                ") WITHOUT ROWID"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS refs_mtime ON refs (mtime)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS directories ("
+                "directory TEXT PRIMARY KEY, mtime INTEGER NOT NULL"
+                ") WITHOUT ROWID"
+            )
+        except BaseException:
+            db.close()
+            raise
+
+        self._db = db
+        self._pid = pid
+        return db
+
+    # Run statements in a transaction which holds the write lock from the
+    # start, so that concurrent processes don't scan the same directories
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._get_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+
+# Split an artifact name into its project, element and key
+def _split_ref(ref):
+    project, _, rest = ref.partition("/")
+    element, _, key = rest.rpartition("/")
+    return project, element, key
+
+
+# Get the element directory of an artifact name
+def _directory(ref):
+    return ref.rpartition("/")[0]
+
+
+# Whether a directory name may contain refs with the given prefix
+def _name_matches(name, prefix, *, exact):
+    if exact:
+        return name == prefix
+    return name.startswith(prefix)
+
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
@@ -16,6 +16,8 @@
 #  Authors:
 #        Raoul Hidalgo Charman <raoul.hidalgocharman@codethink.co.uk>
 #
+import contextlib
+import errno
 import os
 from fnmatch import fnmatch
 from itertools import chain
@@ -27,10 +29,14 @@ from . import _yaml
 from ._cas import CASRemote
 from ._message import Message, MessageType
 from ._exceptions import AssetCacheError, LoadError, RemoteError
-from ._remote import BaseRemote, RemoteSpec, RemoteType
+from ._remote import BaseRemote, RemoteSpec, RemoteType, completed_futures
 from ._protos.build.bazel.remote.asset.v1 import remote_asset_pb2, remote_asset_pb2_grpc
 from ._protos.google.rpc import code_pb2
 
+# Number of refs whose contents are checked together when looking for
+# orphaned refs
+_ORPHAN_CHECK_BATCH = 10000
+
 
 if TYPE_CHECKING:
     from typing import Optional, Type
@@ -120,6 +126,17 @@ class AssetRemote(BaseRemote):
     #     AssetCacheError: If the upstream has a problem
     #
     def fetch_blob(self, uris, *, qualifiers=None):
+        return self.fetch_blob_result(self.fetch_blob_future(uris, qualifiers=qualifiers))
+
+    # fetch_blob_future():
+    #
+    # Start resolving URIs to a CAS blob digest without waiting for the
+    # response, see fetch_blob().
+    #
+    # Returns
+    #    (grpc.Future): The pending call, to be passed to fetch_blob_result()
+    #
+    def fetch_blob_future(self, uris, *, qualifiers=None):
         request = remote_asset_pb2.FetchBlobRequest()
         if self.instance_name:
             request.instance_name = self.instance_name
@@ -127,8 +144,25 @@ class AssetRemote(BaseRemote):
         if qualifiers:
             request.qualifiers.extend(qualifiers)
 
+        return self.fetch_service.FetchBlob.future(request)
+
+    # fetch_blob_result():
+    #
+    # Wait for the result of a call started with fetch_blob_future().
+    #
+    # Args:
+    #    future (grpc.Future): The pending call
+    #
+    # Returns
+    #    (FetchBlobResponse): The asset server response or None if the resource
+    #                         is not available.
+    #
+    # Raises:
+    #     AssetCacheError: If the upstream has a problem
+    #
+    def fetch_blob_result(self, future):
         try:
-            response = self.fetch_service.FetchBlob(request)
+            response = future.result()
         except grpc.RpcError as e:
             if e.code() == grpc.StatusCode.NOT_FOUND:
                 return None
@@ -202,6 +236,27 @@ class AssetRemote(BaseRemote):
     #     AssetCacheError: If the upstream has a problem
     #
     def push_blob(self, uris, blob_digest, *, qualifiers=None, references_blobs=None, references_directories=None):
+        self.push_blob_result(
+            self.push_blob_future(
+                uris,
+                blob_digest,
+                qualifiers=qualifiers,
+                references_blobs=references_blobs,
+                references_directories=references_directories,
+            )
+        )
+
+    # push_blob_future():
+    #
+    # Start associating a CAS blob digest to URIs without waiting for the
+    # response, see push_blob().
+    #
+    # Returns
+    #    (grpc.Future): The pending call, to be passed to push_blob_result()
+    #
+    def push_blob_future(
+        self, uris, blob_digest, *, qualifiers=None, references_blobs=None, references_directories=None
+    ):
         request = remote_asset_pb2.PushBlobRequest()
         if self.instance_name:
             request.instance_name = self.instance_name
@@ -214,8 +269,21 @@ class AssetRemote(BaseRemote):
         if references_directories:
             request.references_directories.extend(references_directories)
 
+        return self.push_service.PushBlob.future(request)
+
+    # push_blob_result():
+    #
+    # Wait for the result of a call started with push_blob_future().
+    #
+    # Args:
+    #    future (grpc.Future): The pending call
+    #
+    # Raises:
+    #     AssetCacheError: If the upstream has a problem
+    #
+    def push_blob_result(self, future):
         try:
-            self.push_service.PushBlob(request)
+            future.result()
         except grpc.RpcError as e:
             raise AssetCacheError("PushBlob failed with status {}: {}".format(e.code().name, e.details())) from e
 
@@ -410,6 +478,10 @@ class AssetCache:
     #     on_failure (callable): Called if we fail to contact one of the caches.
     #
     def initialize_remotes(self, *, on_failure=None):
+        # Remotes are accessed through buildbox-casd, which must be started
+        # before the remote gRPC channels are opened.
+        self.cas.start_casd()
+
         index_remotes, storage_remotes = self._create_remote_instances(on_failure=on_failure)
 
         # Assign remote instances to their respective projects
@@ -486,6 +558,51 @@ class AssetCache:
     #               Local Private Methods          #
     ################################################
 
+    # _fetch_blob_from_remotes():
+    #
+    # Resolve URIs to a CAS blob digest, querying all the given index
+    # remotes concurrently.
+    #
+    # The first remote to answer positively wins. If several remotes
+    # have answered by then, the one configured first is preferred.
+    # Calls to the remaining remotes are cancelled.
+    #
+    # Args:
+    #    remotes (list of AssetRemote): The remotes to query, in priority order
+    #    uris (list of str): The URIs to resolve
+    #    on_missing (callable): Optional callback invoked with each remote
+    #                           which does not have the blob
+    #
+    # Returns:
+    #    (AssetRemote|None): The remote which resolved the URIs, if any
+    #    (FetchBlobResponse|None): The response of that remote
+    #    (list): (AssetRemote, AssetCacheError) tuples for failed remotes
+    #
+    def _fetch_blob_from_remotes(self, remotes, uris, *, on_missing=None):
+        errors = []
+        futures = []
+        for remote in remotes:
+            remote.init()
+            futures.append(remote.fetch_blob_future(uris))
+
+        with contextlib.closing(completed_futures(futures)) as completed:
+            for indices in completed:
+                for index in indices:
+                    remote = remotes[index]
+                    try:
+                        response = remote.fetch_blob_result(futures[index])
+                    except AssetCacheError as e:
+                        errors.append((remote, e))
+                        continue
+
+                    if response:
+                        return remote, response, errors
+
+                    if on_missing:
+                        on_missing(remote)
+
+        return None, None, errors
+
     # _create_remote_instances():
     #
     # Create the global set of Remote instances, including
@@ -659,3 +776,125 @@ class AssetCache:
             raise AssetCacheError("Could not find ref '{}'".format(ref)) from e
         except OSError as e:
             raise AssetCacheError("System error while removing ref '{}': {}".format(ref, e)) from e
+
+    # _remove_refs()
+    #
+    # Removes many refs in one pass.
+    #
+    # The directories left empty are pruned once all refs are removed,
+    # attempting to remove each directory at most once.
+    #
+    # Args:
+    #    refs (iterable): The refs to remove
+    #
+    # Returns:
+    #    (list): The removed refs
+    #    (list): (ref, AssetCacheError) tuples of the refs which could not be removed
+    #
+    def _remove_refs(self, refs):
+        removed = []
+        failed = []
+        directories = set()
+
+        for ref in refs:
+            try:
+                os.unlink(os.path.join(self._basedir, ref))
+            except FileNotFoundError:
+                failed.append((ref, AssetCacheError("Could not find ref '{}'".format(ref), reason="ref-not-found")))
+                continue
+            except OSError as e:
+                failed.append((ref, AssetCacheError("System error while removing ref '{}': {}".format(ref, e))))
+                continue
+
+            removed.append(ref)
+            directory = os.path.dirname(ref)
+            while directory and directory not in directories:
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+
+        # Remove the deepest directories first, parents of directories
+        # which are not empty are not empty either
+        not_empty = set()
+        for directory in sorted(directories, key=lambda d: d.count(os.sep), reverse=True):
+            if directory in not_empty:
+                continue
+
+            try:
+                os.rmdir(os.path.join(self._basedir, directory))
+                continue
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                if e.errno != errno.ENOTEMPTY:
+                    raise AssetCacheError("System error while pruning directory '{}': {}".format(directory, e)) from e
+
+            parent = os.path.dirname(directory)
+            while parent and parent not in not_empty:
+                not_empty.add(parent)
+                parent = os.path.dirname(parent)
+
+        return removed, failed
+
+    # _find_orphaned_refs()
+    #
+    # Find the refs whose contents were evicted from the local CAS.
+    #
+    # The contents of the refs are checked in batches, querying
+    # buildbox-casd for each distinct directory and blob only once.
+    #
+    # Args:
+    #    refs (iterable): The refs to check
+    #    get_contents (callable): Returns a list of (Digest, with_files) tuples of the
+    #                             required directories and a list of the Digests of the
+    #                             required blobs, given the serialized proto of a ref
+    #
+    # Returns:
+    #    (list): The orphaned refs
+    #
+    def _find_orphaned_refs(self, refs, get_contents):
+        refs = list(refs)
+        orphans = []
+
+        for offset in range(0, len(refs), _ORPHAN_CHECK_BATCH):
+            batch = []
+            for ref in refs[offset : offset + _ORPHAN_CHECK_BATCH]:
+                try:
+                    with open(os.path.join(self._basedir, ref), "rb") as f:
+                        directories, blobs = get_contents(f.read())
+                except FileNotFoundError:
+                    continue
+                batch.append((ref, directories, blobs))
+
+            requests = {}
+            blobs = {}
+            for _, ref_directories, ref_blobs in batch:
+                for digest, with_files in ref_directories:
+                    requests.setdefault((digest.hash, with_files), (digest, with_files))
+                for digest in ref_blobs:
+                    blobs.setdefault(digest.hash, digest)
+
+            request_keys = list(requests)
+            available = dict(zip(request_keys, self.cas.contains_directories([requests[k] for k in request_keys])))
+            missing = {digest.hash for digest in self.cas.missing_files(list(blobs.values()))}
+
+            for ref, ref_directories, ref_blobs in batch:
+                if any(not available[(digest.hash, with_files)] for digest, with_files in ref_directories) or any(
+                    digest.hash in missing for digest in ref_blobs
+                ):
+                    orphans.append(ref)
+
+        return orphans
+
+    # _list_refs()
+    #
+    # List all refs of this cache.
+    #
+    # Returns:
+    #    (list): The refs relative to the base directory
+    #
+    def _list_refs(self):
+        return [
+            os.path.relpath(os.path.join(root, filename), self._basedir)
+            for root, _, files in os.walk(self._basedir)
+            for filename in files
+        ]
@@ -18,14 +18,19 @@
 #  Authors:
 #        Jürg Billeter <juerg.billeter@codethink.co.uk>
 
+import concurrent.futures
 import itertools
 import os
 import stat
 import contextlib
 import ctypes
+import functools
+import hashlib
 import multiprocessing
+import shutil
 import signal
 import time
+import uuid
 from typing import Optional, List
 
 import grpc
@@ -35,11 +40,13 @@ from .._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
 from .._protos.build.buildgrid import local_cas_pb2
 
 from .. import _signals, utils
+from .._remote import completed_futures
 from ..types import FastEnum, SourceRef
 from .._exceptions import CASCacheError
 
 from .casdprocessmanager import CASDProcessManager
 from .casremote import _CASBatchRead, _CASBatchUpdate
+from .transfershaper import TransferShaper
 
 _BUFFER_SIZE = 65536
 
@@ -47,6 +54,19 @@ _BUFFER_SIZE = 65536
 # Refresh interval for disk usage of local cache in seconds
 _CACHE_USAGE_REFRESH = 5
 
+# Maximum number of threads used to check out files from the local cache
+_CHECKOUT_MAX_WORKERS = 8
+
+# Number of files checked out by a single checkout task
+_CHECKOUT_CHUNK_SIZE = 256
+
+# Maximum number of local cache queries in flight when checking the
+# cached state of many artifacts at once
+_MAX_CONCURRENT_LOCAL_QUERIES = 64
+
+# Maximum number of digests in a single local FindMissingBlobs request
+_MAX_MISSING_BLOBS_BATCH = 512
+
 
 class CASLogLevel(FastEnum):
     WARNING = "warning"
@@ -63,6 +83,12 @@ class CASLogLevel(FastEnum):
 #     protect_session_blobs (bool): Disable expiry for blobs used in the current session
 #     log_level (LogLevel): Log level to give to buildbox-casd for logging
 #     log_directory (str): the root of the directory in which to store logs
+#     shared_casd (bool): Whether to share the buildbox-casd process with other sessions
+#     shared_casd_idle_timeout (int): Seconds to keep an unused shared buildbox-casd running
+#     batch_requests_in_flight (int): Maximum number of concurrent requests to transfer blobs
+#     pull_bandwidth_limit (int): Maximum bytes per second to pull blobs, or None
+#     push_bandwidth_limit (int): Maximum bytes per second to push blobs, or None
+#     prioritize_pulls (bool): Whether pushes pause while blobs are pulled
 #
 class CASCache:
     def __init__(
@@ -73,33 +99,77 @@ class CASCache:
         cache_quota=None,
         protect_session_blobs=True,
         log_level=CASLogLevel.WARNING,
-        log_directory=None
+        log_directory=None,
+        shared_casd=False,
+        shared_casd_idle_timeout=0,
+        batch_requests_in_flight=4,
+        pull_bandwidth_limit=None,
+        push_bandwidth_limit=None,
+        prioritize_pulls=False
     ):
         self.casdir = os.path.join(path, "cas")
         self.tmpdir = os.path.join(path, "tmp")
         os.makedirs(self.tmpdir, exist_ok=True)
 
+        self.batch_requests_in_flight = batch_requests_in_flight
+        self.transfer_shaper = TransferShaper(
+            os.path.join(self.tmpdir, "transfers"),
+            pull_limit=pull_bandwidth_limit,
+            push_limit=push_bandwidth_limit,
+            prioritize_pulls=prioritize_pulls,
+        )
+
+        # Directory trees confirmed present on remotes in this session,
+        # created here so that it is shared with the forked jobs
+        self._remote_presence = _RemotePresence(
+            os.path.join(self.tmpdir, "remote-presence-{}".format(uuid.uuid4().hex))
+        )
+
         self._cache_usage_monitor = None
         self._cache_usage_monitor_forbidden = False
 
         self._casd_process_manager = None
         self._casd_channel = None
+        self._casd_start = None  # Starts buildbox-casd on first use
         if casd:
             assert log_directory is not None, "log_directory is required when casd is True"
             log_dir = os.path.join(log_directory, "_casd")
-            self._casd_process_manager = CASDProcessManager(
-                path, log_dir, log_level, cache_quota, protect_session_blobs
+            self._casd_start = functools.partial(
+                CASDProcessManager,
+                path,
+                log_dir,
+                log_level,
+                cache_quota,
+                protect_session_blobs,
+                shared=shared_casd,
+                shared_idle_timeout=shared_casd_idle_timeout,
             )
 
-            self._casd_channel = self._casd_process_manager.create_channel()
-            self._cache_usage_monitor = _CASCacheUsageMonitor(self._casd_channel)
+    # start_casd():
+    #
+    # Start buildbox-casd, if it isn't running already.
+    #
+    # buildbox-casd is started when it is first used, so that commands which
+    # never access the cache don't wait for it. This must be called before
+    # opening any other gRPC channels, as starting the cache usage monitor
+    # requires forking, and before forking jobs which use the cache.
+    #
+    def start_casd(self):
+        if self._casd_process_manager:
+            return
+
+        assert self._casd_start, "CASCache was created without a channel"
+
+        self._casd_process_manager = self._casd_start()
+        self._casd_channel = self._casd_process_manager.create_channel()
+        self._cache_usage_monitor = _CASCacheUsageMonitor(self._casd_channel)
 
     # get_cas():
     #
     # Return ContentAddressableStorage stub for buildbox-casd channel.
     #
     def get_cas(self):
-        assert self._casd_channel, "CASCache was created without a channel"
+        self.start_casd()
         return self._casd_channel.get_cas()
 
     # get_local_cas():
@@ -107,7 +177,7 @@ class CASCache:
     # Return LocalCAS stub for buildbox-casd channel.
     #
     def get_local_cas(self):
-        assert self._casd_channel, "CASCache was created without a channel"
+        self.start_casd()
         return self._casd_channel.get_local_cas()
 
     # preflight():
@@ -139,6 +209,8 @@ class CASCache:
             self._casd_process_manager.release_resources(messenger)
             self._casd_process_manager = None
 
+        self._remote_presence.release_resources()
+
     # contains_files():
     #
     # Check whether file digests exist in the local CAS cache
@@ -185,59 +257,105 @@ class CASCache:
                 raise CASCacheError("Unsupported buildbox-casd version: FetchTree unimplemented") from e
             raise
 
-    # checkout():
+    # contains_directories():
     #
-    # Checkout the specified directory digest.
+    # Check whether the specified directories and their subdirectories are
+    # in the cache, querying buildbox-casd for many directories concurrently.
     #
     # Args:
-    #     dest (str): The destination path
-    #     tree (Digest): The directory digest to extract
-    #     can_link (bool): Whether we can create hard links in the destination
+    #     requests (list): Tuples of the directory Digest to check and
+    #                      whether to check files as well
     #
-    def checkout(self, dest, tree, *, can_link=False):
-        os.makedirs(dest, exist_ok=True)
+    # Returns: (list of bool) Whether each directory is available in the local cache
+    #
+    def contains_directories(self, requests):
+        local_cas = self.get_local_cas()
 
-        directory = remote_execution_pb2.Directory()
+        results = [False] * len(requests)
+        for offset in range(0, len(requests), _MAX_CONCURRENT_LOCAL_QUERIES):
+            futures = []
+            for digest, with_files in requests[offset : offset + _MAX_CONCURRENT_LOCAL_QUERIES]:
+                request = local_cas_pb2.FetchTreeRequest()
+                request.root_digest.CopyFrom(digest)
+                request.fetch_file_blobs = with_files
+                futures.append(local_cas.FetchTree.future(request))
 
-        with open(self.objpath(tree), "rb") as f:
-            directory.ParseFromString(f.read())
+            try:
+                for index, future in enumerate(futures):
+                    try:
+                        future.result()
+                        results[offset + index] = True
+                    except grpc.RpcError as e:
+                        if e.code() == grpc.StatusCode.NOT_FOUND:
+                            continue
+                        if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                            raise CASCacheError("Unsupported buildbox-casd version: FetchTree unimplemented") from e
+                        raise
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return results
+
+    # missing_files():
+    #
+    # Check which of the specified file digests are missing from the local
+    # CAS cache, batching the digests into as few requests as possible.
+    #
+    # Args:
+    #     digests (list): The Digests of the files to check
+    #
+    # Returns: (list) The missing Digest objects
+    #
+    def missing_files(self, digests):
+        cas = self.get_cas()
 
-        for filenode in directory.files:
-            # regular file, create hardlink
-            fullpath = os.path.join(dest, filenode.name)
+        futures = []
+        for offset in range(0, len(digests), _MAX_MISSING_BLOBS_BATCH):
+            request = remote_execution_pb2.FindMissingBlobsRequest()
+            request.blob_digests.extend(digests[offset : offset + _MAX_MISSING_BLOBS_BATCH])
+            futures.append(cas.FindMissingBlobs.future(request))
 
-            node_properties = filenode.node_properties
-            if node_properties.HasField("mtime"):
-                mtime = utils._parse_protobuf_timestamp(node_properties.mtime)
-            else:
-                mtime = None
+        missing_blobs = []
+        for future in futures:
+            missing_blobs.extend(future.result().missing_blob_digests)
 
-            if can_link and mtime is None:
-                utils.safe_link(self.objpath(filenode.digest), fullpath)
-            else:
-                utils.safe_copy(self.objpath(filenode.digest), fullpath, copystat=False)
-                if mtime is not None:
-                    utils._set_file_mtime(fullpath, mtime)
+        return missing_blobs
 
-            if filenode.is_executable:
-                st = os.stat(fullpath)
-                mode = st.st_mode
-                if mode & stat.S_IRUSR:
-                    mode |= stat.S_IXUSR
-                if mode & stat.S_IRGRP:
-                    mode |= stat.S_IXGRP
-                if mode & stat.S_IROTH:
-                    mode |= stat.S_IXOTH
-                os.chmod(fullpath, mode)
+    # checkout():
+    #
+    # Checkout the specified directory digest.
+    #
+    # The directory tree is walked once to create all directories and
+    # symlinks, the files are then materialised in parallel.
+    #
+    # Args:
+    #     dest (str): The destination path
+    #     tree (Digest): The directory digest to extract
+    #     can_link (bool): Whether we can create hard links in the destination
+    #     max_workers (int): The maximum number of threads to check out files with
+    #
+    # Files which cannot be hard linked are reflinked if the filesystem
+    # supports it, and copied otherwise.
+    #
+    def checkout(self, dest, tree, *, can_link=False, max_workers=_CHECKOUT_MAX_WORKERS):
+        files = []
+        self._checkout_directories(dest, tree, files)
 
-        for dirnode in directory.directories:
-            fullpath = os.path.join(dest, dirnode.name)
-            self.checkout(fullpath, dirnode.digest, can_link=can_link)
+        chunks = [files[i : i + _CHECKOUT_CHUNK_SIZE] for i in range(0, len(files), _CHECKOUT_CHUNK_SIZE)]
+
+        if max_workers <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                self._checkout_files(chunk, can_link=can_link)
+            return
 
-        for symlinknode in directory.symlinks:
-            # symlink
-            fullpath = os.path.join(dest, symlinknode.name)
-            os.symlink(symlinknode.target, fullpath)
+        # The thread pool is shut down before returning, BuildStream
+        # must be single threaded whenever it forks.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._checkout_files, chunk, can_link=can_link) for chunk in chunks]
+            for future in concurrent.futures.as_completed(futures):
+                # Raise the first error, if any
+                future.result()
 
     # pull_tree():
     #
@@ -421,6 +539,46 @@ class CASCache:
 
         return missing_blobs.values()
 
+    # remotes_by_response_time():
+    #
+    # Generator that yields remotes in the order in which they confirm
+    # having the specified blob, querying all of them concurrently.
+    #
+    # Remotes which do not have the blob, or which fail to answer, are
+    # yielded last. Remotes answering together, as well as the remotes
+    # yielded last, keep the order in which they were passed.
+    #
+    # Args:
+    #     remotes (list): The CASRemotes to query, in priority order
+    #     digest (Digest): The blob to query for
+    #
+    def remotes_by_response_time(self, remotes, digest):
+        cas = self.get_cas()
+
+        futures = []
+        for remote in remotes:
+            remote.init()
+            request = remote_execution_pb2.FindMissingBlobsRequest(instance_name=remote.local_cas_instance_name)
+            request.blob_digests.add().CopyFrom(digest)
+            futures.append(cas.FindMissingBlobs.future(request))
+
+        unavailable = []
+        with contextlib.closing(completed_futures(futures)) as completed:
+            for indices in completed:
+                for index in indices:
+                    try:
+                        available = not futures[index].result().missing_blob_digests
+                    except grpc.RpcError:
+                        available = False
+
+                    if available:
+                        yield remotes[index]
+                    else:
+                        unavailable.append(index)
+
+        for index in sorted(unavailable):
+            yield remotes[index]
+
     # local_missing_blobs():
     #
     # Check local cache for missing blobs.
@@ -438,6 +596,33 @@ class CASCache:
                 missing_blobs.append(digest)
         return missing_blobs
 
+    # required_files_for_directory():
+    #
+    # Generator that returns the Digests of the files in the tree specified
+    # by the Digest of the toplevel Directory object.
+    #
+    # Args:
+    #     directory_digest (Digest): The Digest of the toplevel Directory
+    #     filter_callback (callable): Optional filter callback, called with the
+    #                                 relative path of each file, only files for
+    #                                 which it returns True are included
+    #     path_prefix (str): The relative path of the directory in the tree
+    #
+    def required_files_for_directory(self, directory_digest, *, filter_callback=None, path_prefix=""):
+        directory = remote_execution_pb2.Directory()
+
+        with open(self.objpath(directory_digest), "rb") as f:
+            directory.ParseFromString(f.read())
+
+        for filenode in directory.files:
+            if not filter_callback or filter_callback(os.path.join(path_prefix, filenode.name)):
+                yield filenode.digest
+
+        for dirnode in directory.directories:
+            yield from self.required_files_for_directory(
+                dirnode.digest, filter_callback=filter_callback, path_prefix=os.path.join(path_prefix, dirnode.name)
+            )
+
     # required_blobs_for_directory():
     #
     # Generator that returns the Digests of all blobs in the tree specified by
@@ -499,6 +684,71 @@ class CASCache:
         for dirnode in directory.directories:
             self._reachable_refs_dir(reachable, dirnode.digest, update_mtime=update_mtime, check_exists=check_exists)
 
+    # _checkout_directories():
+    #
+    # Create the directories and symlinks of a directory tree in the
+    # destination, collecting the files to be checked out.
+    #
+    # Args:
+    #     dest (str): The destination path
+    #     tree (Digest): The directory digest to extract
+    #     files (list): List to append (FileNode, path) tuples to
+    #
+    def _checkout_directories(self, dest, tree, files):
+        queue = [(dest, tree)]
+
+        while queue:
+            dirpath, dir_digest = queue.pop()
+            os.makedirs(dirpath, exist_ok=True)
+
+            directory = remote_execution_pb2.Directory()
+
+            with open(self.objpath(dir_digest), "rb") as f:
+                directory.ParseFromString(f.read())
+
+            for filenode in directory.files:
+                files.append((filenode, os.path.join(dirpath, filenode.name)))
+
+            for dirnode in directory.directories:
+                queue.append((os.path.join(dirpath, dirnode.name), dirnode.digest))
+
+            for symlinknode in directory.symlinks:
+                os.symlink(symlinknode.target, os.path.join(dirpath, symlinknode.name))
+
+    # _checkout_files():
+    #
+    # Check out files whose parent directories already exist.
+    #
+    # Args:
+    #     files (list): List of (FileNode, path) tuples
+    #     can_link (bool): Whether we can create hard links in the destination
+    #
+    def _checkout_files(self, files, *, can_link):
+        for filenode, fullpath in files:
+            node_properties = filenode.node_properties
+            if node_properties.HasField("mtime"):
+                mtime = utils._parse_protobuf_timestamp(node_properties.mtime)
+            else:
+                mtime = None
+
+            if can_link and mtime is None:
+                utils.safe_link(self.objpath(filenode.digest), fullpath)
+            else:
+                utils.safe_copy(self.objpath(filenode.digest), fullpath, copystat=False)
+                if mtime is not None:
+                    utils._set_file_mtime(fullpath, mtime)
+
+            if filenode.is_executable:
+                st = os.stat(fullpath)
+                mode = st.st_mode
+                if mode & stat.S_IRUSR:
+                    mode |= stat.S_IXUSR
+                if mode & stat.S_IRGRP:
+                    mode |= stat.S_IXGRP
+                if mode & stat.S_IROTH:
+                    mode |= stat.S_IXOTH
+                os.chmod(fullpath, mode)
+
     # _temporary_object():
     #
     # Returns:
@@ -534,90 +784,93 @@ class CASCache:
 
         return objpath
 
-    # Helper function for _fetch_directory().
-    def _fetch_directory_batch(self, remote, batch, fetch_queue, fetch_next_queue):
-        batch.send()
-
-        # All previously scheduled directories are now locally available,
-        # move them to the processing queue.
-        fetch_queue.extend(fetch_next_queue)
-        fetch_next_queue.clear()
-        return _CASBatchRead(remote)
+    def _fetch_tree(self, remote, digest):
+        objpath = self._ensure_blob(remote, digest)
 
-    # Helper function for _fetch_directory().
-    def _fetch_directory_node(self, remote, digest, batch, fetch_queue, fetch_next_queue, *, recursive=False):
-        in_local_cache = os.path.exists(self.objpath(digest))
+        tree = remote_execution_pb2.Tree()
 
-        if in_local_cache:
-            # Skip download, already in local cache.
-            pass
-        else:
-            batch.add(digest)
+        with open(objpath, "rb") as f:
+            tree.ParseFromString(f.read())
 
-        if recursive:
-            if in_local_cache:
-                # Add directory to processing queue.
-                fetch_queue.append(digest)
-            else:
-                # Directory will be available after completing pending batch.
-                # Add directory to deferred processing queue.
-                fetch_next_queue.append(digest)
+        tree.children.extend([tree.root])
+        for directory in tree.children:
+            dirbuffer = directory.SerializeToString()
+            dirdigest = self.add_object(buffer=dirbuffer)
+            assert dirdigest.size_bytes == len(dirbuffer)
 
-        return batch
+        return dirdigest
 
-    # _fetch_directory():
+    # _fetch_trees():
     #
-    # Fetches remote directory and adds it to content addressable store.
+    # Fetches remote directory trees including their files, as well as
+    # further blobs, and adds them to the content addressable store.
     #
-    # This recursively fetches directory objects but doesn't fetch any
-    # files.
+    # The directories of all trees are fetched level by level. The file
+    # blobs of each level which are missing locally are queued for download
+    # right away, so that their download overlaps with the discovery of the
+    # next levels, and the trees are fetched concurrently.
     #
     # Args:
     #     remote (Remote): The remote to use.
-    #     dir_digest (Digest): Digest object for the directory to fetch.
+    #     dir_digests (list): Digest objects of the toplevel directories
+    #     blobs (list): Digest objects of further blobs to fetch
+    #     without_files (list): Digest objects of further toplevel directories
+    #                           to fetch without the file blobs
+    #     on_batch (callable): Called with the number of blobs, bytes and
+    #                          seconds of each completed batch of file blobs
     #
-    def _fetch_directory(self, remote, dir_digest):
-        # TODO Use GetTree() if the server supports it
-
-        fetch_queue = [dir_digest]
-        fetch_next_queue = []
-        batch = _CASBatchRead(remote)
-
-        while len(fetch_queue) + len(fetch_next_queue) > 0:
-            if not fetch_queue:
-                batch = self._fetch_directory_batch(remote, batch, fetch_queue, fetch_next_queue)
-
-            dir_digest = fetch_queue.pop(0)
-
-            objpath = self._ensure_blob(remote, dir_digest)
-
-            directory = remote_execution_pb2.Directory()
-            with open(objpath, "rb") as f:
-                directory.ParseFromString(f.read())
-
-            for dirnode in directory.directories:
-                batch = self._fetch_directory_node(
-                    remote, dirnode.digest, batch, fetch_queue, fetch_next_queue, recursive=True
-                )
-
-        # Fetch final batch
-        self._fetch_directory_batch(remote, batch, fetch_queue, fetch_next_queue)
+    # Raises:
+    #     BlobNotFound: If a blob is missing on the remote
+    #
+    def _fetch_trees(self, remote, dir_digests, *, blobs=(), without_files=(), on_batch=None):
+        remote.init()
 
-    def _fetch_tree(self, remote, digest):
-        objpath = self._ensure_blob(remote, digest)
+        file_batch = _CASBatchRead(remote, on_batch=on_batch, streaming=True)
+        queued = set()
 
-        tree = remote_execution_pb2.Tree()
+        def queue_blobs(digests):
+            for digest in digests:
+                if digest.hash not in queued:
+                    queued.add(digest.hash)
+                    file_batch.add(digest)
 
-        with open(objpath, "rb") as f:
-            tree.ParseFromString(f.read())
+        queue_blobs(self.local_missing_blobs(blobs))
 
-        tree.children.extend([tree.root])
-        for directory in tree.children:
-            dirbuffer = directory.SerializeToString()
-            dirdigest = self.add_object(buffer=dirbuffer)
-            assert dirdigest.size_bytes == len(dirbuffer)
+        # Pairs of directory digests and whether to fetch their files
+        level = [(digest, True) for digest in dir_digests] + [(digest, False) for digest in without_files]
+        level = list({(digest.hash, with_files): (digest, with_files) for digest, with_files in level}.values())
+        visited = {(digest.hash, with_files) for digest, with_files in level}
+        try:
+            while level:
+                # Fetch the directories of this level missing locally
+                dir_batch = _CASBatchRead(remote)
+                for dir_digest in {digest.hash: digest for digest, _ in level}.values():
+                    if not os.path.exists(self.objpath(dir_digest)):
+                        dir_batch.add(dir_digest)
+                dir_batch.send()
+
+                next_level = []
+                file_digests = []
+                for dir_digest, with_files in level:
+                    directory = remote_execution_pb2.Directory()
+                    with open(self.objpath(dir_digest), "rb") as f:
+                        directory.ParseFromString(f.read())
+
+                    if with_files:
+                        file_digests.extend(filenode.digest for filenode in directory.files)
+                    for dirnode in directory.directories:
+                        if (dirnode.digest.hash, with_files) not in visited:
+                            visited.add((dirnode.digest.hash, with_files))
+                            next_level.append((dirnode.digest, with_files))
+
+                queue_blobs(self.local_missing_blobs(file_digests))
+                level = next_level
+        except BaseException:
+            # Don't leave file blobs in flight
+            file_batch._cancel()
+            raise
 
-        return dirdigest
+        file_batch.send()
 
     # fetch_blobs():
     #
@@ -629,15 +882,17 @@ class CASCache:
     #    digests (list): The Digests of blobs to fetch
     #    allow_partial (bool): True to return missing blobs, False to raise a
     #                          BlobNotFound error if a blob is missing
+    #    on_batch (callable): Called with the number of blobs, bytes and seconds
+    #                         of each completed batch
     #
     # Returns: The Digests of the blobs that were not available on the remote CAS
     #
-    def fetch_blobs(self, remote, digests, *, allow_partial=False):
+    def fetch_blobs(self, remote, digests, *, allow_partial=False, on_batch=None):
         missing_blobs = [] if allow_partial else None
 
         remote.init()
 
-        batch = _CASBatchRead(remote)
+        batch = _CASBatchRead(remote, on_batch=on_batch)
 
         for digest in digests:
             if digest.hash:
@@ -654,22 +909,81 @@ class CASCache:
     # Args:
     #    remote (CASRemote): The remote repository to upload to
     #    digests (list): The Digests of Blobs to upload
+    #    on_batch (callable): Called with the number of blobs, bytes and seconds
+    #                         of each completed batch
     #
-    def send_blobs(self, remote, digests):
-        batch = _CASBatchUpdate(remote)
+    def send_blobs(self, remote, digests, *, on_batch=None):
+        batch = _CASBatchUpdate(remote, on_batch=on_batch)
 
         for digest in digests:
             batch.add(digest)
 
         batch.send()
 
-    def _send_directory(self, remote, digest):
-        required_blobs = self.required_blobs_for_directory(digest)
+    # _send_directory():
+    #
+    # Upload a directory tree to remote CAS.
+    #
+    # Subtrees which have already been uploaded to the remote in this
+    # session are not enumerated again.
+    #
+    # Args:
+    #    remote (CASRemote): The remote repository to upload to
+    #    digest (Digest): The Digest of the toplevel Directory object
+    #    on_batch (callable): Called with the number of blobs, bytes and seconds
+    #                         of each completed batch
+    #
+    # Returns:
+    #    (int, int): The number of blobs and bytes skipped as already present
+    #
+    def _send_directory(self, remote, digest, *, on_batch=None):
+        known_trees = self._remote_presence.load(remote)
+        required_blobs = {}
+        new_trees = []
+        skipped_blobs = 0
+        skipped_bytes = 0
+
+        # Returns the number of blobs and bytes in the tree
+        def add_tree(directory_digest):
+            nonlocal skipped_blobs, skipped_bytes
+
+            known = known_trees.get(directory_digest.hash)
+            if known:
+                skipped_blobs += known[0]
+                skipped_bytes += known[1]
+                return known
+
+            required_blobs[directory_digest.hash] = directory_digest
+            n_blobs = 1
+            n_bytes = directory_digest.size_bytes
+
+            directory = remote_execution_pb2.Directory()
+            with open(self.objpath(directory_digest), "rb") as f:
+                directory.ParseFromString(f.read())
+
+            for filenode in directory.files:
+                required_blobs[filenode.digest.hash] = filenode.digest
+                n_blobs += 1
+                n_bytes += filenode.digest.size_bytes
+
+            for dirnode in directory.directories:
+                subdir_blobs, subdir_bytes = add_tree(dirnode.digest)
+                n_blobs += subdir_blobs
+                n_bytes += subdir_bytes
+
+            new_trees.append((directory_digest.hash, n_blobs, n_bytes))
+            return n_blobs, n_bytes
+
+        add_tree(digest)
 
         # Upload any blobs missing on the server.
         # buildbox-casd will call FindMissingBlobs before the actual upload
         # and skip blobs that already exist on the server.
-        self.send_blobs(remote, required_blobs)
+        self.send_blobs(remote, required_blobs.values(), on_batch=on_batch)
+
+        self._remote_presence.add(remote, new_trees)
+
+        return skipped_blobs, skipped_bytes
 
     # get_cache_usage():
     #
@@ -680,6 +994,11 @@ class CASCache:
     #
     def get_cache_usage(self):
         assert not self._cache_usage_monitor_forbidden
+
+        if not self._cache_usage_monitor:
+            # buildbox-casd has not been started yet
+            return _CASCacheUsage(None, None)
+
         return self._cache_usage_monitor.get_cache_usage()
 
     # get_casd_process_manager()
@@ -690,7 +1009,7 @@ class CASCache:
     #   (subprocess.Process): The casd process that is used for the current cascache
     #
     def get_casd_process_manager(self):
-        assert self._casd_process_manager is not None, "Only call this with a running buildbox-casd process"
+        self.start_casd()
         return self._casd_process_manager
 
 
@@ -726,6 +1045,100 @@ class _CASCacheUsage:
             )
 
 
+# _RemotePresence
+#
+# Remembers the directory trees which have completely been uploaded to
+# remotes in the current session, so that trees shared by multiple
+# artifacts are only enumerated and checked by buildbox-casd once.
+#
+# The trees of each remote are appended as lines of
+# "<hash> <number of blobs> <number of bytes>" to a file in a session
+# directory, which allows the record to be shared between jobs.
+#
+# Args:
+#    basedir (str): The session directory to record trees in
+#
+class _RemotePresence:
+    def __init__(self, basedir):
+        self._basedir = basedir
+        self._trees = {}  # Known trees by remote file name
+        self._offsets = {}  # Offset of the unread records in each file
+
+    # load():
+    #
+    # Get the trees known to be present on a remote, including the
+    # trees recorded by other jobs.
+    #
+    # Args:
+    #    remote (CASRemote): The remote
+    #
+    # Returns:
+    #    (dict): The number of blobs and bytes of each tree, by directory hash
+    #
+    def load(self, remote):
+        name = self._name(remote)
+        trees = self._trees.setdefault(name, {})
+        offset = self._offsets.get(name, 0)
+
+        try:
+            with open(os.path.join(self._basedir, name), "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return trees
+
+        # Records are written with single appends, but only read
+        # up to the last complete line in case a write is in progress
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode().splitlines():
+            tree_hash, n_blobs, n_bytes = line.split()
+            trees[tree_hash] = (int(n_blobs), int(n_bytes))
+        self._offsets[name] = offset + end
+
+        return trees
+
+    # add():
+    #
+    # Record trees which have been uploaded to a remote.
+    #
+    # Args:
+    #    remote (CASRemote): The remote
+    #    trees (list): (hash, number of blobs, number of bytes) tuples
+    #
+    def add(self, remote, trees):
+        if not trees:
+            return
+
+        name = self._name(remote)
+        known_trees = self._trees.setdefault(name, {})
+        for tree_hash, n_blobs, n_bytes in trees:
+            known_trees[tree_hash] = (n_blobs, n_bytes)
+
+        data = "".join("{} {} {}\n".format(*tree) for tree in trees).encode()
+        try:
+            os.makedirs(self._basedir, exist_ok=True)
+            fd = os.open(os.path.join(self._basedir, name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except OSError:
+            # This is only an optimization, other jobs will simply
+            # upload the trees again.
+            pass
+
+    # release_resources():
+    #
+    # Remove the record at the end of the session.
+    #
+    def release_resources(self):
+        shutil.rmtree(self._basedir, ignore_errors=True)
+
+    def _name(self, remote):
+        remote_id = "{}\n{}".format(remote.spec.url, remote.spec.instance_name or "")
+        return hashlib.sha256(remote_id.encode()).hexdigest()
+
+
 # _CASCacheUsageMonitor
 #
 # This manages the subprocess that tracks cache usage information via
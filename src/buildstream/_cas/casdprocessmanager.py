@@ -17,12 +17,14 @@
 #
 
 import contextlib
+import hashlib
 import os
 import random
 import shutil
 import signal
 import stat
 import subprocess
+import sys
 import tempfile
 import time
 import psutil
@@ -46,18 +48,39 @@ _CASD_TIMEOUT = 300  # in seconds
 #
 # This manages the subprocess that runs buildbox-casd.
 #
+# When `shared` is set, a buildbox-casd process which is already running
+# for the same CAS repository is reused, and a newly started process is
+# left running for other sessions. Sessions using the shared process are
+# tracked in the repository, the process is terminated once it has not
+# been used by any session for `shared_idle_timeout` seconds. Note that
+# a reused process keeps the configuration of the session that started it.
+#
 # Args:
 #     path (str): The root directory for the CAS repository
 #     log_dir (str): The directory for the logs
 #     log_level (LogLevel): Log level to give to buildbox-casd for logging
 #     cache_quota (int): User configured cache quota
 #     protect_session_blobs (bool): Disable expiry for blobs used in the current session
+#     shared (bool): Whether to share the buildbox-casd process with other sessions
+#     shared_idle_timeout (int): Seconds to keep an unused shared process running
 #
 class CASDProcessManager:
-    def __init__(self, path, log_dir, log_level, cache_quota, protect_session_blobs):
+    def __init__(
+        self, path, log_dir, log_level, cache_quota, protect_session_blobs, *, shared=False, shared_idle_timeout=0
+    ):
         self._log_dir = log_dir
+        self._shared_dir = os.path.join(path, "shared-casd") if shared else None
+        self._shared_idle_timeout = shared_idle_timeout
+        self._shared_client = "{}-{}".format(os.getpid(), id(self))
+
+        self.process = None
+        self._pid = None
+        self._logfile = None
 
-        self._socket_path = self._make_socket_path(path)
+        if shared:
+            self._socket_path = self._make_shared_socket_path(path)
+        else:
+            self._socket_path = self._make_socket_path(path)
         self._connection_string = "unix:" + self._socket_path
 
         casd_args = [utils.get_host_tool("buildbox-casd")]
@@ -74,13 +97,98 @@ class CASDProcessManager:
         casd_args.append(path)
 
         self._start_time = time.time()
+
+        if not shared:
+            self._pid = self._start_process(casd_args, path)
+            return
+
+        os.makedirs(os.path.join(self._shared_dir, "clients"), exist_ok=True)
+        with _shared_lock(self._shared_dir):
+            self._pid = _read_shared_pid(self._shared_dir)
+            if self._pid is None:
+                # The socket of a process which died is left behind
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(self._socket_path)
+
+                # The shared process must outlive this session, it is not
+                # watched as a child process of this session.
+                self._pid = self._start_process(casd_args, path, detach=True)
+                # Record the start time as well to detect reuse of the pid
+                with open(os.path.join(self._shared_dir, "pid"), "w") as f:
+                    f.write("{} {}".format(self._pid, psutil.Process(self._pid).create_time()))
+
+            with open(os.path.join(self._shared_dir, "clients", self._shared_client), "w"):
+                pass
+
+    # _start_process()
+    #
+    # Start buildbox-casd, logging to a new logfile.
+    #
+    # Unless detached, the process is kept in `self.process`.
+    #
+    # Args:
+    #     casd_args (list): The buildbox-casd command line
+    #     path (str): The root directory for the CAS repository
+    #     detach (bool): Whether to detach the process from this session
+    #
+    # Returns:
+    #     (int): The pid of the buildbox-casd process
+    #
+    def _start_process(self, casd_args, path, *, detach=False):
         self._logfile = self._rotate_and_get_next_logfile()
 
         with open(self._logfile, "w") as logfile_fp:
             # Block SIGINT on buildbox-casd, we don't need to stop it
             # The frontend will take care of it if needed
             with _signals.blocked([signal.SIGINT], ignore=False):
+                if detach:
+                    return _spawn_detached(casd_args, cwd=path, stdout=logfile_fp, stderr=subprocess.STDOUT)
+
                 self.process = subprocess.Popen(casd_args, cwd=path, stdout=logfile_fp, stderr=subprocess.STDOUT)
+                return self.process.pid
+
+    # _make_shared_socket_path()
+    #
+    # Get the path to the socket of the shared CASD process, which only
+    # depends on the CAS repository so that other sessions can find it.
+    # Unlike the socket directory of a private CASD process, this directory
+    # is kept for later sessions.
+    #
+    # Args:
+    #     path (str): The root directory for the CAS repository.
+    #
+    # Returns:
+    #     (str) - The path to the CASD socket.
+    #
+    def _make_shared_socket_path(self, path):
+        path = os.path.realpath(path)
+        path_hash = hashlib.sha256(path.encode()).hexdigest()[:16]
+        self._socket_tempdir = os.path.join(
+            tempfile.gettempdir(), "buildstream-casd-{}-{}".format(os.getuid(), path_hash)
+        )
+
+        try:
+            os.mkdir(self._socket_tempdir)
+        except FileExistsError:
+            if os.lstat(self._socket_tempdir).st_uid != os.getuid():
+                raise CASCacheError(
+                    "Shared buildbox-casd directory is owned by another user: {}".format(self._socket_tempdir)
+                )
+        else:
+            # See _make_socket_path() for the permissions
+            os.chmod(
+                self._socket_tempdir,
+                stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH,
+            )
+
+        link = os.path.join(self._socket_tempdir, "cas")
+        if not os.path.islink(link) or os.readlink(link) != path:
+            # Replace the link atomically, other sessions may be using it
+            tmp_link = "{}.{}".format(link, os.getpid())
+            os.symlink(path, tmp_link)
+            os.replace(tmp_link, link)
+
+        return os.path.join(link, "casserver-shared.sock")
 
     # _make_socket_path()
     #
@@ -162,10 +270,35 @@ class CASDProcessManager:
     #
     # Terminate the process and release related resources.
     #
+    # A shared process is only terminated when no other session uses it
+    # and no idle timeout is configured, otherwise a detached process is
+    # started to terminate it once the idle timeout expires.
+    #
     def release_resources(self, messenger=None):
-        self._terminate(messenger)
-        self.process = None
-        shutil.rmtree(self._socket_tempdir)
+        if self._shared_dir is None:
+            self._terminate(messenger)
+            self.process = None
+            shutil.rmtree(self._socket_tempdir)
+            return
+
+        with _shared_lock(self._shared_dir):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(self._shared_dir, "clients", self._shared_client))
+
+            if _live_clients(self._shared_dir):
+                return
+
+            if self._shared_idle_timeout == 0:
+                _terminate_shared_process(self._shared_dir)
+                return
+
+            clients_mtime = os.stat(os.path.join(self._shared_dir, "clients")).st_mtime_ns
+            _spawn_detached(
+                [sys.executable, "-m", __name__, self._shared_dir, str(self._shared_idle_timeout), str(clients_mtime)],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
 
     # _terminate()
     #
@@ -225,7 +358,7 @@ class CASDProcessManager:
     # established until it is needed.
     #
     def create_channel(self):
-        return CASDChannel(self._socket_path, self._connection_string, self._start_time, self.process.pid)
+        return CASDChannel(self._socket_path, self._connection_string, self._start_time, self._pid)
 
 
 class CASDChannel:
@@ -332,3 +465,169 @@ class CASDChannel:
         self._bytestream = None
         self._casd_channel.close()
         self._casd_channel = None
+
+
+# _spawn_detached()
+#
+# Start a process in a new session which is not a child of this process.
+#
+# The process is started from an intermediate child which exits right
+# away, so that the process is reparented to init. It is then neither
+# left as a zombie should it exit while this process still runs, nor
+# does this process need to wait for it.
+#
+# Args:
+#     args (list): The command line
+#     kwargs: Further arguments for subprocess.Popen()
+#
+# Returns:
+#     (int): The pid of the process
+#
+# Raises:
+#     CASCacheError: If the process could not be started
+#
+def _spawn_detached(args, **kwargs):
+    read_fd, write_fd = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        # Never return to the caller in the intermediate child
+        try:
+            os.close(read_fd)
+            process = subprocess.Popen(args, start_new_session=True, **kwargs)
+            os.write(write_fd, str(process.pid).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    with open(read_fd, "rb") as f:
+        detached_pid = f.read()
+
+    if not detached_pid:
+        raise CASCacheError("Failed to start {}".format(args[0]))
+    return int(detached_pid)
+
+
+# _shared_lock()
+#
+# Context manager to hold the lock protecting the state of a shared
+# buildbox-casd process.
+#
+# Args:
+#     shared_dir (str): The directory holding the shared process state
+#
+@contextlib.contextmanager
+def _shared_lock(shared_dir):
+    # Only imported when sharing buildbox-casd, 'fcntl' is unavailable
+    # on Windows
+    import fcntl
+
+    with open(os.path.join(shared_dir, "lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# _read_shared_pid()
+#
+# Get the shared buildbox-casd process, if it is still running.
+#
+# Args:
+#     shared_dir (str): The directory holding the shared process state
+#
+# Returns:
+#     (int): The pid of the shared process, or None
+#
+def _read_shared_pid(shared_dir):
+    try:
+        with open(os.path.join(shared_dir, "pid")) as f:
+            pid, create_time = f.read().split()
+        proc = psutil.Process(int(pid))
+        if proc.status() != psutil.STATUS_ZOMBIE and proc.create_time() == float(create_time):
+            return proc.pid
+    except (FileNotFoundError, ValueError, psutil.Error):
+        pass
+
+    return None
+
+
+# _live_clients()
+#
+# Get the sessions using the shared buildbox-casd process, forgetting
+# about sessions which exited without releasing it.
+#
+# Args:
+#     shared_dir (str): The directory holding the shared process state
+#
+# Returns:
+#     (list): The names of the sessions, starting with their pid
+#
+def _live_clients(shared_dir):
+    clients_dir = os.path.join(shared_dir, "clients")
+
+    clients = []
+    for name in os.listdir(clients_dir):
+        pid, _ = name.split("-", 1)
+        if psutil.pid_exists(int(pid)):
+            clients.append(name)
+        else:
+            os.unlink(os.path.join(clients_dir, name))
+
+    return clients
+
+
+# _terminate_shared_process()
+#
+# Terminate the shared buildbox-casd process, if it is still running.
+#
+# Args:
+#     shared_dir (str): The directory holding the shared process state
+#
+def _terminate_shared_process(shared_dir):
+    pid = _read_shared_pid(shared_dir)
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(os.path.join(shared_dir, "pid"))
+
+    if pid is None:
+        return
+
+    try:
+        proc = psutil.Process(pid)
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except psutil.TimeoutExpired:
+            proc.kill()
+    except psutil.NoSuchProcess:
+        pass
+
+
+# _reap_shared_process()
+#
+# Terminate the shared buildbox-casd process after the idle timeout,
+# unless another session started using it in the meantime.
+#
+# Args:
+#     shared_dir (str): The directory holding the shared process state
+#     idle_timeout (int): Seconds to wait before terminating the process
+#     clients_mtime (int): Modification time of the clients directory when
+#                          the last session released the process
+#
+def _reap_shared_process(shared_dir, idle_timeout, clients_mtime):
+    time.sleep(idle_timeout)
+
+    with _shared_lock(shared_dir):
+        # Any session which used the process in the meantime takes care
+        # of terminating it when it is done.
+        if os.stat(os.path.join(shared_dir, "clients")).st_mtime_ns != clients_mtime:
+            return
+
+        if not _live_clients(shared_dir):
+            _terminate_shared_process(shared_dir)
+
+
+if __name__ == "__main__":
+    _reap_shared_process(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
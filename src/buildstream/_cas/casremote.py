@@ -15,13 +15,18 @@
 #  License along with this library. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
+import contextlib
+import time
+
 import grpc
 
 from .._protos.google.rpc import code_pb2
 from .._protos.build.buildgrid import local_cas_pb2
 
 from .._remote import BaseRemote
-from .._exceptions import CASRemoteError
+from .._exceptions import CASRemoteError, ImplError
+from .transfershaper import PULL, PUSH
 
 # The default limit for gRPC messages is 4 MiB.
 # Limit payload to 1 MiB to leave sufficient headroom for metadata.
@@ -32,6 +37,10 @@ _MAX_PAYLOAD_BYTES = 1024 * 1024
 # 80 bytes provide sufficient space for hash, size, and protobuf overhead.
 _MAX_DIGESTS = _MAX_PAYLOAD_BYTES / 80
 
+# The maximum total size of the blobs transferred by a single request,
+# so that the work is spread evenly across concurrent requests.
+_MAX_BATCH_BYTES = 64 * 1024 * 1024
+
 
 class BlobNotFound(CASRemoteError):
     def __init__(self, blob, msg):
@@ -41,7 +50,14 @@ class BlobNotFound(CASRemoteError):
 
 # Represents a single remote CAS cache.
 #
+# All communication with the remote goes through buildbox-casd, which
+# keeps its connections open for the whole session. The remote's
+# connection-config is not passed to buildbox-casd, which cannot receive
+# channel settings, and hence does not apply to these connections.
+#
 class CASRemote(BaseRemote):
+    requires_channel = False
+
     def __init__(self, spec, cascache, **kwargs):
         super().__init__(spec, **kwargs)
 
@@ -96,100 +112,221 @@ class CASRemote(BaseRemote):
         return self.cascache.add_object(buffer=message_buffer, instance_name=self.local_cas_instance_name)
 
 
-# Represents a batch of blobs queued for fetching.
+# Represents a batch of blobs queued for transfer by buildbox-casd.
+#
+# The blobs are split into requests limited by the number of digests
+# and by the total size of the blobs, and up to `max_in_flight`
+# requests are sent concurrently.
+#
+# A streaming batch sends each request as soon as it is full, so that
+# the transfer overlaps with adding further blobs. Errors of requests
+# completed while adding blobs are raised from add().
+#
+# Requests are subject to the bandwidth limits and priorities of the
+# TransferShaper of the CASCache.
 #
-class _CASBatchRead:
-    def __init__(self, remote):
+# Args:
+#    remote (CASRemote): The remote to transfer blobs from or to
+#    on_batch (callable): Called with the number of blobs, the number of
+#                         bytes and the duration in seconds of each
+#                         completed request
+#    max_in_flight (int): The maximum number of concurrent requests,
+#                         defaults to the setting of the CASCache
+#    streaming (bool): Whether to send full requests while adding blobs
+#
+class _CASBatch:
+    # The transfer direction, PULL or PUSH
+    _direction = None
+
+    def __init__(self, remote, *, on_batch=None, max_in_flight=None, streaming=False):
+        if max_in_flight is None:
+            max_in_flight = remote.cascache.batch_requests_in_flight
+
         self._remote = remote
+        self._on_batch = on_batch
+        self._max_in_flight = max(max_in_flight, 1)
+        self._streaming = streaming
         self._requests = []
         self._request = None
+        self._request_bytes = 0
+        self._in_flight = collections.deque()
         self._sent = False
+        self._shaper = remote.cascache.transfer_shaper
+        self._transfer = None
 
     def add(self, digest):
         assert not self._sent
 
-        if not self._request or len(self._request.blob_digests) >= _MAX_DIGESTS:
-            self._request = local_cas_pb2.FetchMissingBlobsRequest()
+        if (
+            not self._request
+            or len(self._request.blob_digests) >= _MAX_DIGESTS
+            or (self._request_bytes and self._request_bytes + digest.size_bytes > _MAX_BATCH_BYTES)
+        ):
+            if self._streaming and self._requests:
+                self._send_pending()
+
+            self._request = self._create_request()
             self._request.instance_name = self._remote.local_cas_instance_name
+            self._request_bytes = 0
             self._requests.append(self._request)
 
         request_digest = self._request.blob_digests.add()
         request_digest.CopyFrom(digest)
+        self._request_bytes += digest.size_bytes
 
-    def send(self, *, missing_blobs=None):
+    # _create_request():
+    #
+    # Returns:
+    #    (message): A new empty request
+    #
+    def _create_request(self):
+        raise ImplError("A _CASBatch implementation must create its requests.")
+
+    # _method():
+    #
+    # Returns:
+    #    (grpc.UnaryUnaryMultiCallable): The buildbox-casd method to send the requests with
+    #
+    def _method(self):
+        raise ImplError("A _CASBatch implementation must provide its method.")
+
+    # _handle_response():
+    #
+    # Check the response to a request, raising an error for failed blobs.
+    #
+    # Args:
+    #    batch_response (message): The response to handle
+    #
+    def _handle_response(self, batch_response):
+        raise ImplError("A _CASBatch implementation must handle its responses.")
+
+    # Send all remaining requests and handle all responses.
+    def _send_all(self):
         assert not self._sent
         self._sent = True
 
-        if not self._requests:
-            return
+        self._send_pending()
+        try:
+            while self._in_flight:
+                self._complete()
+        finally:
+            self._cancel()
+
+    # Send the queued requests, keeping up to `max_in_flight` requests
+    # in flight and handling the responses in the order of the requests.
+    def _send_pending(self):
+        try:
+            if self._requests and self._transfer is None:
+                self._transfer = contextlib.ExitStack()
+                self._transfer.enter_context(self._shaper.transferring(self._direction))
+
+            for request in self._requests:
+                if len(self._in_flight) >= self._max_in_flight:
+                    self._complete()
+
+                self._shaper.acquire(self._direction, sum(digest.size_bytes for digest in request.blob_digests))
+
+                times = [time.monotonic()]
+                future = self._method().future(request)
+                future.add_done_callback(lambda _, times=times: times.append(time.monotonic()))
+                self._in_flight.append((request, future, times))
+        except BaseException:
+            self._cancel()
+            raise
+        finally:
+            self._requests = []
 
-        local_cas = self._remote.cascache.get_local_cas()
+    def _complete(self):
+        request, future, times = self._in_flight.popleft()
+        self._handle_response(future.result())
+        if self._on_batch:
+            # The done callback may not have run yet
+            end = times[1] if len(times) > 1 else time.monotonic()
+            n_bytes = sum(digest.size_bytes for digest in request.blob_digests)
+            self._on_batch(len(request.blob_digests), n_bytes, end - times[0])
 
-        for request in self._requests:
-            batch_response = local_cas.FetchMissingBlobs(request)
+    def _cancel(self):
+        for _, future, _ in self._in_flight:
+            future.cancel()
+        self._in_flight.clear()
 
-            for response in batch_response.responses:
-                if response.status.code == code_pb2.NOT_FOUND:
-                    if missing_blobs is None:
-                        raise BlobNotFound(
-                            response.digest.hash,
-                            "Failed to download blob {}: {}".format(response.digest.hash, response.status.code),
-                        )
+        if self._transfer is not None:
+            self._transfer.close()
+            self._transfer = None
 
-                    missing_blobs.append(response.digest)
 
-                if response.status.code != code_pb2.OK:
-                    raise CASRemoteError(
-                        "Failed to download blob {}: {}".format(response.digest.hash, response.status.code)
+# Represents a batch of blobs queued for fetching.
+#
+class _CASBatchRead(_CASBatch):
+    _direction = PULL
+
+    def __init__(self, remote, **kwargs):
+        super().__init__(remote, **kwargs)
+        self._missing_blobs = None
+
+    # send():
+    #
+    # Args:
+    #    missing_blobs (list): A list to append the digests of blobs missing
+    #                          on the remote to, instead of raising BlobNotFound.
+    #                          Not supported for streaming batches.
+    #
+    def send(self, *, missing_blobs=None):
+        assert not (self._streaming and missing_blobs is not None)
+        self._missing_blobs = missing_blobs
+        self._send_all()
+
+    def _create_request(self):
+        return local_cas_pb2.FetchMissingBlobsRequest()
+
+    def _method(self):
+        return self._remote.cascache.get_local_cas().FetchMissingBlobs
+
+    def _handle_response(self, batch_response):
+        for response in batch_response.responses:
+            if response.status.code == code_pb2.NOT_FOUND:
+                if self._missing_blobs is None:
+                    raise BlobNotFound(
+                        response.digest.hash,
+                        "Failed to download blob {}: {}".format(response.digest.hash, response.status.code),
                     )
-                if response.digest.size_bytes != len(response.data):
-                    raise CASRemoteError(
-                        "Failed to download blob {}: expected {} bytes, received {} bytes".format(
-                            response.digest.hash, response.digest.size_bytes, len(response.data)
-                        )
+
+                self._missing_blobs.append(response.digest)
+
+            if response.status.code != code_pb2.OK:
+                raise CASRemoteError(
+                    "Failed to download blob {}: {}".format(response.digest.hash, response.status.code)
+                )
+            if response.digest.size_bytes != len(response.data):
+                raise CASRemoteError(
+                    "Failed to download blob {}: expected {} bytes, received {} bytes".format(
+                        response.digest.hash, response.digest.size_bytes, len(response.data)
                     )
+                )
 
 
 # Represents a batch of blobs queued for upload.
 #
-class _CASBatchUpdate:
-    def __init__(self, remote):
-        self._remote = remote
-        self._requests = []
-        self._request = None
-        self._sent = False
-
-    def add(self, digest):
-        assert not self._sent
-
-        if not self._request or len(self._request.blob_digests) >= _MAX_DIGESTS:
-            self._request = local_cas_pb2.UploadMissingBlobsRequest()
-            self._request.instance_name = self._remote.local_cas_instance_name
-            self._requests.append(self._request)
-
-        request_digest = self._request.blob_digests.add()
-        request_digest.CopyFrom(digest)
+class _CASBatchUpdate(_CASBatch):
+    _direction = PUSH
 
     def send(self):
-        assert not self._sent
-        self._sent = True
+        self._send_all()
 
-        if not self._requests:
-            return
+    def _create_request(self):
+        return local_cas_pb2.UploadMissingBlobsRequest()
 
-        local_cas = self._remote.cascache.get_local_cas()
+    def _method(self):
+        return self._remote.cascache.get_local_cas().UploadMissingBlobs
 
-        for request in self._requests:
-            batch_response = local_cas.UploadMissingBlobs(request)
+    def _handle_response(self, batch_response):
+        for response in batch_response.responses:
+            if response.status.code != code_pb2.OK:
+                if response.status.code == code_pb2.RESOURCE_EXHAUSTED:
+                    reason = "cache-too-full"
+                else:
+                    reason = None
 
-            for response in batch_response.responses:
-                if response.status.code != code_pb2.OK:
-                    if response.status.code == code_pb2.RESOURCE_EXHAUSTED:
-                        reason = "cache-too-full"
-                    else:
-                        reason = None
-
-                    raise CASRemoteError(
-                        "Failed to upload blob {}: {}".format(response.digest.hash, response.status.code),
-                        reason=reason,
-                    )
+                raise CASRemoteError(
+                    "Failed to upload blob {}: {}".format(response.digest.hash, response.status.code), reason=reason,
+                )
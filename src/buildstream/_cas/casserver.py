@@ -20,21 +20,28 @@
 
 from concurrent import futures
 from enum import Enum
+import asyncio
 import contextlib
+import itertools
 import logging
 import os
+import queue
 import signal
 import sys
+import threading
+import time
 
 import grpc
 import click
 
-from .._protos.build.bazel.remote.asset.v1 import remote_asset_pb2_grpc
+from .._protos.build.bazel.remote.asset.v1 import remote_asset_pb2, remote_asset_pb2_grpc
 from .._protos.build.bazel.remote.execution.v2 import (
     remote_execution_pb2,
     remote_execution_pb2_grpc,
 )
+from .._protos.build.buildgrid import local_cas_pb2
 from .._protos.google.bytestream import bytestream_pb2_grpc
+from .._protos.google.rpc import code_pb2
 from .._protos.buildstream.v2 import (
     buildstream_pb2,
     buildstream_pb2_grpc,
@@ -47,14 +54,59 @@ from .._protos.buildstream.v2 import (
 # Not enough that we'd like to duplicate code, but enough that we want
 # to make it very obvious what we're using, so in this case we import
 # the specific methods we'll be using.
-from ..utils import save_file_atomic, _remove_path_with_parents
+from .._remote import BaseRemote, RemoteSpec, RemoteType
 from .casdprocessmanager import CASDProcessManager
+from .refstorage import REF_STORAGE_BACKENDS, open_reference_storage
+from .servermetrics import ServerMetrics, create_async_interceptor, create_interceptor, start_http_server
 
 
 # The default limit for gRPC messages is 4 MiB.
 # Limit payload to 1 MiB to leave sufficient headroom for metadata.
 _MAX_PAYLOAD_BYTES = 1024 * 1024
 
+# Refs are expired in batches of this size
+_EXPIRY_BATCH_SIZE = 64
+
+# Fraction of the quota above which refs are expired
+_EXPIRY_USAGE_THRESHOLD = 0.8
+
+# Fraction of the quota to which refs are expired
+_EXPIRY_USAGE_TARGET = 0.6
+
+# Default seconds between checks of the disk usage for ref expiry,
+# expiry is disabled unless enabled explicitly
+_DEFAULT_REF_EXPIRY_INTERVAL = 0
+
+# Default seconds during which accessed refs are protected from expiry
+_DEFAULT_REF_GRACE_PERIOD = 3600
+
+# Maximum number of refs and assets queued for replication to each peer,
+# further updates are not replicated while the queue is full
+_MAX_REPLICATION_QUEUE = 10000
+
+# Number of attempts to replicate an update to a peer, and the seconds
+# to wait before the first retry, doubled for each further retry
+_REPLICATION_ATTEMPTS = 3
+_REPLICATION_RETRY_DELAY = 5
+
+# Requests sent by the replication carry this metadata, so that peers
+# replicating to each other don't send updates back and forth
+_REPLICATION_METADATA = ("bst-replication", "1")
+
+# Default maximum number of requests the asyncio server proxies to
+# buildbox-casd at the same time.
+_DEFAULT_MAX_CASD_REQUESTS = 256
+
+# The algorithms available to compress responses carrying blobs
+COMPRESSION_ALGORITHMS = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
+# Default minimum size in bytes of the blobs in a response to compress it
+_DEFAULT_COMPRESSION_THRESHOLD = 4096
+
 
 # LogLevel():
 #
@@ -95,53 +147,372 @@ class LogLevel(click.Choice):
 #     repo (str): Path to CAS repository
 #     enable_push (bool): Whether to allow blob uploads and artifact updates
 #     index_only (bool): Whether to store CAS blobs or only artifacts
+#     ref_storage (str): The backend to store artifact refs in, one of "files" or "sqlite"
+#     ref_expiry_interval (int): Seconds between checks for ref expiry, 0 to disable expiry
+#     ref_grace_period (int): Seconds during which accessed refs are protected from expiry
+#     upstream (RemoteSpec): An upstream server to fetch and store missing refs, assets and blobs from
+#     metrics_port (int): The port to serve metrics in the Prometheus text format on, or None
+#     replicate_to (list): RemoteSpecs of peer servers to replicate refs and assets accepted from clients to
+#     compression (str): The algorithm to compress responses carrying blobs with, one of COMPRESSION_ALGORITHMS
+#     compression_threshold (int): Minimum size in bytes of the blobs in a response to compress it
 #
 @contextlib.contextmanager
-def create_server(repo, *, enable_push, quota, index_only, log_level=LogLevel.Levels.WARNING):
-    logger = logging.getLogger("buildstream._cas.casserver")
-    logger.setLevel(LogLevel.get_logging_equivalent(log_level))
-    handler = logging.StreamHandler(sys.stderr)
-    handler.setFormatter(logging.Formatter(fmt="%(levelname)s: %(funcName)s: %(message)s"))
-    logger.addHandler(handler)
-
-    casd_manager = CASDProcessManager(
-        os.path.abspath(repo), os.path.join(os.path.abspath(repo), "logs"), log_level, quota, False
-    )
-    casd_channel = casd_manager.create_channel()
-
-    try:
-        root = os.path.abspath(repo)
+def create_server(
+    repo,
+    *,
+    enable_push,
+    quota,
+    index_only,
+    log_level=LogLevel.Levels.WARNING,
+    ref_storage="files",
+    ref_expiry_interval=_DEFAULT_REF_EXPIRY_INTERVAL,
+    ref_grace_period=_DEFAULT_REF_GRACE_PERIOD,
+    upstream=None,
+    metrics_port=None,
+    replicate_to=None,
+    compression="none",
+    compression_threshold=_DEFAULT_COMPRESSION_THRESHOLD
+):
+    with _server_components(
+        repo,
+        quota=quota,
+        index_only=index_only,
+        log_level=log_level,
+        ref_storage=ref_storage,
+        ref_expiry_interval=ref_expiry_interval,
+        ref_grace_period=ref_grace_period,
+        upstream=upstream,
+        metrics_port=metrics_port,
+        replicate_to=replicate_to,
+    ) as components:
+        casd_channel = components.casd_channel
+        upstream_remote = components.upstream
+        metrics = components.metrics
+        replicator = components.replicator
+
+        interceptors = [create_interceptor(metrics)] if metrics else []
 
         # Use max_workers default from Python 3.5+
         max_workers = (os.cpu_count() or 1) * 5
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers))
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers), interceptors=interceptors)
 
         if not index_only:
+            response_compression = _ResponseCompression(compression, compression_threshold)
+
             bytestream_pb2_grpc.add_ByteStreamServicer_to_server(
-                _ByteStreamServicer(casd_channel, enable_push=enable_push), server
+                _ByteStreamServicer(casd_channel, upstream_remote, response_compression, enable_push=enable_push),
+                server,
             )
 
             remote_execution_pb2_grpc.add_ContentAddressableStorageServicer_to_server(
-                _ContentAddressableStorageServicer(casd_channel, enable_push=enable_push), server
+                _ContentAddressableStorageServicer(
+                    casd_channel, upstream_remote, response_compression, enable_push=enable_push
+                ),
+                server,
             )
 
         remote_execution_pb2_grpc.add_CapabilitiesServicer_to_server(_CapabilitiesServicer(), server)
 
         # Remote Asset API
-        remote_asset_pb2_grpc.add_FetchServicer_to_server(_FetchServicer(casd_channel), server)
+        remote_asset_pb2_grpc.add_FetchServicer_to_server(
+            _FetchServicer(casd_channel, upstream_remote, metrics), server
+        )
         if enable_push:
-            remote_asset_pb2_grpc.add_PushServicer_to_server(_PushServicer(casd_channel), server)
+            remote_asset_pb2_grpc.add_PushServicer_to_server(_PushServicer(casd_channel, replicator), server)
 
         # BuildStream protocols
         buildstream_pb2_grpc.add_ReferenceStorageServicer_to_server(
-            _ReferenceStorageServicer(casd_channel, root, enable_push=enable_push), server
+            _ReferenceStorageServicer(
+                casd_channel, components.refs, upstream_remote, metrics, replicator, enable_push=enable_push
+            ),
+            server,
         )
 
         yield server
 
+
+# create_async_server():
+#
+# Create an asyncio based gRPC CAS artifact server, which serves the same
+# services as the server created by `create_server()`.
+#
+# Requests are proxied to buildbox-casd without blocking a thread each,
+# which allows serving many more concurrent clients. The server must be
+# run in the current event loop.
+#
+# Args:
+#     repo (str): Path to CAS repository
+#     enable_push (bool): Whether to allow blob uploads and artifact updates
+#     index_only (bool): Whether to store CAS blobs or only artifacts
+#     ref_storage (str): The backend to store artifact refs in, one of "files" or "sqlite"
+#     ref_expiry_interval (int): Seconds between checks for ref expiry, 0 to disable expiry
+#     ref_grace_period (int): Seconds during which accessed refs are protected from expiry
+#     upstream (RemoteSpec): An upstream server to fetch and store missing refs, assets and blobs from
+#     metrics_port (int): The port to serve metrics in the Prometheus text format on, or None
+#     replicate_to (list): RemoteSpecs of peer servers to replicate refs and assets accepted from clients to
+#     compression (str): The algorithm to compress responses carrying blobs with, one of COMPRESSION_ALGORITHMS
+#     compression_threshold (int): Minimum size in bytes of the blobs in a response to compress it
+#     max_concurrent_rpcs (int): Maximum number of RPCs handled at the same time,
+#                                further RPCs are rejected with RESOURCE_EXHAUSTED
+#     max_casd_requests (int): Maximum number of requests proxied to buildbox-casd
+#                              at the same time, further requests wait their turn
+#
+@contextlib.contextmanager
+def create_async_server(
+    repo,
+    *,
+    enable_push,
+    quota,
+    index_only,
+    log_level=LogLevel.Levels.WARNING,
+    ref_storage="files",
+    ref_expiry_interval=_DEFAULT_REF_EXPIRY_INTERVAL,
+    ref_grace_period=_DEFAULT_REF_GRACE_PERIOD,
+    upstream=None,
+    metrics_port=None,
+    replicate_to=None,
+    compression="none",
+    compression_threshold=_DEFAULT_COMPRESSION_THRESHOLD,
+    max_concurrent_rpcs=None,
+    max_casd_requests=_DEFAULT_MAX_CASD_REQUESTS
+):
+    if not _has_grpc_aio():
+        raise RuntimeError("The asyncio artifact server requires grpcio 1.32 or newer")
+    from grpc import aio  # pylint: disable=import-outside-toplevel
+
+    loop = asyncio.get_event_loop()
+
+    with _server_components(
+        repo,
+        quota=quota,
+        index_only=index_only,
+        log_level=log_level,
+        ref_storage=ref_storage,
+        ref_expiry_interval=ref_expiry_interval,
+        ref_grace_period=ref_grace_period,
+        upstream=upstream,
+        metrics_port=metrics_port,
+        replicate_to=replicate_to,
+    ) as components:
+        upstream_remote = components.upstream
+        metrics = components.metrics
+        replicator = components.replicator
+
+        async_casd_channel = _AsyncCASDChannel(aio.insecure_channel(components.casd_manager._connection_string))
+        try:
+            # Limits the requests in flight to buildbox-casd, waiting requests
+            # apply backpressure to the clients.
+            casd_limiter = asyncio.Semaphore(max_casd_requests)
+
+            interceptors = [create_async_interceptor(metrics)] if metrics else []
+
+            server = aio.server(interceptors=interceptors, maximum_concurrent_rpcs=max_concurrent_rpcs)
+
+            if not index_only:
+                response_compression = _ResponseCompression(compression, compression_threshold)
+
+                bytestream_pb2_grpc.add_ByteStreamServicer_to_server(
+                    _AsyncByteStreamServicer(
+                        async_casd_channel,
+                        casd_limiter,
+                        upstream_remote,
+                        response_compression,
+                        enable_push=enable_push,
+                    ),
+                    server,
+                )
+
+                remote_execution_pb2_grpc.add_ContentAddressableStorageServicer_to_server(
+                    _AsyncContentAddressableStorageServicer(
+                        async_casd_channel,
+                        casd_limiter,
+                        upstream_remote,
+                        response_compression,
+                        enable_push=enable_push,
+                    ),
+                    server,
+                )
+
+            remote_execution_pb2_grpc.add_CapabilitiesServicer_to_server(_AsyncCapabilitiesServicer(), server)
+
+            # Remote Asset API
+            remote_asset_pb2_grpc.add_FetchServicer_to_server(
+                _AsyncFetchServicer(async_casd_channel, casd_limiter, upstream_remote, metrics), server
+            )
+            if enable_push:
+                remote_asset_pb2_grpc.add_PushServicer_to_server(
+                    _AsyncPushServicer(async_casd_channel, casd_limiter, replicator), server
+                )
+
+            # BuildStream protocols
+            buildstream_pb2_grpc.add_ReferenceStorageServicer_to_server(
+                _AsyncReferenceStorageServicer(
+                    components.casd_channel,
+                    components.refs,
+                    upstream_remote,
+                    metrics,
+                    replicator,
+                    enable_push=enable_push,
+                ),
+                server,
+            )
+
+            yield server
+
+        finally:
+            loop.run_until_complete(async_casd_channel.close())
+
+
+# _ServerComponents
+#
+# The components shared by the services of an artifact server.
+#
+class _ServerComponents:
+    def __init__(self):
+        self.casd_manager = None  # The CASDProcessManager
+        self.casd_channel = None  # The CASDChannel to buildbox-casd
+        self.refs = None  # The reference storage
+        self.upstream = None  # The _UpstreamRemote, or None
+        self.replicator = None  # The _Replicator, or None
+        self.metrics = None  # The ServerMetrics, or None
+        self.expiry = None  # The _ReferenceExpiry, or None
+        self.metrics_server = None  # The metrics HTTP server, or None
+
+
+# _server_components():
+#
+# Start buildbox-casd and the components shared by the threaded and the
+# asyncio servers, and stop them again on exit.
+#
+# Args:
+#     See `create_server()`
+#
+# Yields:
+#     (_ServerComponents): The started components
+#
+@contextlib.contextmanager
+def _server_components(
+    repo,
+    *,
+    quota,
+    index_only,
+    log_level,
+    ref_storage,
+    ref_expiry_interval,
+    ref_grace_period,
+    upstream,
+    metrics_port,
+    replicate_to
+):
+    _setup_logging(log_level)
+
+    root = os.path.abspath(repo)
+    components = _ServerComponents()
+    components.casd_manager = CASDProcessManager(root, os.path.join(root, "logs"), log_level, quota, False)
+    components.casd_channel = components.casd_manager.create_channel()
+
+    try:
+        components.refs = open_reference_storage(root, ref_storage)
+
+        # Wait for buildbox-casd to become ready
+        components.casd_channel.get_cas()
+
+        if upstream:
+            components.upstream = _UpstreamRemote(upstream, components.casd_channel)
+            components.upstream.init()
+
+        if replicate_to:
+            components.replicator = _Replicator(components.casd_channel, replicate_to)
+            components.replicator.start()
+
+        components.expiry = _start_reference_expiry(
+            components.casd_channel,
+            components.refs,
+            quota=quota,
+            index_only=index_only,
+            interval=ref_expiry_interval,
+            grace_period=ref_grace_period,
+        )
+
+        if metrics_port:
+            components.metrics = ServerMetrics()
+            if components.expiry:
+                components.metrics.add_collector(components.expiry.collect_metrics)
+            if components.replicator:
+                components.metrics.add_collector(components.replicator.collect_metrics)
+            components.metrics_server = start_http_server(components.metrics, metrics_port)
+
+        yield components
+
     finally:
-        casd_channel.close()
-        casd_manager.release_resources()
+        if components.metrics_server:
+            components.metrics_server.shutdown()
+            components.metrics_server.server_close()
+        if components.expiry:
+            components.expiry.stop()
+        if components.replicator:
+            components.replicator.stop()
+        if components.refs:
+            components.refs.close()
+        if components.upstream:
+            components.upstream.close()
+        components.casd_channel.close()
+        components.casd_manager.release_resources()
+
+
+# _has_grpc_aio():
+#
+# Returns:
+#     (bool): Whether grpcio supports asyncio servers, i.e. is 1.32 or newer
+#
+def _has_grpc_aio():
+    try:
+        from grpc import aio  # pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        return False
+    return True
+
+
+# _start_reference_expiry():
+#
+# Start the expiry of refs, unless it is disabled.
+#
+# Expiry is disabled for index only servers, as the blobs referenced
+# by their refs are stored by another server.
+#
+# Args:
+#     casd (CASDChannel): The channel to buildbox-casd
+#     refs (FileReferenceStorage|SQLiteReferenceStorage): The reference storage
+#     quota (int): The quota of buildbox-casd in bytes, or None
+#     index_only (bool): Whether the server only stores artifacts
+#     interval (int): Seconds between checks, 0 to disable expiry
+#     grace_period (int): Seconds during which accessed refs are protected
+#
+# Returns:
+#     (_ReferenceExpiry): The started expiry task, or None if disabled
+#
+def _start_reference_expiry(casd, refs, *, quota, index_only, interval, grace_period):
+    if index_only or not interval:
+        return None
+
+    expiry = _ReferenceExpiry(casd, refs, quota=quota, interval=interval, grace_period=grace_period)
+    expiry.start()
+    return expiry
+
+
+# _setup_logging():
+#
+# Configure the logger of the artifact server.
+#
+# Args:
+#     log_level (LogLevel.Levels): The log level
+#
+def _setup_logging(log_level):
+    logger = logging.getLogger("buildstream._cas.casserver")
+    logger.setLevel(LogLevel.get_logging_equivalent(log_level))
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(fmt="%(levelname)s: %(funcName)s: %(message)s"))
+    logger.addHandler(handler)
 
 
 @click.command(short_help="CAS Artifact Server")
@@ -157,16 +528,173 @@ def create_server(repo, *, enable_push, quota, index_only, log_level=LogLevel.Le
     help='Only provide the BuildStream artifact and source services ("index"), not the CAS ("storage")',
 )
 @click.option("--log-level", type=LogLevel(), help="The log level to launch with", default="warning")
+@click.option(
+    "--ref-storage",
+    type=click.Choice(REF_STORAGE_BACKENDS),
+    default="files",
+    show_default=True,
+    help="Store artifact refs as separate files or in a single SQLite database",
+)
+@click.option(
+    "--ref-expiry-interval",
+    type=click.INT,
+    default=_DEFAULT_REF_EXPIRY_INTERVAL,
+    show_default=True,
+    help="Seconds between checks for expiring least recently used ReferenceStorage refs, "
+    "0 to disable. Remote Asset refs are never expired",
+)
+@click.option(
+    "--ref-grace-period",
+    type=click.INT,
+    default=_DEFAULT_REF_GRACE_PERIOD,
+    show_default=True,
+    help="Seconds during which pushed or accessed refs are never expired",
+)
+@click.option("--upstream", help="URL of an upstream server to fetch missing artifacts and blobs from")
+@click.option("--upstream-instance-name", help="Instance name of the upstream server")
+@click.option("--upstream-server-cert", help="Public upstream server certificate for TLS (PEM-encoded)")
+@click.option("--upstream-client-key", help="Private client key for TLS with the upstream server (PEM-encoded)")
+@click.option(
+    "--upstream-client-cert", help="Public client certificate for TLS with the upstream server (PEM-encoded)"
+)
+@click.option("--metrics-port", type=click.INT, help="Port number to serve metrics in the Prometheus text format on")
+@click.option(
+    "--replicate-to",
+    multiple=True,
+    help="URL of a peer server to replicate refs and assets pushed by clients to, may be specified multiple times",
+)
+@click.option("--replication-server-cert", help="Public peer server certificate for TLS (PEM-encoded)")
+@click.option("--replication-client-key", help="Private client key for TLS with peer servers (PEM-encoded)")
+@click.option("--replication-client-cert", help="Public client certificate for TLS with peer servers (PEM-encoded)")
+@click.option(
+    "--compression",
+    type=click.Choice(list(COMPRESSION_ALGORITHMS)),
+    default="none",
+    show_default=True,
+    help="Compress responses carrying blobs with this algorithm, if the client accepts it. "
+    "Only downloads are compressed, blobs pushed by clients are not",
+)
+@click.option(
+    "--compression-threshold",
+    type=click.INT,
+    default=_DEFAULT_COMPRESSION_THRESHOLD,
+    show_default=True,
+    help="Minimum size in bytes of the blobs in a response to compress it",
+)
+@click.option(
+    "--asyncio",
+    "use_asyncio",
+    is_flag=True,
+    help="Serve requests with asyncio instead of a thread pool (grpcio >= 1.32)",
+)
+@click.option(
+    "--max-concurrent-rpcs",
+    type=click.INT,
+    default=None,
+    help="Maximum number of concurrent RPCs, further RPCs are rejected (asyncio only)",
+)
+@click.option(
+    "--max-casd-requests",
+    type=click.INT,
+    default=_DEFAULT_MAX_CASD_REQUESTS,
+    show_default=True,
+    help="Maximum number of concurrent requests to buildbox-casd, further requests wait (asyncio only)",
+)
 @click.argument("repo")
-def server_main(repo, port, server_key, server_cert, client_certs, enable_push, quota, index_only, log_level):
+def server_main(
+    repo,
+    port,
+    server_key,
+    server_cert,
+    client_certs,
+    enable_push,
+    quota,
+    index_only,
+    log_level,
+    ref_storage,
+    ref_expiry_interval,
+    ref_grace_period,
+    upstream,
+    upstream_instance_name,
+    upstream_server_cert,
+    upstream_client_key,
+    upstream_client_cert,
+    metrics_port,
+    replicate_to,
+    replication_server_cert,
+    replication_client_key,
+    replication_client_cert,
+    compression,
+    compression_threshold,
+    use_asyncio,
+    max_concurrent_rpcs,
+    max_casd_requests,
+):
     # Handle SIGTERM by calling sys.exit(0), which will raise a SystemExit exception,
     # properly executing cleanup code in `finally` clauses and context managers.
     # This is required to terminate buildbox-casd on SIGTERM.
     signal.signal(signal.SIGTERM, lambda signalnum, frame: sys.exit(0))
 
-    with create_server(
-        repo, quota=quota, enable_push=enable_push, index_only=index_only, log_level=log_level
-    ) as server:
+    if upstream:
+        upstream = RemoteSpec(
+            upstream,
+            False,
+            upstream_server_cert,
+            upstream_client_key,
+            upstream_client_cert,
+            upstream_instance_name,
+            RemoteType.ALL,
+        )
+
+    replicate_to = [
+        RemoteSpec(
+            url, True, replication_server_cert, replication_client_key, replication_client_cert, None, RemoteType.ALL,
+        )
+        for url in replicate_to
+    ]
+
+    if use_asyncio and not _has_grpc_aio():
+        click.echo("ERROR: --asyncio requires grpcio 1.32 or newer", err=True)
+        sys.exit(-1)
+
+    if use_asyncio:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server_context = create_async_server(
+            repo,
+            quota=quota,
+            enable_push=enable_push,
+            index_only=index_only,
+            log_level=log_level,
+            ref_storage=ref_storage,
+            ref_expiry_interval=ref_expiry_interval,
+            ref_grace_period=ref_grace_period,
+            upstream=upstream,
+            metrics_port=metrics_port,
+            replicate_to=replicate_to,
+            compression=compression,
+            compression_threshold=compression_threshold,
+            max_concurrent_rpcs=max_concurrent_rpcs,
+            max_casd_requests=max_casd_requests,
+        )
+    else:
+        server_context = create_server(
+            repo,
+            quota=quota,
+            enable_push=enable_push,
+            index_only=index_only,
+            log_level=log_level,
+            ref_storage=ref_storage,
+            ref_expiry_interval=ref_expiry_interval,
+            ref_grace_period=ref_grace_period,
+            upstream=upstream,
+            metrics_port=metrics_port,
+            replicate_to=replicate_to,
+            compression=compression,
+            compression_threshold=compression_threshold,
+        )
+
+    with server_context as server:
 
         use_tls = bool(server_key)
 
@@ -201,23 +729,37 @@ def server_main(repo, port, server_key, server_cert, client_certs, enable_push,
             server.add_insecure_port("[::]:{}".format(port))
 
         # Run artifact server
-        server.start()
-        try:
-            while True:
-                signal.pause()
-        finally:
-            server.stop(0)
+        if use_asyncio:
+            loop.run_until_complete(server.start())
+            try:
+                loop.run_until_complete(server.wait_for_termination())
+            finally:
+                loop.run_until_complete(server.stop(0))
+        else:
+            server.start()
+            try:
+                while True:
+                    signal.pause()
+            finally:
+                server.stop(0)
 
 
 class _ByteStreamServicer(bytestream_pb2_grpc.ByteStreamServicer):
-    def __init__(self, casd, *, enable_push):
+    def __init__(self, casd, upstream, compression, *, enable_push):
         super().__init__()
         self.bytestream = casd.get_bytestream()
+        self.upstream = upstream
+        self.compression = compression
         self.enable_push = enable_push
         self.logger = logging.getLogger("buildstream._cas.casserver")
 
     def Read(self, request, context):
         self.logger.debug("Reading %s", request.resource_name)
+        digest = _parse_resource_name(request.resource_name)
+        if digest:
+            if self.upstream:
+                self.upstream.fetch_missing_blobs([digest])
+            self.compression.apply(context, digest.size_bytes)
         try:
             return self.bytestream.Read(request)
         except grpc.RpcError as err:
@@ -234,9 +776,11 @@ class _ByteStreamServicer(bytestream_pb2_grpc.ByteStreamServicer):
 
 
 class _ContentAddressableStorageServicer(remote_execution_pb2_grpc.ContentAddressableStorageServicer):
-    def __init__(self, casd, *, enable_push):
+    def __init__(self, casd, upstream, compression, *, enable_push):
         super().__init__()
         self.cas = casd.get_cas()
+        self.upstream = upstream
+        self.compression = compression
         self.enable_push = enable_push
         self.logger = logging.getLogger("buildstream._cas.casserver")
 
@@ -249,6 +793,9 @@ class _ContentAddressableStorageServicer(remote_execution_pb2_grpc.ContentAddres
 
     def BatchReadBlobs(self, request, context):
         self.logger.info("Reading '%s'", request.digests)
+        if self.upstream:
+            self.upstream.fetch_missing_blobs(request.digests)
+        self.compression.apply(context, sum(digest.size_bytes for digest in request.digests))
         try:
             return self.cas.BatchReadBlobs(request)
         except grpc.RpcError as err:
@@ -284,117 +831,122 @@ class _CapabilitiesServicer(remote_execution_pb2_grpc.CapabilitiesServicer):
 
 
 class _FetchServicer(remote_asset_pb2_grpc.FetchServicer):
-    def __init__(self, casd):
+    def __init__(self, casd, upstream, metrics):
         super().__init__()
         self.fetch = casd.get_asset_fetch()
+        self.upstream = upstream
+        self.metrics = metrics
         self.logger = logging.getLogger("buildstream._cas.casserver")
 
     def FetchBlob(self, request, context):
         self.logger.debug("FetchBlob '%s'", request.uris)
-        try:
-            return self.fetch.FetchBlob(request)
-        except grpc.RpcError as err:
-            context.abort(err.code(), err.details())
+        upstream_method = self.upstream.fetch_blob if self.upstream else None
+        return self._fetch_through(self.fetch.FetchBlob, upstream_method, request, context)
 
     def FetchDirectory(self, request, context):
         self.logger.debug("FetchDirectory '%s'", request.uris)
+        upstream_method = self.upstream.fetch_directory if self.upstream else None
+        return self._fetch_through(self.fetch.FetchDirectory, upstream_method, request, context)
+
+    # Fetch an asset from buildbox-casd, falling back to the upstream server
+    def _fetch_through(self, method, upstream_method, request, context):
         try:
-            return self.fetch.FetchDirectory(request)
+            response = method(request)
         except grpc.RpcError as err:
-            context.abort(err.code(), err.details())
+            if err.code() != grpc.StatusCode.NOT_FOUND:
+                context.abort(err.code(), err.details())
+            response = None
+
+        if not _is_asset_miss(response):
+            _count_lookup(self.metrics, "Fetch", "hit")
+            return response
+
+        if upstream_method:
+            upstream_response = upstream_method(request)
+            if upstream_response is not None:
+                _count_lookup(self.metrics, "Fetch", "upstream")
+                return upstream_response
+
+        _count_lookup(self.metrics, "Fetch", "miss")
+        if response is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, "Asset not found")
+        return response
 
 
 class _PushServicer(remote_asset_pb2_grpc.PushServicer):
-    def __init__(self, casd):
+    def __init__(self, casd, replicator):
         super().__init__()
         self.push = casd.get_asset_push()
+        self.replicator = replicator
         self.logger = logging.getLogger("buildstream._cas.casserver")
 
     def PushBlob(self, request, context):
         self.logger.debug("PushBlob '%s'", request.uris)
         try:
-            return self.push.PushBlob(request)
+            response = self.push.PushBlob(request)
         except grpc.RpcError as err:
             context.abort(err.code(), err.details())
 
+        if self.replicator and not _is_replicated(context):
+            self.replicator.replicate_asset(request)
+        return response
+
     def PushDirectory(self, request, context):
         self.logger.debug("PushDirectory '%s'", request.uris)
         try:
-            return self.push.PushDirectory(request)
+            response = self.push.PushDirectory(request)
         except grpc.RpcError as err:
             context.abort(err.code(), err.details())
 
+        if self.replicator and not _is_replicated(context):
+            self.replicator.replicate_asset(request)
+        return response
+
 
 class _ReferenceStorageServicer(buildstream_pb2_grpc.ReferenceStorageServicer):
-    def __init__(self, casd, cas_root, *, enable_push):
+    def __init__(self, casd, refs, upstream, metrics, replicator, *, enable_push):
         super().__init__()
         self.cas = casd.get_cas()
-        self.root = cas_root
+        self.refs = refs
+        self.upstream = upstream
+        self.metrics = metrics
+        self.replicator = replicator
         self.enable_push = enable_push
         self.logger = logging.getLogger("buildstream._cas.casserver")
-        self.tmpdir = os.path.join(self.root, "tmp")
-        self.casdir = os.path.join(self.root, "cas")
-        self.refdir = os.path.join(self.casdir, "refs", "heads")
-        os.makedirs(self.tmpdir, exist_ok=True)
-
-    # ref_path():
-    #
-    # Get the path to a digest's file.
-    #
-    # Args:
-    #     ref - The ref of the digest.
-    #
-    # Returns:
-    #     str - The path to the digest's file.
-    #
-    def ref_path(self, ref: str) -> str:
-        return os.path.join(self.refdir, ref)
-
-    # set_ref():
-    #
-    # Create or update a ref with a new digest.
-    #
-    # Args:
-    #     ref - The ref of the digest.
-    #     tree - The digest to write.
-    #
-    def set_ref(self, ref: str, tree):
-        ref_path = self.ref_path(ref)
-
-        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
-        with save_file_atomic(ref_path, "wb", tempdir=self.tmpdir) as f:
-            f.write(tree.SerializeToString())
 
     # resolve_ref():
     #
-    # Resolve a ref to a digest.
+    # Resolve a ref to a digest, fetching and storing it from the
+    # upstream server if it is missing.
     #
     # Args:
-    #     ref (str): The name of the ref
+    #     key (str): The name of the ref
     #
     # Returns:
-    #     (Digest): The digest stored in the ref
+    #     (Digest): The digest stored in the ref, or None if it doesn't exist
     #
-    def resolve_ref(self, ref):
-        ref_path = self.ref_path(ref)
+    def resolve_ref(self, key):
+        digest = self.refs.get(key)
+        if digest is not None:
+            _count_lookup(self.metrics, "ReferenceStorage", "hit")
+            return digest
 
-        with open(ref_path, "rb") as f:
-            os.utime(ref_path)
+        if self.upstream:
+            digest = self.upstream.get_reference(key)
+            if digest is not None:
+                self.refs.set([key], digest)
+                _count_lookup(self.metrics, "ReferenceStorage", "upstream")
+                return digest
 
-            digest = remote_execution_pb2.Digest()
-            digest.ParseFromString(f.read())
-            return digest
+        _count_lookup(self.metrics, "ReferenceStorage", "miss")
+        return None
 
     def GetReference(self, request, context):
         self.logger.debug("'%s'", request.key)
         response = buildstream_pb2.GetReferenceResponse()
 
-        try:
-            digest = self.resolve_ref(request.key)
-        except FileNotFoundError:
-            with contextlib.suppress(FileNotFoundError):
-                _remove_path_with_parents(self.refdir, request.key)
-
+        digest = self.resolve_ref(request.key)
+        if digest is None:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             return response
 
@@ -411,8 +963,10 @@ class _ReferenceStorageServicer(buildstream_pb2_grpc.ReferenceStorageServicer):
             context.set_code(grpc.StatusCode.PERMISSION_DENIED)
             return response
 
-        for key in request.keys:
-            self.set_ref(key, request.digest)
+        self.refs.set(request.keys, request.digest)
+
+        if self.replicator and not _is_replicated(context):
+            self.replicator.replicate_reference(request.keys, request.digest)
 
         return response
 
@@ -423,3 +977,887 @@ class _ReferenceStorageServicer(buildstream_pb2_grpc.ReferenceStorageServicer):
         response.allow_updates = self.enable_push
 
         return response
+
+
+# _ReferenceExpiry
+#
+# Background task which expires least recently used refs.
+#
+# buildbox-casd evicts the least recently used blobs to stay within the
+# quota, but refs don't keep blobs alive, so refs whose blobs were
+# evicted would be left dangling.
+#
+# While the disk usage is close to the quota, this task removes the
+# least recently used refs outside the grace period, until the size of
+# their trees brings the usage below a lower target. Their blobs are
+# then the least recently used ones in casd, which evicts them before
+# the blobs of the refs which are kept.
+#
+# Only refs of the ReferenceStorage service are expired. The Remote Asset
+# refs which BuildStream stores artifacts and sources as are kept by
+# buildbox-casd, which offers no way to list or expire them.
+#
+# Only the refs to be removed are looked at: the refs which are kept are
+# not accessed in casd, so that their order in casd is not disturbed.
+# As casd only evicts blobs once it reaches its quota, the size of the
+# expired trees is remembered until the usage decreases.
+#
+# Args:
+#     casd (CASDChannel): The channel to buildbox-casd
+#     refs (FileReferenceStorage|SQLiteReferenceStorage): The reference storage
+#     quota (int): The quota of buildbox-casd in bytes, or None
+#     interval (int): Seconds between checks of the disk usage
+#     grace_period (int): Seconds during which accessed refs are protected
+#
+class _ReferenceExpiry:
+    def __init__(self, casd, refs, *, quota, interval, grace_period):
+        self._cas = casd.get_cas()
+        self._local_cas = casd.get_local_cas()
+        self._refs = refs
+        self._quota = quota
+        self._interval = interval
+        self._grace_period = grace_period
+        self._last_usage = None
+        self._pending_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ref-expiry", daemon=True)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "scans": 0,
+            "refs_expired": 0,
+            "bytes_expired": 0,
+            "last_scan_seconds": 0.0,
+            "disk_usage_bytes": 0,
+        }
+        self.logger = logging.getLogger("buildstream._cas.casserver")
+
+    # start():
+    #
+    # Start the background task.
+    #
+    def start(self):
+        self._thread.start()
+
+    # stop():
+    #
+    # Stop the background task and wait for it to finish.
+    #
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    # get_stats():
+    #
+    # Returns:
+    #     (dict): The cumulative expiry statistics
+    #
+    def get_stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    # collect_metrics():
+    #
+    # Returns:
+    #     (list): The expiry statistics as ServerMetrics collector tuples
+    #
+    def collect_metrics(self):
+        stats = self.get_stats()
+        return [
+            ("ref_expiry_scans_total", "counter", "Number of ref expiry scans.", stats["scans"]),
+            ("ref_expiry_expired_total", "counter", "Number of expired refs.", stats["refs_expired"]),
+            (
+                "ref_expiry_expired_bytes_total",
+                "counter",
+                "Estimated size of the trees of expired refs.",
+                stats["bytes_expired"],
+            ),
+            (
+                "ref_expiry_last_scan_seconds",
+                "gauge",
+                "Duration of the last ref expiry scan.",
+                stats["last_scan_seconds"],
+            ),
+            ("disk_usage_bytes", "gauge", "Disk usage of buildbox-casd.", stats["disk_usage_bytes"]),
+        ]
+
+    # check():
+    #
+    # Check the disk usage and expire refs if required.
+    #
+    # Refs are expired while the usage is above a fraction of the quota,
+    # not counting the trees of refs expired before which casd did not
+    # evict yet.
+    #
+    def check(self):
+        usage = self._local_cas.GetLocalDiskUsage(local_cas_pb2.GetLocalDiskUsageRequest()).size_bytes
+        if self._last_usage is not None and usage < self._last_usage:
+            # casd evicted blobs
+            self._pending_bytes = max(self._pending_bytes - (self._last_usage - usage), 0)
+        self._last_usage = usage
+
+        with self._stats_lock:
+            self._stats["disk_usage_bytes"] = usage
+
+        if self._quota is not None and usage - self._pending_bytes >= self._quota * _EXPIRY_USAGE_THRESHOLD:
+            self.expire(usage - self._pending_bytes)
+
+    # expire():
+    #
+    # Remove the least recently used refs outside the grace period until
+    # the size of their trees brings the usage below the target.
+    #
+    # Args:
+    #     usage (int): The current disk usage in bytes
+    #
+    # Returns:
+    #     (int): The number of expired refs
+    #
+    def expire(self, usage):
+        start = time.monotonic()
+        cutoff = time.time() - self._grace_period
+        excess = usage - self._quota * _EXPIRY_USAGE_TARGET
+        seen = set()
+
+        expired = 0
+        freed = 0
+        keys = []
+        for key, digest, _ in self._refs.list_lru(accessed_before=cutoff):
+            if freed >= excess or self._stop.is_set():
+                break
+
+            keys.append(key)
+            freed += self._tree_size(digest, seen)
+            if len(keys) >= _EXPIRY_BATCH_SIZE:
+                expired += self._remove(keys, cutoff)
+                keys = []
+
+        expired += self._remove(keys, cutoff)
+        self._pending_bytes += freed
+
+        elapsed = time.monotonic() - start
+        with self._stats_lock:
+            self._stats["scans"] += 1
+            self._stats["refs_expired"] += expired
+            self._stats["bytes_expired"] += freed
+            self._stats["last_scan_seconds"] = elapsed
+
+        self.logger.info("Expired %d refs with %d bytes in %.1fs", expired, freed, elapsed)
+        return expired
+
+    # Remove expired refs, returns the number of removed refs
+    def _remove(self, keys, cutoff):
+        # Refs accessed since they were listed are kept
+        if not keys:
+            return 0
+        return self._refs.remove(keys, accessed_before=cutoff)
+
+    # Get the size of the blobs reachable from a digest. Blobs in `seen`
+    # are not counted again, and are added to it.
+    #
+    # Refs may point to directories or plain blobs. GetTree() only reads
+    # the directories, the file blobs are not accessed in casd. Digests
+    # missing in casd have a size of 0, refs to them are dangling.
+    #
+    def _tree_size(self, digest, seen):
+        try:
+            directories = [
+                directory
+                for response in self._cas.GetTree(remote_execution_pb2.GetTreeRequest(root_digest=digest))
+                for directory in response.directories
+            ]
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.NOT_FOUND:
+                return 0
+            # Not a directory
+            directories = []
+
+        digests = [digest]
+        for directory in directories:
+            digests.extend(node.digest for node in itertools.chain(directory.files, directory.directories))
+
+        size = 0
+        for blob_digest in digests:
+            if blob_digest.hash not in seen:
+                size += blob_digest.size_bytes
+                seen.add(blob_digest.hash)
+        return size
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.check()
+            except grpc.RpcError as e:
+                self.logger.warning("Failed to expire refs: %s", e.details())
+
+
+# _ServerRemote
+#
+# Another artifact server. Blobs are transferred between the local
+# buildbox-casd and the server through buildbox-casd, the same way
+# clients pull and push.
+#
+# Args:
+#     spec (RemoteSpec): The server
+#     casd (CASDChannel): The channel to buildbox-casd
+#
+class _ServerRemote(BaseRemote):
+    def __init__(self, spec, casd):
+        super().__init__(spec)
+        self.cas = casd.get_cas()
+        self.local_cas = casd.get_local_cas()
+        self.local_push = casd.get_asset_push()
+        self.local_cas_instance_name = None
+        self.ref_storage = None
+        self.fetch = None
+        self.push = None
+        self.logger = logging.getLogger("buildstream._cas.casserver")
+
+    def _configure_protocols(self):
+        self.ref_storage = buildstream_pb2_grpc.ReferenceStorageStub(self.channel)
+        self.fetch = remote_asset_pb2_grpc.FetchStub(self.channel)
+        self.push = remote_asset_pb2_grpc.PushStub(self.channel)
+
+        request = local_cas_pb2.GetInstanceNameForRemotesRequest()
+        cas_endpoint = request.content_addressable_storage
+        cas_endpoint.url = self.spec.url
+        if self.spec.instance_name:
+            cas_endpoint.instance_name = self.spec.instance_name
+        if self.server_cert:
+            cas_endpoint.server_cert = self.server_cert
+        if self.client_key:
+            cas_endpoint.client_key = self.client_key
+        if self.client_cert:
+            cas_endpoint.client_cert = self.client_cert
+        self.local_cas_instance_name = self.local_cas.GetInstanceNameForRemotes(request).instance_name
+
+
+# _UpstreamRemote
+#
+# An upstream server to fetch refs, assets and blobs from which are
+# missing locally. Everything fetched is stored in the local
+# buildbox-casd, so that it is served locally on subsequent requests.
+#
+class _UpstreamRemote(_ServerRemote):
+
+    # fetch_missing_blobs():
+    #
+    # Fetch the blobs which are missing locally from the upstream server.
+    # Blobs missing upstream as well are ignored, they will be reported
+    # as missing when they are read.
+    #
+    # Args:
+    #     digests (list): The Digests of the blobs
+    #
+    def fetch_missing_blobs(self, digests):
+        request = remote_execution_pb2.FindMissingBlobsRequest()
+        request.blob_digests.extend(digests)
+        missing = self.cas.FindMissingBlobs(request).missing_blob_digests
+        if not missing:
+            return
+
+        request = local_cas_pb2.FetchMissingBlobsRequest(instance_name=self.local_cas_instance_name)
+        request.blob_digests.extend(missing)
+        try:
+            self.local_cas.FetchMissingBlobs(request)
+        except grpc.RpcError as e:
+            self.logger.warning("Failed to fetch blobs from upstream: %s", e.details())
+
+    # get_reference():
+    #
+    # Resolve a ref on the upstream server.
+    #
+    # Args:
+    #     key (str): The name of the ref
+    #
+    # Returns:
+    #     (Digest): The digest stored in the ref, or None if it doesn't exist
+    #
+    def get_reference(self, key):
+        request = buildstream_pb2.GetReferenceRequest(key=key)
+        if self.instance_name:
+            request.instance_name = self.instance_name
+        try:
+            return self.ref_storage.GetReference(request).digest
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.NOT_FOUND:
+                self.logger.warning("Failed to get reference from upstream: %s", e.details())
+            return None
+
+    # fetch_blob():
+    #
+    # Fetch a blob asset from the upstream server and store it locally.
+    #
+    # Args:
+    #     request (FetchBlobRequest): The request received from the client
+    #
+    # Returns:
+    #     (FetchBlobResponse): The upstream response, or None if the asset is missing
+    #
+    def fetch_blob(self, request):
+        response = self._fetch_asset(self.fetch.FetchBlob, request)
+        if response is None:
+            return None
+
+        self.fetch_missing_blobs([response.blob_digest])
+
+        push_request = remote_asset_pb2.PushBlobRequest(uris=request.uris, qualifiers=response.qualifiers)
+        push_request.blob_digest.CopyFrom(response.blob_digest)
+        self._store_asset(self.local_push.PushBlob, push_request)
+        return response
+
+    # fetch_directory():
+    #
+    # Fetch a directory asset from the upstream server and store it
+    # locally. Only the directories are fetched right away, the files
+    # are fetched when they are read.
+    #
+    # Args:
+    #     request (FetchDirectoryRequest): The request received from the client
+    #
+    # Returns:
+    #     (FetchDirectoryResponse): The upstream response, or None if the asset is missing
+    #
+    def fetch_directory(self, request):
+        response = self._fetch_asset(self.fetch.FetchDirectory, request)
+        if response is None:
+            return None
+
+        tree_request = local_cas_pb2.FetchTreeRequest(
+            instance_name=self.local_cas_instance_name, fetch_file_blobs=False
+        )
+        tree_request.root_digest.CopyFrom(response.root_directory_digest)
+        try:
+            self.local_cas.FetchTree(tree_request)
+        except grpc.RpcError as e:
+            self.logger.warning("Failed to fetch directory from upstream: %s", e.details())
+            return response
+
+        push_request = remote_asset_pb2.PushDirectoryRequest(uris=request.uris, qualifiers=response.qualifiers)
+        push_request.root_directory_digest.CopyFrom(response.root_directory_digest)
+        self._store_asset(self.local_push.PushDirectory, push_request)
+        return response
+
+    def _fetch_asset(self, method, request):
+        upstream_request = type(request)()
+        upstream_request.CopyFrom(request)
+        upstream_request.instance_name = self.instance_name or ""
+        try:
+            response = method(upstream_request)
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.NOT_FOUND:
+                self.logger.warning("Failed to fetch asset from upstream: %s", e.details())
+            return None
+
+        if response.status.code != code_pb2.OK:
+            return None
+        return response
+
+    def _store_asset(self, method, request):
+        try:
+            method(request)
+        except grpc.RpcError as e:
+            self.logger.warning("Failed to store asset from upstream: %s", e.details())
+
+
+# _ReplicationPeer
+#
+# A peer server which refs and assets are replicated to.
+#
+class _ReplicationPeer(_ServerRemote):
+
+    # replicate():
+    #
+    # Upload the blobs of an update which are missing on the peer, and
+    # then apply the update.
+    #
+    # Args:
+    #     update (tuple): The update queued by _Replicator
+    #
+    # Raises:
+    #     (grpc.RpcError|_ReplicationError): If the replication failed
+    #
+    def replicate(self, update):
+        kind, message = update
+        metadata = (_REPLICATION_METADATA,)
+
+        if kind == "reference":
+            keys, digest = message
+            self._upload(blobs=[digest], directories=[digest], allow_blobs=True)
+            request = buildstream_pb2.UpdateReferenceRequest(keys=keys)
+            if self.instance_name:
+                request.instance_name = self.instance_name
+            request.digest.CopyFrom(digest)
+            self.ref_storage.UpdateReference(request, metadata=metadata)
+        else:
+            request = type(message)()
+            request.CopyFrom(message)
+            request.instance_name = self.instance_name or ""
+            if kind == "blob":
+                self._upload(
+                    blobs=[request.blob_digest, *request.references_blobs], directories=request.references_directories
+                )
+                self.push.PushBlob(request, metadata=metadata)
+            else:
+                self._upload(
+                    blobs=request.references_blobs,
+                    directories=[request.root_directory_digest, *request.references_directories],
+                )
+                self.push.PushDirectory(request, metadata=metadata)
+
+    # Upload blobs and directory trees which are missing on the peer.
+    #
+    # With allow_blobs, directories may also be plain blobs, which
+    # buildbox-casd fails to parse as directories.
+    #
+    def _upload(self, *, blobs, directories, allow_blobs=False):
+        if blobs:
+            request = local_cas_pb2.UploadMissingBlobsRequest(instance_name=self.local_cas_instance_name)
+            request.blob_digests.extend(blobs)
+            for response in self.local_cas.UploadMissingBlobs(request).responses:
+                if response.status.code != code_pb2.OK:
+                    raise _ReplicationError(
+                        "Failed to upload blob {}: {}".format(response.digest.hash, response.status.code)
+                    )
+
+        for digest in directories:
+            request = local_cas_pb2.UploadTreeRequest(instance_name=self.local_cas_instance_name)
+            request.root_digest.CopyFrom(digest)
+            try:
+                self.local_cas.UploadTree(request)
+            except grpc.RpcError as e:
+                if not (allow_blobs and e.code() == grpc.StatusCode.INVALID_ARGUMENT):
+                    raise
+
+
+class _ReplicationError(Exception):
+    pass
+
+
+# _Replicator
+#
+# Replicates refs and assets accepted from clients to peer servers in
+# the background.
+#
+# Every peer has its own queue and thread, so that a slow or unavailable
+# peer doesn't hold back the others. Updates which fail are retried a
+# few times before they are dropped.
+#
+# Args:
+#     casd (CASDChannel): The channel to buildbox-casd
+#     peers (list): The RemoteSpecs of the peers
+#
+class _Replicator:
+    def __init__(self, casd, peers):
+        self._peers = [_ReplicationPeer(spec, casd) for spec in peers]
+        self._queues = [queue.Queue(maxsize=_MAX_REPLICATION_QUEUE) for _ in self._peers]
+        self._threads = [
+            threading.Thread(target=self._run, args=(peer, updates), name="replication", daemon=True)
+            for peer, updates in zip(self._peers, self._queues)
+        ]
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {"replicated": 0, "failed": 0, "dropped": 0}
+        self.logger = logging.getLogger("buildstream._cas.casserver")
+
+    # start():
+    #
+    # Start replicating.
+    #
+    def start(self):
+        for peer in self._peers:
+            peer.init()
+        for thread in self._threads:
+            thread.start()
+
+    # stop():
+    #
+    # Stop replicating, pending updates are dropped.
+    #
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+        pending = sum(updates.qsize() for updates in self._queues)
+        if pending:
+            self.logger.warning("Dropping %d pending replication updates", pending)
+
+        for peer in self._peers:
+            peer.close()
+
+    # replicate_reference():
+    #
+    # Queue an updated ref for replication.
+    #
+    # Args:
+    #     keys (list): The names of the refs
+    #     digest (Digest): The digest stored in the refs
+    #
+    def replicate_reference(self, keys, digest):
+        self._queue_update(("reference", (list(keys), digest)))
+
+    # replicate_asset():
+    #
+    # Queue a pushed asset for replication.
+    #
+    # Args:
+    #     request (PushBlobRequest|PushDirectoryRequest): The request of the client
+    #
+    def replicate_asset(self, request):
+        kind = "blob" if isinstance(request, remote_asset_pb2.PushBlobRequest) else "directory"
+        self._queue_update((kind, request))
+
+    # collect_metrics():
+    #
+    # Returns:
+    #     (list): The replication statistics as ServerMetrics collector tuples
+    #
+    def collect_metrics(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        return [
+            ("replicated_total", "counter", "Number of updates replicated to peers.", stats["replicated"]),
+            ("replication_failures_total", "counter", "Number of updates which failed to replicate.", stats["failed"]),
+            ("replication_dropped_total", "counter", "Number of updates dropped from full queues.", stats["dropped"]),
+            (
+                "replication_queued",
+                "gauge",
+                "Number of updates waiting for replication.",
+                sum(updates.qsize() for updates in self._queues),
+            ),
+        ]
+
+    def _queue_update(self, update):
+        for peer, updates in zip(self._peers, self._queues):
+            try:
+                updates.put_nowait(update)
+            except queue.Full:
+                self.logger.warning("Replication queue for %s is full, dropping update", peer.url)
+                self._count("dropped")
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def _run(self, peer, updates):
+        while not self._stop.is_set():
+            try:
+                update = updates.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            delay = _REPLICATION_RETRY_DELAY
+            for attempt in range(_REPLICATION_ATTEMPTS):
+                try:
+                    peer.replicate(update)
+                    self._count("replicated")
+                    break
+                except (grpc.RpcError, _ReplicationError) as e:
+                    if attempt == _REPLICATION_ATTEMPTS - 1:
+                        self.logger.warning("Failed to replicate to %s: %s", peer.url, e)
+                        self._count("failed")
+                    elif self._stop.wait(delay):
+                        return
+                    delay *= 2
+
+
+# _is_replicated():
+#
+# Whether a request was sent by the replication of a peer server.
+#
+# Args:
+#     context (grpc.ServicerContext): The context of the request
+#
+def _is_replicated(context):
+    return _REPLICATION_METADATA in tuple(context.invocation_metadata())
+
+
+# _count_lookup():
+#
+# Count a lookup of a ref or asset, if metrics are enabled.
+#
+# Args:
+#     metrics (ServerMetrics): The metrics, or None
+#     service (str): The service of the lookup, e.g. "Fetch"
+#     result (str): One of "hit", "upstream" or "miss"
+#
+def _count_lookup(metrics, service, result):
+    if metrics:
+        metrics.count_lookup(service, result)
+
+
+# _ResponseCompression
+#
+# Chooses whether to compress responses carrying blobs. Clients announce
+# the algorithms they accept with each request, responses are only
+# compressed with an algorithm the client accepts and otherwise sent
+# uncompressed. Small blobs are not worth the cost of compressing.
+#
+# This is gRPC transport compression of ByteStream.Read and
+# BatchReadBlobs responses only. Blobs pushed by clients are not
+# compressed, and the compressed blob encodings of newer REAPI versions
+# are not supported.
+#
+# Args:
+#     algorithm (str): The compression algorithm, one of COMPRESSION_ALGORITHMS
+#     threshold (int): Minimum size in bytes of the blobs in a response to compress it
+#
+class _ResponseCompression:
+    def __init__(self, algorithm, threshold):
+        self.compression = COMPRESSION_ALGORITHMS[algorithm]
+        self.threshold = threshold
+
+    # apply():
+    #
+    # Set the compression of the response to a request.
+    #
+    # Args:
+    #     context (grpc.ServicerContext): The context of the request
+    #     size_bytes (int): The total size of the blobs in the response
+    #
+    def apply(self, context, size_bytes):
+        if self.compression != grpc.Compression.NoCompression and size_bytes >= self.threshold:
+            context.set_compression(self.compression)
+
+
+# _parse_resource_name():
+#
+# Get the digest of a ByteStream read resource name.
+#
+# Args:
+#     resource_name (str): The resource name, "[{instance_name}/]blobs/{hash}/{size}"
+#
+# Returns:
+#     (Digest): The digest, or None if the resource name is invalid
+#
+def _parse_resource_name(resource_name):
+    parts = resource_name.split("/")
+    try:
+        index = parts.index("blobs")
+        return remote_execution_pb2.Digest(hash=parts[index + 1], size_bytes=int(parts[index + 2]))
+    except (ValueError, IndexError):
+        return None
+
+
+# _is_asset_miss():
+#
+# Whether a Remote Asset API response reports a missing asset.
+#
+# Args:
+#     response (FetchBlobResponse|FetchDirectoryResponse): The response, or None
+#
+def _is_asset_miss(response):
+    return response is None or response.status.code == code_pb2.NOT_FOUND
+
+
+# _run_blocking():
+#
+# Run a blocking function in the default executor of the event loop.
+#
+async def _run_blocking(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+# _AsyncCASDChannel
+#
+# Asynchronous stubs for an asyncio channel to buildbox-casd.
+#
+# Args:
+#     channel (grpc.aio.Channel): The channel to buildbox-casd
+#
+class _AsyncCASDChannel:
+    def __init__(self, channel):
+        self._channel = channel
+        self.bytestream = bytestream_pb2_grpc.ByteStreamStub(channel)
+        self.cas = remote_execution_pb2_grpc.ContentAddressableStorageStub(channel)
+        self.fetch = remote_asset_pb2_grpc.FetchStub(channel)
+        self.push = remote_asset_pb2_grpc.PushStub(channel)
+
+    async def close(self):
+        await self._channel.close()
+
+
+# _proxy()
+#
+# Forward a unary request to buildbox-casd, aborting the RPC with the
+# status returned by buildbox-casd on errors.
+#
+# Args:
+#     method (grpc.aio.UnaryUnaryMultiCallable): The buildbox-casd method
+#     request (Message): The request to forward
+#     context (grpc.aio.ServicerContext): The context of the RPC
+#     limiter (asyncio.Semaphore): Limits the requests in flight to buildbox-casd
+#
+# Returns:
+#     (Message): The response of buildbox-casd
+#
+async def _proxy(method, request, context, limiter):
+    async with limiter:
+        try:
+            return await method(request)
+        except grpc.RpcError as err:
+            await context.abort(err.code(), err.details())
+
+
+class _AsyncByteStreamServicer(bytestream_pb2_grpc.ByteStreamServicer):
+    def __init__(self, casd, limiter, upstream, compression, *, enable_push):
+        super().__init__()
+        self.bytestream = casd.bytestream
+        self.limiter = limiter
+        self.upstream = upstream
+        self.compression = compression
+        self.enable_push = enable_push
+        self.logger = logging.getLogger("buildstream._cas.casserver")
+
+    async def Read(self, request, context):
+        self.logger.debug("Reading %s", request.resource_name)
+        digest = _parse_resource_name(request.resource_name)
+        if digest:
+            if self.upstream:
+                await _run_blocking(self.upstream.fetch_missing_blobs, [digest])
+            self.compression.apply(context, digest.size_bytes)
+        async with self.limiter:
+            try:
+                async for response in self.bytestream.Read(request):
+                    yield response
+            except grpc.RpcError as err:
+                await context.abort(err.code(), err.details())
+
+    async def Write(self, request_iterator, context):
+        # Note that we can't easily give more information because the
+        # data is stuck in an iterator that will be consumed if read.
+        self.logger.debug("Writing data")
+        return await _proxy(self.bytestream.Write, request_iterator, context, self.limiter)
+
+
+class _AsyncContentAddressableStorageServicer(remote_execution_pb2_grpc.ContentAddressableStorageServicer):
+    def __init__(self, casd, limiter, upstream, compression, *, enable_push):
+        super().__init__()
+        self.cas = casd.cas
+        self.limiter = limiter
+        self.upstream = upstream
+        self.compression = compression
+        self.enable_push = enable_push
+        self.logger = logging.getLogger("buildstream._cas.casserver")
+
+    async def FindMissingBlobs(self, request, context):
+        self.logger.info("Finding '%s'", request.blob_digests)
+        return await _proxy(self.cas.FindMissingBlobs, request, context, self.limiter)
+
+    async def BatchReadBlobs(self, request, context):
+        self.logger.info("Reading '%s'", request.digests)
+        if self.upstream:
+            await _run_blocking(self.upstream.fetch_missing_blobs, request.digests)
+        self.compression.apply(context, sum(digest.size_bytes for digest in request.digests))
+        return await _proxy(self.cas.BatchReadBlobs, request, context, self.limiter)
+
+    async def BatchUpdateBlobs(self, request, context):
+        self.logger.info("Updating: '%s'", [request.digest for request in request.requests])
+        return await _proxy(self.cas.BatchUpdateBlobs, request, context, self.limiter)
+
+
+class _AsyncCapabilitiesServicer(_CapabilitiesServicer):
+    async def GetCapabilities(self, request, context):
+        return super().GetCapabilities(request, context)
+
+
+class _AsyncFetchServicer(remote_asset_pb2_grpc.FetchServicer):
+    def __init__(self, casd, limiter, upstream, metrics):
+        super().__init__()
+        self.fetch = casd.fetch
+        self.limiter = limiter
+        self.upstream = upstream
+        self.metrics = metrics
+        self.logger = logging.getLogger("buildstream._cas.casserver")
+
+    async def FetchBlob(self, request, context):
+        self.logger.debug("FetchBlob '%s'", request.uris)
+        upstream_method = self.upstream.fetch_blob if self.upstream else None
+        return await self._fetch_through(self.fetch.FetchBlob, upstream_method, request, context)
+
+    async def FetchDirectory(self, request, context):
+        self.logger.debug("FetchDirectory '%s'", request.uris)
+        upstream_method = self.upstream.fetch_directory if self.upstream else None
+        return await self._fetch_through(self.fetch.FetchDirectory, upstream_method, request, context)
+
+    # Fetch an asset from buildbox-casd, falling back to the upstream server
+    async def _fetch_through(self, method, upstream_method, request, context):
+        response = None
+        async with self.limiter:
+            try:
+                response = await method(request)
+            except grpc.RpcError as err:
+                if err.code() != grpc.StatusCode.NOT_FOUND:
+                    await context.abort(err.code(), err.details())
+
+        if not _is_asset_miss(response):
+            _count_lookup(self.metrics, "Fetch", "hit")
+            return response
+
+        if upstream_method:
+            upstream_response = await _run_blocking(upstream_method, request)
+            if upstream_response is not None:
+                _count_lookup(self.metrics, "Fetch", "upstream")
+                return upstream_response
+
+        _count_lookup(self.metrics, "Fetch", "miss")
+        if response is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "Asset not found")
+        return response
+
+
+class _AsyncPushServicer(remote_asset_pb2_grpc.PushServicer):
+    def __init__(self, casd, limiter, replicator):
+        super().__init__()
+        self.push = casd.push
+        self.limiter = limiter
+        self.replicator = replicator
+        self.logger = logging.getLogger("buildstream._cas.casserver")
+
+    async def PushBlob(self, request, context):
+        self.logger.debug("PushBlob '%s'", request.uris)
+        response = await _proxy(self.push.PushBlob, request, context, self.limiter)
+        if self.replicator and not _is_replicated(context):
+            self.replicator.replicate_asset(request)
+        return response
+
+    async def PushDirectory(self, request, context):
+        self.logger.debug("PushDirectory '%s'", request.uris)
+        response = await _proxy(self.push.PushDirectory, request, context, self.limiter)
+        if self.replicator and not _is_replicated(context):
+            self.replicator.replicate_asset(request)
+        return response
+
+
+# The refs are stored on disk or in an SQLite database, which may block,
+# so they are accessed from the default executor of the event loop.
+class _AsyncReferenceStorageServicer(_ReferenceStorageServicer):
+    async def GetReference(self, request, context):
+        self.logger.debug("'%s'", request.key)
+        response = buildstream_pb2.GetReferenceResponse()
+
+        digest = await _run_blocking(self.resolve_ref, request.key)
+        if digest is None:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            return response
+
+        response.digest.CopyFrom(digest)
+        return response
+
+    async def UpdateReference(self, request, context):
+        self.logger.debug("%s -> %s", request.keys, request.digest)
+        response = buildstream_pb2.UpdateReferenceResponse()
+
+        if not self.enable_push:
+            context.set_code(grpc.StatusCode.PERMISSION_DENIED)
+            return response
+
+        await _run_blocking(self.refs.set, request.keys, request.digest)
+
+        if self.replicator and not _is_replicated(context):
+            self.replicator.replicate_reference(request.keys, request.digest)
+
+        return response
+
+    async def Status(self, request, context):
+        return super().Status(request, context)
@@ -0,0 +1,486 @@
+#
+#  Copyright (C) 2020 Bloomberg Finance LP
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	 See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+import click
+
+from .._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+
+# Note: Like casserver, this module should import as little as possible
+# from the core codebase.
+from ..utils import save_file_atomic, _remove_path_with_parents
+
+
+# Maximum number of keys per SQLite statement, SQLite limits the
+# number of host parameters to 999 by default.
+_MAX_KEYS_PER_STATEMENT = 500
+
+# Access times of resolved refs are only written to the database in
+# batches, once this many are pending or this many seconds have passed.
+_ATIME_FLUSH_COUNT = 1024
+_ATIME_FLUSH_INTERVAL = 10
+
+# Number of refs inserted per transaction by the migration
+_MIGRATION_BATCH_SIZE = 1000
+
+
+# The available reference storage backends
+REF_STORAGE_BACKENDS = ["files", "sqlite"]
+
+
+# open_reference_storage():
+#
+# Open the reference storage of an artifact server repository.
+#
+# Args:
+#     root (str): Path to the repository
+#     backend (str): One of REF_STORAGE_BACKENDS
+#
+# Returns:
+#     (FileReferenceStorage|SQLiteReferenceStorage): The reference storage
+#
+def open_reference_storage(root, backend):
+    if backend == "files":
+        return FileReferenceStorage(root)
+    elif backend == "sqlite":
+        return SQLiteReferenceStorage(root)
+    else:
+        raise ValueError("Unknown reference storage backend: {}".format(backend))
+
+
+# FileReferenceStorage
+#
+# Stores every ref as a separate file containing the serialized digest
+# under `cas/refs/heads` in the repository, the file modification time
+# records the last access.
+#
+# Args:
+#     root (str): Path to the repository
+#
+class FileReferenceStorage:
+    def __init__(self, root):
+        self.tmpdir = os.path.join(root, "tmp")
+        self.refdir = os.path.join(root, "cas", "refs", "heads")
+        os.makedirs(self.tmpdir, exist_ok=True)
+
+    # get():
+    #
+    # Resolve a ref to a digest and record the access.
+    #
+    # Args:
+    #     key (str): The name of the ref
+    #
+    # Returns:
+    #     (Digest): The digest stored in the ref, or None if it doesn't exist
+    #
+    def get(self, key):
+        ref_path = os.path.join(self.refdir, key)
+
+        try:
+            with open(ref_path, "rb") as f:
+                os.utime(ref_path)
+
+                digest = remote_execution_pb2.Digest()
+                digest.ParseFromString(f.read())
+                return digest
+        except FileNotFoundError:
+            with contextlib.suppress(FileNotFoundError):
+                _remove_path_with_parents(self.refdir, key)
+            return None
+
+    # get_many():
+    #
+    # Resolve multiple refs to digests and record the accesses.
+    #
+    # Args:
+    #     keys (iterable): The names of the refs
+    #
+    # Returns:
+    #     (dict): The digests of the refs that exist, by name
+    #
+    def get_many(self, keys):
+        digests = {}
+        for key in keys:
+            digest = self.get(key)
+            if digest is not None:
+                digests[key] = digest
+        return digests
+
+    # set():
+    #
+    # Create or update refs with a new digest.
+    #
+    # Args:
+    #     keys (iterable): The names of the refs
+    #     digest (Digest): The digest to store
+    #
+    def set(self, keys, digest):
+        data = digest.SerializeToString()
+        for key in keys:
+            ref_path = os.path.join(self.refdir, key)
+            os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+            with save_file_atomic(ref_path, "wb", tempdir=self.tmpdir) as f:
+                f.write(data)
+
+    # remove():
+    #
+    # Remove refs, refs which don't exist are ignored.
+    #
+    # Args:
+    #     keys (iterable): The names of the refs
+    #     accessed_before (float): Only remove refs last accessed before this time
+    #
+    # Returns:
+    #     (int): The number of removed refs
+    #
+    def remove(self, keys, *, accessed_before=None):
+        removed = 0
+        for key in keys:
+            with contextlib.suppress(FileNotFoundError):
+                if accessed_before is not None and os.stat(os.path.join(self.refdir, key)).st_mtime >= accessed_before:
+                    continue
+                _remove_path_with_parents(self.refdir, key)
+                removed += 1
+
+        return removed
+
+    # list_refs():
+    #
+    # List all refs without recording accesses.
+    #
+    # Yields:
+    #     (str, Digest, float): The name, digest and last access time of each ref
+    #
+    def list_refs(self):
+        for dirpath, _, filenames in os.walk(self.refdir):
+            for filename in filenames:
+                ref_path = os.path.join(dirpath, filename)
+                try:
+                    with open(ref_path, "rb") as f:
+                        digest = remote_execution_pb2.Digest()
+                        digest.ParseFromString(f.read())
+                        atime = os.fstat(f.fileno()).st_mtime
+                except FileNotFoundError:
+                    continue
+
+                yield os.path.relpath(ref_path, self.refdir), digest, atime
+
+    # list_lru():
+    #
+    # List the refs last accessed before a given time, least recently
+    # used first, without recording accesses.
+    #
+    # Args:
+    #     accessed_before (float): Only list refs last accessed before this time
+    #
+    # Yields:
+    #     (str, Digest, float): The name, digest and last access time of each ref
+    #
+    def list_lru(self, *, accessed_before):
+        # The files have no index, all refs need to be read
+        refs = [ref for ref in self.list_refs() if ref[2] < accessed_before]
+        yield from sorted(refs, key=lambda ref: ref[2])
+
+    # flush():
+    #
+    # Write pending access times, nothing is pending for this backend.
+    #
+    def flush(self):
+        pass
+
+    # close():
+    #
+    # Release the resources of the storage.
+    #
+    def close(self):
+        pass
+
+
+# SQLiteReferenceStorage
+#
+# Stores all refs in a single indexed SQLite database at `cas/refs.db`
+# in the repository.
+#
+# Lookups and updates of multiple refs are batched into single
+# statements. Access times of resolved refs are kept in memory and
+# written in batches, so that reads don't require a write to disk each.
+#
+# The storage may be used from multiple threads.
+#
+# Args:
+#     root (str): Path to the repository
+#
+class SQLiteReferenceStorage:
+    def __init__(self, root):
+        casdir = os.path.join(root, "cas")
+        os.makedirs(casdir, exist_ok=True)
+
+        self.path = os.path.join(casdir, "refs.db")
+        self._lock = threading.Lock()
+        self._pending_atimes = {}
+        self._last_flush = time.monotonic()
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS refs ("
+            "key TEXT PRIMARY KEY, hash TEXT NOT NULL, size_bytes INTEGER NOT NULL, atime REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS refs_atime ON refs (atime)")
+
+    # get():
+    #
+    # Resolve a ref to a digest and record the access.
+    #
+    # Args:
+    #     key (str): The name of the ref
+    #
+    # Returns:
+    #     (Digest): The digest stored in the ref, or None if it doesn't exist
+    #
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    # get_many():
+    #
+    # Resolve multiple refs to digests and record the accesses.
+    #
+    # Args:
+    #     keys (iterable): The names of the refs
+    #
+    # Returns:
+    #     (dict): The digests of the refs that exist, by name
+    #
+    def get_many(self, keys):
+        keys = list(keys)
+        digests = {}
+
+        with self._lock:
+            for i in range(0, len(keys), _MAX_KEYS_PER_STATEMENT):
+                batch = keys[i : i + _MAX_KEYS_PER_STATEMENT]
+                rows = self._db.execute(
+                    "SELECT key, hash, size_bytes FROM refs WHERE key IN ({})".format(",".join("?" * len(batch))),
+                    batch,
+                )
+                for key, hash_, size_bytes in rows:
+                    digests[key] = remote_execution_pb2.Digest(hash=hash_, size_bytes=size_bytes)
+
+            now = time.time()
+            for key in digests:
+                self._pending_atimes[key] = now
+
+            if (
+                len(self._pending_atimes) >= _ATIME_FLUSH_COUNT
+                or time.monotonic() - self._last_flush >= _ATIME_FLUSH_INTERVAL
+            ):
+                self._flush_atimes()
+
+        return digests
+
+    # set():
+    #
+    # Create or update refs with a new digest in a single transaction.
+    #
+    # Args:
+    #     keys (iterable): The names of the refs
+    #     digest (Digest): The digest to store
+    #
+    def set(self, keys, digest):
+        now = time.time()
+        self._insert([(key, digest.hash, digest.size_bytes, now) for key in keys])
+
+    # remove():
+    #
+    # Remove refs, refs which don't exist are ignored.
+    #
+    # Args:
+    #     keys (iterable): The names of the refs
+    #     accessed_before (float): Only remove refs last accessed before this time
+    #
+    # Returns:
+    #     (int): The number of removed refs
+    #
+    def remove(self, keys, *, accessed_before=None):
+        keys = list(keys)
+        with self._lock:
+            if accessed_before is None:
+                for key in keys:
+                    self._pending_atimes.pop(key, None)
+            else:
+                # Pending accesses must be considered
+                self._flush_atimes()
+
+            with self._transaction():
+                if accessed_before is None:
+                    cursor = self._db.executemany("DELETE FROM refs WHERE key = ?", [(key,) for key in keys])
+                else:
+                    cursor = self._db.executemany(
+                        "DELETE FROM refs WHERE key = ? AND atime < ?", [(key, accessed_before) for key in keys]
+                    )
+
+            return cursor.rowcount
+
+    # list_refs():
+    #
+    # List all refs without recording accesses.
+    #
+    # Yields:
+    #     (str, Digest, float): The name, digest and last access time of each ref
+    #
+    def list_refs(self):
+        self.flush()
+        with self._lock:
+            rows = self._db.execute("SELECT key, hash, size_bytes, atime FROM refs").fetchall()
+        for key, hash_, size_bytes, atime in rows:
+            yield key, remote_execution_pb2.Digest(hash=hash_, size_bytes=size_bytes), atime
+
+    # list_lru():
+    #
+    # List the refs last accessed before a given time, least recently
+    # used first, without recording accesses.
+    #
+    # The refs are read from the access time index in pages, so that
+    # only as many refs are read as the caller consumes.
+    #
+    # Args:
+    #     accessed_before (float): Only list refs last accessed before this time
+    #
+    # Yields:
+    #     (str, Digest, float): The name, digest and last access time of each ref
+    #
+    def list_lru(self, *, accessed_before):
+        self.flush()
+        last_atime, last_key = float("-inf"), ""
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT key, hash, size_bytes, atime FROM refs "
+                    "WHERE atime < ? AND (atime > ? OR (atime = ? AND key > ?)) "
+                    "ORDER BY atime, key LIMIT ?",
+                    (accessed_before, last_atime, last_atime, last_key, _MAX_KEYS_PER_STATEMENT),
+                ).fetchall()
+            if not rows:
+                return
+
+            for key, hash_, size_bytes, atime in rows:
+                yield key, remote_execution_pb2.Digest(hash=hash_, size_bytes=size_bytes), atime
+            last_key, _, _, last_atime = rows[-1]
+
+    # flush():
+    #
+    # Write pending access times to the database.
+    #
+    def flush(self):
+        with self._lock:
+            self._flush_atimes()
+
+    # close():
+    #
+    # Write pending access times and close the database.
+    #
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    # Insert or replace rows of (key, hash, size_bytes, atime) in a
+    # single transaction.
+    def _insert(self, rows):
+        with self._lock, self._transaction():
+            for key, *_ in rows:
+                self._pending_atimes.pop(key, None)
+            self._db.executemany("INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?)", rows)
+
+    # Must be called with the lock held
+    def _flush_atimes(self):
+        if self._pending_atimes:
+            with self._transaction():
+                self._db.executemany(
+                    "UPDATE refs SET atime = ? WHERE key = ?",
+                    [(atime, key) for key, atime in self._pending_atimes.items()],
+                )
+            self._pending_atimes = {}
+        self._last_flush = time.monotonic()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+
+# migrate_file_references():
+#
+# Import the refs of the file layout of a repository into its SQLite
+# reference storage, keeping their last access times.
+#
+# Args:
+#     root (str): Path to the repository
+#     remove_files (bool): Whether to remove the ref files after importing them
+#
+# Returns:
+#     (int): The number of migrated refs
+#
+def migrate_file_references(root, *, remove_files=False):
+    files = FileReferenceStorage(root)
+    database = SQLiteReferenceStorage(root)
+    count = 0
+
+    def migrate(batch):
+        database._insert([(key, digest.hash, digest.size_bytes, atime) for key, digest, atime in batch])
+        if remove_files:
+            files.remove(key for key, _, _ in batch)
+
+    try:
+        batch = []
+        for ref in files.list_refs():
+            batch.append(ref)
+            if len(batch) >= _MIGRATION_BATCH_SIZE:
+                migrate(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            migrate(batch)
+            count += len(batch)
+    finally:
+        database.close()
+
+    return count
+
+
+@click.command(short_help="Migrate the refs of a CAS Artifact Server repository")
+@click.option("--remove-files", is_flag=True, help="Remove the ref files after migrating them")
+@click.argument("repo")
+def migrate_main(repo, remove_files):
+    """Import the refs stored as files under `cas/refs/heads` in the
+    repository into the SQLite reference storage used by
+    `bst-artifact-server --ref-storage sqlite`.
+
+    The server must not be running during the migration.
+    """
+    count = migrate_file_references(os.path.abspath(repo), remove_files=remove_files)
+    click.echo("Migrated {} refs".format(count))
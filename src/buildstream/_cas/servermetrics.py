@@ -0,0 +1,394 @@
+#
+#  Copyright (C) 2020 Bloomberg Finance LP
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	 See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+import collections
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import grpc
+
+
+# Upper bounds of the request latency histogram buckets in seconds
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_PREFIX = "bst_artifact_server_"
+
+
+# ServerMetrics
+#
+# Collects metrics of the artifact server and renders them in the
+# Prometheus text exposition format.
+#
+# Requests are recorded by the interceptors returned by
+# create_interceptor() and create_async_interceptor(), lookups are
+# recorded by the servicers.
+#
+class ServerMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = collections.Counter()
+        self._failures = collections.Counter()
+        self._received_bytes = collections.Counter()
+        self._sent_bytes = collections.Counter()
+        self._latencies = {}
+        self._latency_sums = collections.Counter()
+        self._lookups = collections.Counter()
+        self._collectors = []
+
+    # observe_request():
+    #
+    # Record a completed request.
+    #
+    # Args:
+    #     method (str): The name of the method, e.g. "ByteStream/Read"
+    #     duration (float): The duration of the request in seconds
+    #     received (int): The number of message bytes received
+    #     sent (int): The number of message bytes sent
+    #     failed (bool): Whether the request failed with an exception
+    #
+    def observe_request(self, method, duration, received, sent, failed):
+        bucket = bisect.bisect_left(_LATENCY_BUCKETS, duration)
+        with self._lock:
+            self._requests[method] += 1
+            if failed:
+                self._failures[method] += 1
+            self._received_bytes[method] += received
+            self._sent_bytes[method] += sent
+            self._latency_sums[method] += duration
+            try:
+                self._latencies[method][bucket] += 1
+            except KeyError:
+                self._latencies[method] = [0] * (len(_LATENCY_BUCKETS) + 1)
+                self._latencies[method][bucket] += 1
+
+    # count_lookup():
+    #
+    # Record the result of a ref or asset lookup.
+    #
+    # Args:
+    #     service (str): The service, "ReferenceStorage" or "Fetch"
+    #     result (str): "hit", "miss" or "upstream" if fetched from the upstream server
+    #
+    def count_lookup(self, service, result):
+        with self._lock:
+            self._lookups[(service, result)] += 1
+
+    # add_collector():
+    #
+    # Add a callback providing further metrics when rendering.
+    #
+    # Args:
+    #     collector (callable): Returns a list of (name, type, help, value) tuples
+    #
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    # render():
+    #
+    # Returns:
+    #     (str): The metrics in the Prometheus text exposition format
+    #
+    def render(self):
+        lines = []
+
+        def header(name, metric_type, help_text):
+            lines.append("# HELP {}{} {}".format(_PREFIX, name, help_text))
+            lines.append("# TYPE {}{} {}".format(_PREFIX, name, metric_type))
+
+        def samples(name, counter, label):
+            for key, value in sorted(counter.items()):
+                lines.append('{}{}{{{}="{}"}} {}'.format(_PREFIX, name, label, key, value))
+
+        with self._lock:
+            header("requests_total", "counter", "Number of handled requests.")
+            samples("requests_total", self._requests, "method")
+            header("request_failures_total", "counter", "Number of requests which failed with an error.")
+            samples("request_failures_total", self._failures, "method")
+            header("received_bytes_total", "counter", "Number of message bytes received from clients.")
+            samples("received_bytes_total", self._received_bytes, "method")
+            header("sent_bytes_total", "counter", "Number of message bytes sent to clients.")
+            samples("sent_bytes_total", self._sent_bytes, "method")
+
+            header("request_duration_seconds", "histogram", "Duration of requests.")
+            for method, buckets in sorted(self._latencies.items()):
+                cumulative = 0
+                for bound, count in zip(_LATENCY_BUCKETS + ("+Inf",), buckets):
+                    cumulative += count
+                    lines.append(
+                        '{}request_duration_seconds_bucket{{method="{}",le="{}"}} {}'.format(
+                            _PREFIX, method, bound, cumulative
+                        )
+                    )
+                lines.append(
+                    '{}request_duration_seconds_sum{{method="{}"}} {}'.format(
+                        _PREFIX, method, self._latency_sums[method]
+                    )
+                )
+                lines.append('{}request_duration_seconds_count{{method="{}"}} {}'.format(_PREFIX, method, cumulative))
+
+            header("lookups_total", "counter", "Number of ref and asset lookups by result.")
+            for (service, result), value in sorted(self._lookups.items()):
+                lines.append('{}lookups_total{{service="{}",result="{}"}} {}'.format(_PREFIX, service, result, value))
+
+        for collector in self._collectors:
+            for name, metric_type, help_text, value in collector():
+                header(name, metric_type, help_text)
+                lines.append("{}{} {}".format(_PREFIX, name, value))
+
+        return "\n".join(lines) + "\n"
+
+
+# create_interceptor():
+#
+# Create a server interceptor recording all requests.
+#
+# Args:
+#     metrics (ServerMetrics): The metrics to record the requests in
+#
+# Returns:
+#     (grpc.ServerInterceptor): The interceptor
+#
+def create_interceptor(metrics):
+    class _MetricsInterceptor(grpc.ServerInterceptor):
+        def intercept_service(self, continuation, handler_call_details):
+            return _wrap_handler(continuation(handler_call_details), handler_call_details.method, metrics)
+
+    return _MetricsInterceptor()
+
+
+# create_async_interceptor():
+#
+# Create an asyncio server interceptor recording all requests.
+#
+# Args:
+#     metrics (ServerMetrics): The metrics to record the requests in
+#
+# Returns:
+#     (grpc.aio.ServerInterceptor): The interceptor
+#
+def create_async_interceptor(metrics):
+    from grpc import aio  # pylint: disable=import-outside-toplevel
+
+    class _AsyncMetricsInterceptor(aio.ServerInterceptor):
+        async def intercept_service(self, continuation, handler_call_details):
+            handler = await continuation(handler_call_details)
+            return _wrap_async_handler(handler, handler_call_details.method, metrics)
+
+    return _AsyncMetricsInterceptor()
+
+
+# start_http_server():
+#
+# Serve the metrics over HTTP from a background thread.
+#
+# Args:
+#     metrics (ServerMetrics): The metrics to serve
+#     port (int): The port to listen on
+#
+# Returns:
+#     (HTTPServer): The server, to be stopped with shutdown()
+#
+def start_http_server(metrics, port):
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = _ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+# Get the short method name, e.g. "ByteStream/Read" from
+# "/google.bytestream.ByteStream/Read".
+def _method_name(full_method):
+    service, _, method = full_method.rpartition("/")
+    return "{}/{}".format(service.rpartition(".")[2], method)
+
+
+def _wrap_handler(handler, full_method, metrics):
+    if handler is None:
+        return None
+
+    method = _method_name(full_method)
+
+    if handler.unary_unary:
+        behavior = handler.unary_unary
+
+        def unary_unary(request, context):
+            start = time.monotonic()
+            sent = 0
+            failed = True
+            try:
+                response = behavior(request, context)
+                sent = response.ByteSize()
+                failed = False
+                return response
+            finally:
+                metrics.observe_request(method, time.monotonic() - start, request.ByteSize(), sent, failed)
+
+        return grpc.unary_unary_rpc_method_handler(
+            unary_unary,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+    if handler.unary_stream:
+        behavior = handler.unary_stream
+
+        def unary_stream(request, context):
+            start = time.monotonic()
+            sent = 0
+            failed = True
+            try:
+                for response in behavior(request, context):
+                    sent += response.ByteSize()
+                    yield response
+                failed = False
+            finally:
+                metrics.observe_request(method, time.monotonic() - start, request.ByteSize(), sent, failed)
+
+        return grpc.unary_stream_rpc_method_handler(
+            unary_stream,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+    if handler.stream_unary:
+        behavior = handler.stream_unary
+
+        def stream_unary(request_iterator, context):
+            start = time.monotonic()
+            received = 0
+            sent = 0
+            failed = True
+
+            def count_requests():
+                nonlocal received
+                for request in request_iterator:
+                    received += request.ByteSize()
+                    yield request
+
+            try:
+                response = behavior(count_requests(), context)
+                sent = response.ByteSize()
+                failed = False
+                return response
+            finally:
+                metrics.observe_request(method, time.monotonic() - start, received, sent, failed)
+
+        return grpc.stream_unary_rpc_method_handler(
+            stream_unary,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+    # None of the served methods are bidirectional streams
+    return handler
+
+
+def _wrap_async_handler(handler, full_method, metrics):
+    if handler is None:
+        return None
+
+    method = _method_name(full_method)
+
+    if handler.unary_unary:
+        behavior = handler.unary_unary
+
+        async def unary_unary(request, context):
+            start = time.monotonic()
+            sent = 0
+            failed = True
+            try:
+                response = await behavior(request, context)
+                sent = response.ByteSize()
+                failed = False
+                return response
+            finally:
+                metrics.observe_request(method, time.monotonic() - start, request.ByteSize(), sent, failed)
+
+        return grpc.unary_unary_rpc_method_handler(
+            unary_unary,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+    if handler.unary_stream:
+        behavior = handler.unary_stream
+
+        async def unary_stream(request, context):
+            start = time.monotonic()
+            sent = 0
+            failed = True
+            try:
+                async for response in behavior(request, context):
+                    sent += response.ByteSize()
+                    yield response
+                failed = False
+            finally:
+                metrics.observe_request(method, time.monotonic() - start, request.ByteSize(), sent, failed)
+
+        return grpc.unary_stream_rpc_method_handler(
+            unary_stream,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+    if handler.stream_unary:
+        behavior = handler.stream_unary
+
+        async def stream_unary(request_iterator, context):
+            start = time.monotonic()
+            received = 0
+            sent = 0
+            failed = True
+
+            async def count_requests():
+                nonlocal received
+                async for request in request_iterator:
+                    received += request.ByteSize()
+                    yield request
+
+            try:
+                response = await behavior(count_requests(), context)
+                sent = response.ByteSize()
+                failed = False
+                return response
+            finally:
+                metrics.observe_request(method, time.monotonic() - start, received, sent, failed)
+
+        return grpc.stream_unary_rpc_method_handler(
+            stream_unary,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+    return handler
@@ -0,0 +1,130 @@
+#
+#  Copyright (C) 2020 Bloomberg Finance LP
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	 See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import os
+import sys
+import time
+
+
+# The transfer directions, pulls take precedence over pushes
+PULL = "pull"
+PUSH = "push"
+
+
+# TransferShaper
+#
+# Limits the bandwidth used for blob transfers between buildbox-casd and
+# remotes, and optionally lets pulls take precedence over pushes.
+#
+# The state is kept in lock files in a directory, so that the limits are
+# shared between the forked jobs of a session and concurrent sessions
+# using the same cache directory.
+#
+# Each direction has a limit enforced by reserving the bytes of each
+# request before it is sent: the time at which the reserved bytes will
+# have been transferred at the limit is stored, and a request only
+# starts once the bytes reserved before it have been transferred.
+#
+# While a process is pulling blobs, it holds a shared lock which keeps
+# other processes from sending push requests.
+#
+# Without any limit or on Windows, where 'fcntl' is unavailable, the
+# shaper does nothing.
+#
+# Args:
+#     directory (str): The directory to keep the state in
+#     pull_limit (int): Maximum bytes per second to pull, or None
+#     push_limit (int): Maximum bytes per second to push, or None
+#     prioritize_pulls (bool): Whether pushes pause while blobs are pulled
+#
+class TransferShaper:
+    def __init__(self, directory, *, pull_limit=None, push_limit=None, prioritize_pulls=False):
+        self._directory = directory
+        self._limits = {PULL: pull_limit, PUSH: push_limit}
+        self._prioritize_pulls = prioritize_pulls
+        self._enabled = bool(pull_limit or push_limit or prioritize_pulls) and sys.platform != "win32"
+
+        if self._enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    # transferring():
+    #
+    # Context manager to wrap a series of requests transferring blobs in
+    # the given direction. Pulls hold off pushes until they are done.
+    #
+    # Args:
+    #     direction (str): PULL or PUSH
+    #
+    @contextlib.contextmanager
+    def transferring(self, direction):
+        if not self._enabled or direction != PULL or not self._prioritize_pulls:
+            yield
+            return
+
+        # Open the lock file in every call, locks on file descriptions
+        # inherited by forked jobs would be shared with the parent
+        with self._locked("pulls", shared=True):
+            yield
+
+    # acquire():
+    #
+    # Wait until a request in the given direction may be sent.
+    #
+    # Args:
+    #     direction (str): PULL or PUSH
+    #     n_bytes (int): The number of bytes transferred by the request
+    #
+    def acquire(self, direction, n_bytes):
+        if not self._enabled:
+            return
+
+        if direction == PUSH and self._prioritize_pulls:
+            # Blocks while any process is pulling
+            with self._locked("pulls"):
+                pass
+
+        limit = self._limits[direction]
+        if limit:
+            delay = self._reserve(direction, n_bytes, limit)
+            if delay > 0:
+                time.sleep(delay)
+
+    # Reserve bytes at the limit of a direction, returns the number of
+    # seconds to wait until the request may start.
+    def _reserve(self, direction, n_bytes, limit):
+        with self._locked(direction) as f:
+            now = time.time()
+            try:
+                start = max(now, float(f.read() or 0))
+            except ValueError:
+                start = now
+
+            f.seek(0)
+            f.truncate()
+            f.write(str(start + n_bytes / limit))
+
+        return start - now
+
+    @contextlib.contextmanager
+    def _locked(self, name, *, shared=False):
+        import fcntl
+
+        with open(os.path.join(self._directory, name), "a+") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            f.seek(0)
+            yield f
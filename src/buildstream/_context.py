@@ -131,6 +131,10 @@ class Context:
         # Maximum number of retries for network tasks
         self.sched_network_retries = None
 
+        # Number of seconds to gather pushed artifacts for before pushing
+        # their references together, 0 to push them from each push task
+        self.sched_push_batch_window = None
+
         # What to do when a build fails in non interactive mode
         self.sched_error_action = None
 
@@ -149,12 +153,33 @@ class Context:
         # Whether or not to attempt to pull build trees globally
         self.pull_buildtrees = None
 
+        # Whether to only pull the file contents of artifacts when staged
+        self.pull_files_on_demand = None
+
         # Whether to pull the files of an artifact when doing remote execution
         self.pull_artifact_files = None
 
         # Whether or not to cache build trees on artifact creation
         self.cache_buildtrees = None
 
+        # Number of seconds to remember artifacts missing from remotes
+        self.remote_miss_ttl = None
+
+        # Whether to share buildbox-casd with other sessions, and for how long
+        # to keep it running when unused
+        self.shared_casd = None
+        self.shared_casd_idle_timeout = None
+
+        # Maximum number of concurrent requests to transfer blobs
+        self.batch_requests_in_flight = None
+
+        # Maximum bytes per second to pull and push blobs, or None
+        self.pull_bandwidth_limit = None
+        self.push_bandwidth_limit = None
+
+        # Whether pushes pause while blobs are pulled
+        self.prioritize_pulls = None
+
         # Whether directory trees are required for all artifacts in the local cache
         self.require_artifact_directories = True
 
@@ -312,7 +337,21 @@ class Context:
         # We need to find the first existing directory in the path of our
         # casdir - the casdir may not have been created yet.
         cache = defaults.get_mapping("cache")
-        cache.validate_keys(["quota", "pull-buildtrees", "cache-buildtrees"])
+        cache.validate_keys(
+            [
+                "quota",
+                "pull-buildtrees",
+                "pull-files-on-demand",
+                "cache-buildtrees",
+                "remote-miss-ttl",
+                "shared-casd",
+                "shared-casd-idle-timeout",
+                "batch-requests-in-flight",
+                "pull-bandwidth-limit",
+                "push-bandwidth-limit",
+                "prioritize-pulls",
+            ]
+        )
 
         cas_volume = self.casdir
         while not os.path.exists(cas_volume):
@@ -351,9 +390,45 @@ class Context:
         # Load pull build trees configuration
         self.pull_buildtrees = cache.get_bool("pull-buildtrees")
 
+        # Load on demand file pull configuration
+        self.pull_files_on_demand = cache.get_bool("pull-files-on-demand")
+
         # Load cache build trees configuration
         self.cache_buildtrees = cache.get_enum("cache-buildtrees", _CacheBuildTrees)
 
+        # Load remote miss TTL configuration
+        self.remote_miss_ttl = cache.get_int("remote-miss-ttl")
+        if self.remote_miss_ttl < 0:
+            provenance = cache.get_scalar("remote-miss-ttl").get_provenance()
+            raise LoadError(
+                "{}: Invalid value for 'remote-miss-ttl'. Must not be negative.".format(provenance),
+                LoadErrorReason.INVALID_DATA,
+            )
+
+        # Load shared buildbox-casd configuration
+        self.shared_casd = cache.get_bool("shared-casd")
+        self.shared_casd_idle_timeout = cache.get_int("shared-casd-idle-timeout")
+        if self.shared_casd_idle_timeout < 0:
+            provenance = cache.get_scalar("shared-casd-idle-timeout").get_provenance()
+            raise LoadError(
+                "{}: Invalid value for 'shared-casd-idle-timeout'. Must not be negative.".format(provenance),
+                LoadErrorReason.INVALID_DATA,
+            )
+
+        # Load blob transfer configuration
+        self.batch_requests_in_flight = cache.get_int("batch-requests-in-flight")
+        if self.batch_requests_in_flight < 1:
+            provenance = cache.get_scalar("batch-requests-in-flight").get_provenance()
+            raise LoadError(
+                "{}: Invalid value for 'batch-requests-in-flight'. Must be at least 1.".format(provenance),
+                LoadErrorReason.INVALID_DATA,
+            )
+
+        # Load bandwidth shaping configuration
+        self.pull_bandwidth_limit = self._load_bandwidth_limit(cache, "pull-bandwidth-limit")
+        self.push_bandwidth_limit = self._load_bandwidth_limit(cache, "push-bandwidth-limit")
+        self.prioritize_pulls = cache.get_bool("prioritize-pulls")
+
         # Load logging config
         logging = defaults.get_mapping("logging")
         logging.validate_keys(
@@ -379,12 +454,21 @@ class Context:
 
         # Load scheduler config
         scheduler = defaults.get_mapping("scheduler")
-        scheduler.validate_keys(["on-error", "fetchers", "builders", "pushers", "network-retries"])
+        scheduler.validate_keys(
+            ["on-error", "fetchers", "builders", "pushers", "network-retries", "push-batch-window"]
+        )
         self.sched_error_action = scheduler.get_enum("on-error", _SchedulerErrorAction)
         self.sched_fetchers = scheduler.get_int("fetchers")
         self.sched_builders = scheduler.get_int("builders")
         self.sched_pushers = scheduler.get_int("pushers")
         self.sched_network_retries = scheduler.get_int("network-retries")
+        self.sched_push_batch_window = scheduler.get_int("push-batch-window")
+        if self.sched_push_batch_window < 0:
+            provenance = scheduler.get_scalar("push-batch-window").get_provenance()
+            raise LoadError(
+                "{}: Invalid value for 'push-batch-window'. Must not be negative.".format(provenance),
+                LoadErrorReason.INVALID_DATA,
+            )
 
         # Load build config
         build = defaults.get_mapping("build")
@@ -547,6 +631,31 @@ class Context:
         if not os.environ.get("XDG_DATA_HOME"):
             os.environ["XDG_DATA_HOME"] = os.path.expanduser("~/.local/share")
 
+    # Load a bandwidth limit in bytes per second from the cache
+    # configuration, returns None if it is unlimited.
+    def _load_bandwidth_limit(self, cache, key):
+        value = cache.get_str(key)
+        try:
+            if value.endswith("%"):
+                raise utils.UtilError("{} is not a valid bandwidth.".format(value))
+            limit = utils._parse_size(value, None)
+        except utils.UtilError as e:
+            provenance = cache.get_scalar(key).get_provenance()
+            raise LoadError(
+                "{}: Invalid value for '{}': {}\n"
+                "\nValid values are, for example: infinity 500K 10M 1G\n".format(provenance, key, e),
+                LoadErrorReason.INVALID_DATA,
+            ) from e
+
+        if limit == 0:
+            provenance = cache.get_scalar(key).get_provenance()
+            raise LoadError(
+                "{}: Invalid value for '{}'. Must be greater than 0.".format(provenance, key),
+                LoadErrorReason.INVALID_DATA,
+            )
+
+        return limit
+
     def get_cascache(self):
         if self._cascache is None:
             if self.log_debug:
@@ -562,6 +671,12 @@ class Context:
                 cache_quota=self.config_cache_quota,
                 log_level=log_level,
                 log_directory=self.logdir,
+                shared_casd=self.shared_casd,
+                shared_casd_idle_timeout=self.shared_casd_idle_timeout,
+                batch_requests_in_flight=self.batch_requests_in_flight,
+                pull_bandwidth_limit=self.pull_bandwidth_limit,
+                push_bandwidth_limit=self.push_bandwidth_limit,
+                prioritize_pulls=self.prioritize_pulls,
             )
         return self._cascache
 
@@ -576,5 +691,8 @@ class Context:
             if cache:
                 cache.close_grpc_channels()
 
+        if self._artifactcache:
+            self._artifactcache.prepare_fork()
+
         # Do not allow fork if there are background threads.
         return utils._is_single_threaded()
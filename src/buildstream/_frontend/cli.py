@@ -549,14 +549,24 @@ def show(app, elements, deps, except_, order, format_):
         if not elements:
             elements = app.project.get_default_targets()
 
-        dependencies = app.stream.load_selection(elements, selection=deps, except_targets=except_)
+        if not format_:
+            format_ = app.context.log_element_format
+
+        # The cache only needs to be queried for the element state, for build
+        # plans and, in non-strict mode, for the cache keys.
+        query_cache = (
+            deps == _PipelineSelection.PLAN
+            or "%{state" in format_
+            or (not app.context.get_strict() and ("%{key" in format_ or "%{full-key" in format_))
+        )
+
+        dependencies = app.stream.load_selection(
+            elements, selection=deps, except_targets=except_, query_cache=query_cache
+        )
 
         if order == "alpha":
             dependencies = sorted(dependencies)
 
-        if not format_:
-            format_ = app.context.log_element_format
-
         report = app.logger.show_pipeline(dependencies, format_)
         click.echo(report)
 
@@ -1334,6 +1344,67 @@ def artifact_pull(app, artifacts, deps, remote):
         app.stream.pull(artifacts, selection=deps, remote=remote, ignore_junction_targets=ignore_junction_targets)
 
 
+################################################################
+#                   Artifact Prefetch Command                  #
+################################################################
+@artifact.command(name="prefetch", short_help="Pull all missing artifacts at once")
+@click.option(
+    "--deps",
+    "-d",
+    default=_PipelineSelection.ALL,
+    show_default=True,
+    type=FastEnumType(
+        _PipelineSelection,
+        [_PipelineSelection.BUILD, _PipelineSelection.NONE, _PipelineSelection.RUN, _PipelineSelection.ALL],
+    ),
+    help="The dependency artifacts to prefetch",
+)
+@click.option(
+    "--remote", "-r", default=None, help="The URL of the remote cache (defaults to the first configured cache)"
+)
+@click.option("--sources", is_flag=True, help="Fetch the sources of elements whose artifacts are not available")
+@click.argument("elements", nargs=-1, type=click.Path(readable=False))
+@click.pass_obj
+def artifact_prefetch(app, elements, deps, remote, sources):
+    """Pull all artifacts of the selected elements which are missing from
+    the local cache, to warm the cache before a build.
+
+    Unlike `bst artifact pull`, the remotes are queried for all artifacts
+    at once and their contents are transferred together, without a job
+    per element.
+
+    Specifying no elements will result in prefetching the default targets
+    of the project. If no default targets are configured, all project
+    elements will be prefetched.
+
+    Specify `--deps` to control which artifacts to prefetch:
+
+    \b
+        none:  No dependencies, just the element itself
+        run:   Runtime dependencies, including the element itself
+        build: Build time dependencies, excluding the element itself
+        all:   All dependencies
+
+    Buildtrees are only pulled if the `--pull-buildtrees` option is given
+    to `bst` or configured.
+
+    Specify `--sources` to also fetch the sources of the elements whose
+    artifacts are not available, as these will need to be built.
+    """
+
+    with app.initialized(session_name="Prefetch"):
+        ignore_junction_targets = False
+
+        if not elements:
+            elements = app.project.get_default_targets()
+            # Junction elements cannot be pulled, exclude them from default targets
+            ignore_junction_targets = True
+
+        app.stream.prefetch(
+            elements, selection=deps, remote=remote, ignore_junction_targets=ignore_junction_targets, sources=sources,
+        )
+
+
 ##################################################################
 #                     Artifact Push Command                      #
 ##################################################################
@@ -1478,12 +1549,23 @@ def artifact_list_contents(app, artifacts, long_):
     ),
     help="The dependencies to delete",
 )
+@click.option(
+    "--orphans",
+    is_flag=True,
+    help="Remove the artifacts and cached sources whose contents were evicted from the local cache",
+)
 @click.argument("artifacts", type=click.Path(), nargs=-1)
 @click.pass_obj
-def artifact_delete(app, artifacts, deps):
-    """Remove artifacts from the local cache"""
+def artifact_delete(app, artifacts, deps, orphans):
+    """Remove artifacts from the local cache
+
+    With `--orphans`, the artifacts and cached sources which are no longer
+    complete because their contents were evicted from the local cache are
+    removed as well. In that case, the default targets are not removed when
+    no ARTIFACTS are given.
+    """
     with app.initialized():
-        app.stream.artifact_delete(artifacts, selection=deps)
+        app.stream.artifact_delete(artifacts, selection=deps, orphans=orphans)
 
 
 ##################################################################
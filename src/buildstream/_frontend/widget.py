@@ -340,32 +340,36 @@ class LogLine(Widget):
         for element in dependencies:
             line = format_
 
-            full_key, cache_key, dim_keys = element._get_display_key()
-
             line = p.fmt_subst(line, "name", element._get_full_name(), fg="blue", bold=True)
-            line = p.fmt_subst(line, "key", cache_key, fg="yellow", dim=dim_keys)
-            line = p.fmt_subst(line, "full-key", full_key, fg="yellow", dim=dim_keys)
 
-            try:
-                if not element._has_all_sources_resolved():
-                    line = p.fmt_subst(line, "state", "no reference", fg="red")
-                else:
-                    if element.get_kind() == "junction":
-                        line = p.fmt_subst(line, "state", "junction", fg="magenta")
-                    elif element._cached_failure():
-                        line = p.fmt_subst(line, "state", "failed", fg="red")
-                    elif element._cached_success():
-                        line = p.fmt_subst(line, "state", "cached", fg="magenta")
-                    elif element._fetch_needed():
-                        line = p.fmt_subst(line, "state", "fetch needed", fg="red")
-                    elif element._buildable():
-                        line = p.fmt_subst(line, "state", "buildable", fg="green")
+            # In non-strict mode, the cache keys depend on the cached state
+            if "%{key" in format_ or "%{full-key" in format_:
+                full_key, cache_key, dim_keys = element._get_display_key()
+                line = p.fmt_subst(line, "key", cache_key, fg="yellow", dim=dim_keys)
+                line = p.fmt_subst(line, "full-key", full_key, fg="yellow", dim=dim_keys)
+
+            # Element state
+            if "%{state" in format_:
+                try:
+                    if not element._has_all_sources_resolved():
+                        line = p.fmt_subst(line, "state", "no reference", fg="red")
                     else:
-                        line = p.fmt_subst(line, "state", "waiting", fg="blue")
-            except BstError as e:
-                # Provide context to plugin error
-                e.args = ("Failed to determine state for {}: {}".format(element._get_full_name(), str(e)),)
-                raise e
+                        if element.get_kind() == "junction":
+                            line = p.fmt_subst(line, "state", "junction", fg="magenta")
+                        elif element._cached_failure():
+                            line = p.fmt_subst(line, "state", "failed", fg="red")
+                        elif element._cached_success():
+                            line = p.fmt_subst(line, "state", "cached", fg="magenta")
+                        elif element._fetch_needed():
+                            line = p.fmt_subst(line, "state", "fetch needed", fg="red")
+                        elif element._buildable():
+                            line = p.fmt_subst(line, "state", "buildable", fg="green")
+                        else:
+                            line = p.fmt_subst(line, "state", "waiting", fg="blue")
+                except BstError as e:
+                    # Provide context to plugin error
+                    e.args = ("Failed to determine state for {}: {}".format(element._get_full_name(), str(e)),)
+                    raise e
 
             # Element configuration
             if "%{config" in format_:
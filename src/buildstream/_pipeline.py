@@ -26,6 +26,7 @@ from collections import OrderedDict
 
 from pyroaring import BitMap  # pylint: disable=no-name-in-module
 
+from ._artifact import Artifact
 from ._exceptions import PipelineError
 from ._message import Message, MessageType
 from ._profile import Topics, PROFILER
@@ -100,8 +101,10 @@ class Pipeline:
     #
     # Args:
     #    targets (list of Element): The list of toplevel element targets
+    #    query_cache (bool): Whether to query the cache for the artifact state,
+    #                        otherwise only cache keys are resolved
     #
-    def resolve_elements(self, targets):
+    def resolve_elements(self, targets, *, query_cache=True):
         with self._context.messenger.simple_task("Resolving cached state", silent_nested=True) as task:
             # We need to go through the project to access the loader
             if task:
@@ -112,9 +115,25 @@ class Pipeline:
             # to happen, even for large projects (tested with the Debian stack). Although,
             # if it does become a problem we may have to set the recursion limit to a
             # greater value.
-            for element in self.dependencies(targets, _Scope.ALL):
+            elements = list(self.dependencies(targets, _Scope.ALL))
+
+            # Calculate the cache keys first, deferring the artifact state
+            # which requires querying the local cache.
+            for element in elements:
+                element._initialize_state(defer_artifact_state=True)
+
+            if not query_cache:
+                # The artifact state is completed on first access
+                if task:
+                    task.set_current_progress(len(elements))
+                return
+
+            # Query the local cache for all artifacts at once
+            Artifact.query_cached([artifact for element in elements for artifact in element._get_deferred_artifacts()])
+
+            for element in elements:
                 # Determine initial element state.
-                element._initialize_state()
+                element._update_deferred_artifact_state()
 
                 # We may already have Elements which are cached and have their runtimes
                 # cached, if this is the case, we should immediately notify their reverse
@@ -135,8 +154,44 @@ class Pipeline:
         with self._context.messenger.simple_task("Querying remotes for cached status", silent_nested=True) as task:
             task.set_maximum_progress(len(targets))
 
-            for element in targets:
-                element._cached_remotely()
+            queries = [(element._get_project(), [element.get_artifact_name()]) for element in targets]
+            results = self._artifacts.check_remotes_for_artifacts(queries)
+
+            for element, cached in zip(targets, results):
+                if cached is not None:
+                    element._set_cached_remotely(cached)
+
+                task.add_current_progress()
+
+    # check_remotes_for_pull()
+    #
+    # Check which of the artifacts to be pulled for the given elements
+    # are available in the remotes, so that no pull jobs are scheduled
+    # for artifacts which are not. The user is notified of the artifacts
+    # which are not available.
+    #
+    # Args:
+    #    elements (list [Element]): The list of elements to be pulled
+    #
+    def check_remotes_for_pull(self, elements):
+        elements = [element for element in elements if element._can_query_cache() and element._pull_pending()]
+        if not elements:
+            return
+
+        with self._context.messenger.simple_task("Querying remotes for artifacts to pull", silent_nested=True) as task:
+            task.set_maximum_progress(len(elements))
+
+            def on_missing(index, remote):
+                element = elements[index]
+                _, display_key, _ = element._get_display_key()
+                element.info("Remote ({}) does not have artifact {} cached".format(remote, display_key))
+
+            queries = [(element._get_project(), element._get_pull_artifact_names()) for element in elements]
+            results = self._artifacts.check_remotes_for_artifacts(queries, on_missing=on_missing)
+
+            for element, available in zip(elements, results):
+                if available is not None:
+                    element._set_pull_available(available)
 
                 task.add_current_progress()
 
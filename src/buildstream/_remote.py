@@ -16,6 +16,8 @@
 #
 
 import os
+import queue
+import threading
 from collections import namedtuple
 from urllib.parse import urlparse
 
@@ -39,11 +41,77 @@ class RemoteType(FastEnum):
         return self.name.lower().replace("_", "-")
 
 
+# ConnectionConfig():
+#
+# The settings of the gRPC connection to a remote, any of which may be
+# None to use the gRPC default.
+#
+class ConnectionConfig(
+    namedtuple("ConnectionConfig", "keepalive_time keepalive_timeout max_message_size http2_window_size")
+):
+
+    # new_from_config_node
+    #
+    # Creates a ConnectionConfig() from a YAML loaded node.
+    #
+    # Args:
+    #    node (MappingNode): The `connection-config` node of a remote spec
+    #
+    # Returns:
+    #    (ConnectionConfig) - The described ConnectionConfig instance.
+    #
+    # Raises:
+    #    LoadError: If the node is malformed.
+    #
+    @classmethod
+    def new_from_config_node(cls, node):
+        keys = ["keepalive-time", "keepalive-timeout", "max-message-size", "http2-window-size"]
+        node.validate_keys(keys)
+
+        def get_positive_int(key):
+            value = node.get_int(key, default=None)
+            if value is not None and value <= 0:
+                provenance = node.get_scalar(key).get_provenance()
+                raise LoadError(
+                    "{}: '{}' must be a positive number".format(provenance, key), LoadErrorReason.INVALID_DATA
+                )
+            return value
+
+        return cls(*(get_positive_int(key) for key in keys))
+
+    # channel_options():
+    #
+    # Returns:
+    #    (tuple): The gRPC channel arguments for this configuration
+    #
+    def channel_options(self):
+        options = []
+        if self.keepalive_time is not None:
+            options.append(("grpc.keepalive_time_ms", self.keepalive_time * 1000))
+            # Keep pinging while waiting for long running requests
+            options.append(("grpc.http2.max_pings_without_data", 0))
+        if self.keepalive_timeout is not None:
+            options.append(("grpc.keepalive_timeout_ms", self.keepalive_timeout * 1000))
+        if self.max_message_size is not None:
+            options.append(("grpc.max_send_message_length", self.max_message_size))
+            options.append(("grpc.max_receive_message_length", self.max_message_size))
+        if self.http2_window_size is not None:
+            # Use a fixed window instead of estimating the bandwidth-delay product
+            options.append(("grpc.http2.lookahead_bytes", self.http2_window_size))
+            options.append(("grpc.http2.bdp_probe", 0))
+        return tuple(options)
+
+
+ConnectionConfig.__new__.__defaults__ = (None, None, None, None)  # type: ignore
+
+
 # RemoteSpec():
 #
 # Defines the basic structure of a remote specification.
 #
-class RemoteSpec(namedtuple("RemoteSpec", "url push server_cert client_key client_cert instance_name type")):
+class RemoteSpec(
+    namedtuple("RemoteSpec", "url push server_cert client_key client_cert instance_name type connection_config")
+):
 
     # new_from_config_node
     #
@@ -61,7 +129,9 @@ class RemoteSpec(namedtuple("RemoteSpec", "url push server_cert client_key clien
     #
     @classmethod
     def new_from_config_node(cls, spec_node, basedir=None):
-        spec_node.validate_keys(["url", "push", "server-cert", "client-key", "client-cert", "instance-name", "type"])
+        spec_node.validate_keys(
+            ["url", "push", "server-cert", "client-key", "client-cert", "instance-name", "type", "connection-config"]
+        )
 
         url = spec_node.get_str("url")
         if not url:
@@ -98,7 +168,12 @@ class RemoteSpec(namedtuple("RemoteSpec", "url push server_cert client_key clien
 
         type_ = spec_node.get_enum("type", RemoteType, default=RemoteType.ALL)
 
-        return cls(url, push, server_cert, client_key, client_cert, instance_name, type_)
+        connection_config = None
+        connection_node = spec_node.get_mapping("connection-config", default=None)
+        if connection_node is not None:
+            connection_config = ConnectionConfig.new_from_config_node(connection_node)
+
+        return cls(url, push, server_cert, client_key, client_cert, instance_name, type_, connection_config)
 
 
 # FIXME: This can be made much nicer in python 3.7 through the use of
@@ -116,15 +191,97 @@ RemoteSpec.__new__.__defaults__ = (  # type: ignore
     None,  # client_cert    - The (public) client certificate
     None,  # instance_name  - The (grpc) instance name of the remote
     RemoteType.ALL,  # type           - The type of the remote (index, storage, both)
+    None,  # connection_config - The ConnectionConfig of the gRPC channel
 )
 
 
+# _ChannelPool():
+#
+# Shares gRPC channels between the remotes of a single process, so that
+# remotes for the same server, such as the artifact and source caches,
+# use a single connection and TLS handshake.
+#
+# Channels are keyed by their target, credentials and channel options,
+# and closed when the last remote using them is closed. As gRPC channels
+# cannot be used across fork, the remotes of the main process are closed
+# before jobs are started, see Context.prepare_fork(), and channels
+# inherited by a forked process are never handed out. Channels are thus
+# not reused across jobs, each job opens its own.
+#
+class _ChannelPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._pid = os.getpid()
+
+    # acquire():
+    #
+    # Get a channel, creating it if no remote is using it yet.
+    #
+    # Args:
+    #    key (tuple): The scheme, target, server certificate, client key,
+    #                 client certificate and channel options
+    #
+    # Returns:
+    #    (grpc.Channel): The channel
+    #
+    def acquire(self, key):
+        with self._lock:
+            self._check_pid()
+            entry = self._channels.get(key)
+            if entry is None:
+                entry = self._channels[key] = [self._create_channel(*key), 0]
+            entry[1] += 1
+            return entry[0]
+
+    # release():
+    #
+    # Release a channel obtained from acquire(), closing it once it is
+    # no longer used.
+    #
+    # Args:
+    #    key (tuple): The key passed to acquire()
+    #
+    def release(self, key):
+        with self._lock:
+            self._check_pid()
+            entry = self._channels.get(key)
+            if entry is None:
+                # Acquired before fork
+                return
+
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._channels[key]
+                entry[0].close()
+
+    # Forget the channels of the parent process after fork
+    def _check_pid(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            self._channels = {}
+            self._pid = pid
+
+    def _create_channel(self, scheme, target, server_cert, client_key, client_cert, options):
+        if scheme == "http":
+            return grpc.insecure_channel(target, options=options)
+
+        credentials = grpc.ssl_channel_credentials(
+            root_certificates=server_cert, private_key=client_key, certificate_chain=client_cert
+        )
+        return grpc.secure_channel(target, credentials, options=options)
+
+
+_channel_pool = _ChannelPool()
+
+
 # BaseRemote():
 #
 # Provides the basic functionality required to set up remote
 # interaction via GRPC. In particular, this will set up a
 # grpc.insecure_channel, or a grpc.secure_channel, based on the given
-# spec.
+# spec. Remotes with the same server, credentials and connection
+# configuration share their channel.
 #
 # Customization for the particular protocol is expected to be
 # performed in children.
@@ -132,11 +289,16 @@ RemoteSpec.__new__.__defaults__ = (  # type: ignore
 class BaseRemote:
     key_name = None
 
+    # Whether the remote is accessed through its own gRPC channel, rather
+    # than only through buildbox-casd
+    requires_channel = True
+
     def __init__(self, spec):
         self.spec = spec
         self._initialized = False
 
         self.channel = None
+        self._channel_key = None
 
         self.server_cert = None
         self.client_key = None
@@ -159,7 +321,6 @@ class BaseRemote:
         url = urlparse(self.spec.url)
         if url.scheme == "http":
             port = url.port or 80
-            self.channel = grpc.insecure_channel("{}:{}".format(url.hostname, port))
         elif url.scheme == "https":
             port = url.port or 443
             try:
@@ -171,13 +332,24 @@ class BaseRemote:
             self.server_cert = server_cert
             self.client_key = client_key
             self.client_cert = client_cert
-            credentials = grpc.ssl_channel_credentials(
-                root_certificates=self.server_cert, private_key=self.client_key, certificate_chain=self.client_cert
-            )
-            self.channel = grpc.secure_channel("{}:{}".format(url.hostname, port), credentials)
         else:
             raise RemoteError("Unsupported URL: {}".format(self.spec.url))
 
+        if self.requires_channel:
+            options = ()
+            if self.spec.connection_config:
+                options = self.spec.connection_config.channel_options()
+
+            self._channel_key = (
+                url.scheme,
+                "{}:{}".format(url.hostname, port),
+                self.server_cert,
+                self.client_key,
+                self.client_cert,
+                options,
+            )
+            self.channel = _channel_pool.acquire(self._channel_key)
+
         self._configure_protocols()
 
         self._initialized = True
@@ -191,8 +363,9 @@ class BaseRemote:
 
     def close(self):
         if self.channel:
-            self.channel.close()
+            _channel_pool.release(self._channel_key)
             self.channel = None
+            self._channel_key = None
 
         self._initialized = False
 
@@ -246,6 +419,51 @@ class BaseRemote:
         return self.url
 
 
+# completed_futures():
+#
+# Wait for gRPC futures to complete, yielding them in order of
+# completion.
+#
+# Futures which complete before the caller asks for the next result
+# are yielded together, sorted by their position in `futures`. This
+# allows callers racing several remotes to use the configured remote
+# order as a tie-breaker.
+#
+# Any futures which are still pending when the caller stops iterating
+# are cancelled.
+#
+# Args:
+#    futures (list): The gRPC futures to wait for
+#
+# Yields:
+#    (list of int): Indices into `futures` of the newly completed futures
+#
+def completed_futures(futures):
+    completed = queue.Queue()
+
+    def on_done(index):
+        return lambda _: completed.put(index)
+
+    for index, future in enumerate(futures):
+        future.add_done_callback(on_done(index))
+
+    remaining = len(futures)
+    try:
+        while remaining:
+            indices = [completed.get()]
+            while True:
+                try:
+                    indices.append(completed.get_nowait())
+                except queue.Empty:
+                    break
+
+            remaining -= len(indices)
+            yield sorted(indices)
+    finally:
+        for future in futures:
+            future.cancel()
+
+
 # _read_files():
 #
 # A helper method to read a bunch of files, ignoring any input
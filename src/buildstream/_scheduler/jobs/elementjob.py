@@ -100,3 +100,49 @@ class ChildElementJob(ChildJob):
             data["workspace"] = workspace.to_dict()
 
         return data
+
+
+# ElementBatchJob()
+#
+# A job to run a command for many elements at once. When this job is
+# started `action_cb` will be called with the list of elements, and when
+# it completes `complete_cb` will be called.
+#
+# Args:
+#    scheduler (Scheduler): The scheduler
+#    action_name (str): The queue action name
+#    logfile (str): The logfile
+#    elements (list [Element]): The elements to work on
+#    queue (Queue): The queue which created the job
+#    action_cb (callable): The function to execute on the child, called with
+#                          the list of elements and returning a simple
+#                          serializable object, see ElementJob
+#    complete_cb (callable): The function to execute when the job completes,
+#                            called with the job, the list of elements, the
+#                            JobStatus and the result of `action_cb`
+#    kwargs: Remaining Job() constructor arguments
+#
+class ElementBatchJob(Job):
+    def __init__(self, *args, elements, queue, action_cb, complete_cb, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_name("{} elements".format(len(elements)))
+        self.queue = queue
+        self._elements = elements
+        self._action_cb = action_cb
+        self._complete_cb = complete_cb
+
+    def parent_complete(self, status, result):
+        self._complete_cb(self, self._elements, status, self._result)
+
+    def create_child_job(self, *args, **kwargs):
+        return ChildElementBatchJob(*args, elements=self._elements, action_cb=self._action_cb, **kwargs)
+
+
+class ChildElementBatchJob(ChildJob):
+    def __init__(self, *args, elements, action_cb, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._elements = elements
+        self._action_cb = action_cb
+
+    def child_process(self):
+        return self._action_cb(self._elements)
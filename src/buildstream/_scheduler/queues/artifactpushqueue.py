@@ -20,12 +20,22 @@
 
 # Local imports
 from . import Queue, QueueStatus
+from ..jobs import ElementBatchJob, JobStatus
 from ..resources import ResourceType
 from ..._exceptions import SkipJob
+from ..._message import MessageType
+
+# Maximum number of artifacts whose references are pushed together
+_MAX_REFERENCE_BATCH = 256
 
 
 # A queue which pushes element artifacts
 #
+# If the `push-batch-window` scheduler configuration is set, the push
+# jobs only upload the blobs of the artifacts. The references of the
+# artifacts completed within the window are then pushed to the remotes
+# together by a single job.
+#
 class ArtifactPushQueue(Queue):
 
     action_name = "Push"
@@ -36,8 +46,14 @@ class ArtifactPushQueue(Queue):
         super().__init__(scheduler)
 
         self._skip_uncached = skip_uncached
+        self._batch_window = scheduler.context.sched_push_batch_window
+        self._pending_references = []  # Elements whose references are yet to be pushed
+        self._flush_handle = None  # The timer of the batch window
+        self._flush_ready = False  # Whether the pending references are ready to be pushed
 
     def get_process_func(self):
+        if self._batch_window:
+            return ArtifactPushQueue._push_blobs_or_skip
         return ArtifactPushQueue._push_or_skip
 
     def status(self, element):
@@ -46,7 +62,88 @@ class ArtifactPushQueue(Queue):
 
         return QueueStatus.READY
 
+    def done(self, _, element, result, status):
+        if not self._batch_window or status is not JobStatus.OK:
+            return
+
+        self._pending_references.append(element)
+        if len(self._pending_references) >= _MAX_REFERENCE_BATCH:
+            # The scheduler harvests jobs once this job is done
+            self._flush_ready = True
+        elif self._flush_handle is None:
+            self._flush_handle = self._scheduler.loop.call_later(self._batch_window, self._window_elapsed)
+
+    def harvest_jobs(self):
+        jobs = []
+        if self._flush_ready and self._resources.reserve(self.resources):
+            jobs.append(self._create_reference_job())
+
+        return jobs + super().harvest_jobs()
+
+    def flush(self):
+        if not self._pending_references or not self._resources.reserve(self.resources):
+            return []
+
+        return [self._create_reference_job()]
+
+    # Create a job pushing the pending references, the resources must
+    # be reserved.
+    def _create_reference_job(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        elements = self._pending_references[:_MAX_REFERENCE_BATCH]
+        self._pending_references = self._pending_references[_MAX_REFERENCE_BATCH:]
+        self._flush_ready = len(self._pending_references) >= _MAX_REFERENCE_BATCH
+        if self._pending_references and not self._flush_ready:
+            self._flush_handle = self._scheduler.loop.call_later(self._batch_window, self._window_elapsed)
+
+        return ElementBatchJob(
+            self._scheduler,
+            self.action_name,
+            "push-references",
+            elements=elements,
+            queue=self,
+            action_cb=ArtifactPushQueue._push_references,
+            complete_cb=self._reference_job_done,
+            max_retries=self._max_retries,
+        )
+
+    def _window_elapsed(self):
+        self._flush_handle = None
+        self._flush_ready = True
+        self._scheduler.reschedule()
+
+    def _reference_job_done(self, job, elements, status, result):
+        self._resources.release(self.resources)
+        if job.get_terminated():
+            return
+
+        if status is JobStatus.OK:
+            failed = dict(result)
+        else:
+            failed = {element._get_full_name(): "Failed to push artifact references" for element in elements}
+
+        for element in elements:
+            error = failed.get(element._get_full_name())
+            if error is not None:
+                self._message(element, MessageType.ERROR, "Failed to push artifact", detail=error)
+                self._task_group.add_failed_task(element._get_full_name())
+
     @staticmethod
     def _push_or_skip(element):
         if not element._push():
             raise SkipJob(ArtifactPushQueue.action_name)
+
+    @staticmethod
+    def _push_blobs_or_skip(element):
+        if not element._push(push_references=False):
+            raise SkipJob(ArtifactPushQueue.action_name)
+
+    # Returns the names of the elements whose references could not be
+    # pushed, with the error
+    @staticmethod
+    def _push_references(elements):
+        artifacts = elements[0]._get_context().artifactcache
+        return [(element._get_full_name(), str(error)) for element, error in artifacts.push_references(elements)]
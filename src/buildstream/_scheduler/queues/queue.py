@@ -164,6 +164,18 @@ class Queue:
     def register_pending_element(self, element):
         raise ImplError("Queue type: {} does not implement register_pending_element()".format(self.action_name))
 
+    # flush()
+    #
+    # Virtual method for completing any work which the queue deferred
+    # past the completion of its jobs, called when the scheduler runs
+    # out of jobs, unless it was terminated.
+    #
+    # Returns:
+    #     ([Job]): A list of jobs completing the deferred work
+    #
+    def flush(self):
+        return []
+
     #####################################################
     #          Scheduler / Pipeline facing APIs         #
     #####################################################
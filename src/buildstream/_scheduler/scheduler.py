@@ -138,24 +138,38 @@ class Scheduler:
         # Handle unix signals while running
         self._connect_signals()
 
-        # Watch casd while running to ensure it doesn't die
+        # Watch casd while running to ensure it doesn't die, a shared
+        # casd is not a child process and cannot be watched.
         self._casd_process = casd_process_manager.process
         _watcher = asyncio.get_child_watcher()
 
         def abort_casd(pid, returncode):
             asyncio.get_event_loop().call_soon(self._abort_on_casd_failure, pid, returncode)
 
-        _watcher.add_child_handler(self._casd_process.pid, abort_casd)
+        if self._casd_process:
+            _watcher.add_child_handler(self._casd_process.pid, abort_casd)
 
         # Start the profiler
         with PROFILER.profile(Topics.SCHEDULER, "_".join(queue.action_name for queue in self.queues)):
             # Run the queues
             self._sched()
             self.loop.run_forever()
+
+            # Complete the work deferred by the queues
+            while not self.terminated:
+                jobs = [job for queue in self.queues for job in queue.flush()]
+                if not jobs:
+                    break
+
+                self._start_jobs(jobs)
+                if self._active_jobs:
+                    self.loop.run_forever()
+
             self.loop.close()
 
         # Stop watching casd
-        _watcher.remove_child_handler(self._casd_process.pid)
+        if self._casd_process:
+            _watcher.remove_child_handler(self._casd_process.pid)
         self._casd_process = None
 
         # Stop handling unix signals
@@ -238,6 +252,14 @@ class Scheduler:
     def stop(self):
         self._queue_jobs = False
 
+    # reschedule()
+    #
+    # Ask the queues for jobs again, for queues whose jobs become ready
+    # without any job completing.
+    #
+    def reschedule(self):
+        self._sched()
+
     # job_completed():
     #
     # Called when a Job completes
@@ -348,6 +370,16 @@ class Scheduler:
             # If that happens, do another round.
             process_queues = any(q.dequeue_ready() for q in self.queues)
 
+        self._start_jobs(ready)
+
+    # _start_jobs()
+    #
+    # Spawns jobs, if forking is allowed
+    #
+    # Args:
+    #    jobs (list): The jobs to start
+    #
+    def _start_jobs(self, jobs):
         # Make sure fork is allowed before starting jobs
         if not self.context.prepare_fork():
             message = Message(MessageType.BUG, "Fork is not allowed", detail="Background threads are active")
@@ -357,7 +389,7 @@ class Scheduler:
 
         # Start the jobs
         #
-        for job in ready:
+        for job in jobs:
             self._start_job(job)
 
     # _sched()
@@ -145,10 +145,7 @@ class SourceCache(AssetCache):
                 source.status("Pulling data for source {} <- {}".format(display_key, remote))
 
                 # Fetch source blobs
-                self.cas._fetch_directory(remote, source_digest)
-                required_blobs = self.cas.required_blobs_for_directory(source_digest)
-                missing_blobs = self.cas.local_missing_blobs(required_blobs)
-                self.cas.fetch_blobs(remote, missing_blobs)
+                self.cas._fetch_trees(remote, [source_digest])
 
                 source.info("Pulled source {} <- {}".format(display_key, remote))
                 return True
@@ -229,6 +226,24 @@ class SourceCache(AssetCache):
         with utils.save_file_atomic(path, "w+b") as f:
             f.write(proto.SerializeToString())
 
+    # remove_orphans():
+    #
+    # Removes the cached sources whose files were evicted from the local
+    # CAS, and which are therefore not cached anymore.
+    #
+    # Returns:
+    #    (list): The removed refs
+    #
+    def remove_orphans(self):
+        def get_contents(data):
+            source_proto = source_pb2.Source()
+            source_proto.ParseFromString(data)
+            return [(source_proto.files, True)], []
+
+        orphans = self._find_orphaned_refs(self._list_refs(), get_contents)
+        removed, _ = self._remove_refs(orphans)
+        return removed
+
     def _get_source(self, ref):
         path = self._source_path(ref)
         source_proto = source_pb2.Source()
@@ -32,7 +32,7 @@ from collections import deque
 from typing import List, Tuple
 
 from ._artifactelement import verify_artifact_ref, ArtifactElement
-from ._exceptions import StreamError, ImplError, BstError, ArtifactElementError, ArtifactError
+from ._exceptions import StreamError, ImplError, BstError, ArtifactElementError
 from ._message import Message, MessageType
 from ._scheduler import (
     Scheduler,
@@ -139,6 +139,8 @@ class Stream:
     #    selection (_PipelineSelection): The selection mode for the specified targets
     #    except_targets (list of str): Specified targets to except from fetching
     #    use_artifact_config (bool): If artifact remote configs should be loaded
+    #    load_refs (bool): Whether to load artifact refs as targets
+    #    query_cache (bool): Whether to query the cache for the artifact state
     #
     # Returns:
     #    (list of Element): The selected elements
@@ -149,7 +151,8 @@ class Stream:
         selection=_PipelineSelection.NONE,
         except_targets=(),
         use_artifact_config=False,
-        load_refs=False
+        load_refs=False,
+        query_cache=True
     ):
         with PROFILER.profile(Topics.LOAD_SELECTION, "_".join(t.replace(os.sep, "-") for t in targets)):
             target_objects = self._load(
@@ -158,6 +161,7 @@ class Stream:
                 except_targets=except_targets,
                 use_artifact_config=use_artifact_config,
                 load_refs=load_refs,
+                query_cache=query_cache,
             )
 
             return target_objects
@@ -288,12 +292,21 @@ class Stream:
                 scope = _Scope.ALL if selection == _PipelineSelection.ALL else _Scope.RUN
                 for element in self.targets:
                     element._set_artifact_files_required(scope=scope)
+        elif self._context.pull_files_on_demand:
+            # Require artifact files only for target elements and their runtime dependencies,
+            # the files of other artifacts are pulled when they are staged.
+            self._context.set_artifact_files_optional()
+
+            scope = _Scope.ALL if selection == _PipelineSelection.ALL else _Scope.RUN
+            for element in self.targets:
+                element._set_artifact_files_required(scope=scope)
 
         # Now construct the queues
         #
         self._scheduler.clear_queues()
 
         if self._artifacts.has_fetch_remotes():
+            self._pipeline.check_remotes_for_pull(elements)
             self._add_queue(PullQueue(self._scheduler))
 
         self._add_queue(FetchQueue(self._scheduler, skip_cached=True))
@@ -442,11 +455,69 @@ class Stream:
             raise StreamError("No artifact caches available for pulling artifacts")
 
         self._pipeline.assert_consistent(elements)
+        self._pipeline.check_remotes_for_pull(elements)
         self._scheduler.clear_queues()
         self._add_queue(PullQueue(self._scheduler))
         self._enqueue_plan(elements)
         self._run(announce_session=True)
 
+    # prefetch()
+    #
+    # Pulls all artifacts of the selected elements which are missing
+    # locally at once, to warm the local cache before a build.
+    #
+    # Unlike pull(), this does not schedule a job per element, the remotes
+    # are queried for all artifacts in bulk and their contents are fetched
+    # together.
+    #
+    # Args:
+    #    targets (list of str): Targets to prefetch
+    #    selection (_PipelineSelection): The selection mode for the specified targets
+    #    ignore_junction_targets (bool): Whether junction targets should be filtered out
+    #    remote (str): The URL of a specific remote server to pull from, or None
+    #    sources (bool): Whether to fetch the sources of elements whose artifacts
+    #                    are not available
+    #
+    def prefetch(
+        self, targets, *, selection=_PipelineSelection.ALL, ignore_junction_targets=False, remote=None, sources=False
+    ):
+
+        use_config = True
+        if remote:
+            use_config = False
+
+        elements = self._load(
+            targets,
+            selection=selection,
+            ignore_junction_targets=ignore_junction_targets,
+            use_artifact_config=use_config,
+            use_source_config=sources,
+            artifact_remote_url=remote,
+        )
+
+        if not self._artifacts.has_fetch_remotes():
+            raise StreamError("No artifact caches available for pulling artifacts")
+
+        self._pipeline.assert_consistent(elements)
+
+        pending = [element for element in elements if element._can_query_cache() and element._pull_pending()]
+        with self._context.messenger.timed_activity("Prefetching {} artifacts".format(len(pending))):
+            pulled = self._artifacts.prefetch(pending, pull_buildtrees=self._context.pull_buildtrees)
+
+        for element in pending:
+            element._pull_done()
+
+        self._message(
+            MessageType.INFO,
+            "Prefetched {} artifacts, {} not available".format(len(pulled), len(pending) - len(pulled)),
+        )
+
+        if sources:
+            self._scheduler.clear_queues()
+            self._add_queue(FetchQueue(self._scheduler, skip_cached=True))
+            self._enqueue_plan(elements)
+            self._run(announce_session=True)
+
     # push()
     #
     # Pulls artifacts to remote artifact server(s)
@@ -682,8 +753,27 @@ class Stream:
     #
     # Args:
     #    targets (str): Targets to remove
+    #    selection (_PipelineSelection): The selection mode for the specified targets
+    #    orphans (bool): Whether to remove the artifacts and sources whose contents
+    #                    were evicted from the local CAS, targets are only loaded if
+    #                    specified in that case
+    #
+    def artifact_delete(self, targets, *, selection=_PipelineSelection.NONE, orphans=False):
+        if targets or not orphans:
+            self._delete_artifacts(targets, selection)
+
+        if orphans:
+            self._delete_orphans()
+
+    # _delete_artifacts()
+    #
+    # Remove the artifacts of targets from the local cache in one pass
+    #
+    # Args:
+    #    targets (str): Targets to remove
+    #    selection (_PipelineSelection): The selection mode for the specified targets
     #
-    def artifact_delete(self, targets, *, selection=_PipelineSelection.NONE):
+    def _delete_artifacts(self, targets, selection):
         # Return list of Element and/or ArtifactElement objects
         target_objects = self.load_selection(targets, selection=selection, load_refs=True)
 
@@ -695,20 +785,32 @@ class Stream:
                 key = obj._get_cache_key(strength=key_strength)
                 remove_refs.add(obj.get_artifact_name(key=key))
 
-        ref_removed = False
-        for ref in remove_refs:
-            try:
-                self._artifacts.remove(ref)
-            except ArtifactError as e:
-                self._message(MessageType.WARN, str(e))
-                continue
+        removed, failed = self._artifacts.remove_artifacts(remove_refs)
 
+        for _, e in failed:
+            self._message(MessageType.WARN, str(e))
+
+        for ref in removed:
             self._message(MessageType.INFO, "Removed: {}".format(ref))
-            ref_removed = True
 
-        if not ref_removed:
+        if not removed:
             self._message(MessageType.INFO, "No artifacts were removed")
 
+    # _delete_orphans()
+    #
+    # Remove the artifacts and sources whose contents were evicted from
+    # the local CAS
+    #
+    def _delete_orphans(self):
+        with self._context.messenger.timed_activity("Removing orphaned artifacts and sources"):
+            artifacts = self._artifacts.remove_orphans()
+            sources = self._sourcecache.remove_orphans() + self._elementsourcescache.remove_orphans()
+
+        self._message(
+            MessageType.INFO,
+            "Removed {} orphaned artifacts and {} orphaned source refs".format(len(artifacts), len(sources)),
+        )
+
     # source_checkout()
     #
     # Checkout sources of the target element to the specified location
@@ -1210,6 +1312,9 @@ class Stream:
     #    use_source_config (bool): Whether to initialize remote source caches with the config
     #    artifact_remote_url (str): A remote url for initializing the artifacts
     #    source_remote_url (str): A remote url for initializing source caches
+    #    dynamic_plan (bool): Require artifacts of the top-level targets only
+    #    load_refs (bool): Whether to load artifact refs as targets
+    #    query_cache (bool): Whether to query the cache for the artifact state
     #
     # Returns:
     #    (list of Element): The primary element selection
@@ -1226,7 +1331,8 @@ class Stream:
         artifact_remote_url=None,
         source_remote_url=None,
         dynamic_plan=False,
-        load_refs=False
+        load_refs=False,
+        query_cache=True
     ):
         elements, except_elements, artifacts = self._load_elements_from_targets(
             targets, except_targets, rewritable=False
@@ -1250,7 +1356,7 @@ class Stream:
 
         # Now move on to loading primary selection.
         #
-        self._pipeline.resolve_elements(self.targets)
+        self._pipeline.resolve_elements(self.targets, query_cache=query_cache)
         selected = self._pipeline.get_selection(self.targets, selection, silent=False)
         selected = self._pipeline.except_elements(self.targets, selected, except_elements)
 
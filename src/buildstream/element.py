@@ -85,6 +85,7 @@ from itertools import chain
 import string
 from typing import cast, TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Set, Sequence
 
+import grpc
 from pyroaring import BitMap  # pylint: disable=no-name-in-module
 from ruamel import yaml
 
@@ -224,7 +225,7 @@ class Element(Plugin):
     ):
 
         self.__cache_key_dict = None  # Dict for cache key calculation
-        self.__cache_key = None  # Our cached cache key
+        self.__cache_key_value = None  # Our cached cache key, see `__cache_key`
 
         super().__init__(load_element.name, context, project, load_element.node, "element")
 
@@ -285,6 +286,7 @@ class Element(Plugin):
         self.__assemble_scheduled = False  # Element is scheduled to be assembled
         self.__assemble_done = False  # Element is assembled
         self.__pull_done = False  # Whether pull was attempted
+        self.__pull_available = None  # Whether the artifact to pull is known to be available remotely
         self.__cached_successfully = None  # If the Element is known to be successfully cached
         self.__splits = None  # Resolved regex objects for computing split domains
         self.__whitelist_regex = None  # Resolved regex object to check if file is allowed to overlap
@@ -293,7 +295,7 @@ class Element(Plugin):
         self.__artifact_files_required = False  # Whether artifact files are required in the local cache
         self.__build_result = None  # The result of assembling this Element (success, description, detail)
         # Artifact class for direct artifact composite interaction
-        self.__artifact = None  # type: Optional[Artifact]
+        self.__artifact_value = None  # type: Optional[Artifact]
 
         self.__batch_prepare_assemble = False  # Whether batching across prepare()/assemble() is configured
         self.__batch_prepare_assemble_flags = 0  # Sandbox flags for batching across prepare()/assemble()
@@ -306,6 +308,8 @@ class Element(Plugin):
         self.__buildable_callback = None  # Callback to BuildQueue
 
         self.__resolved_initial_state = False  # Whether the initial state of the Element has been resolved
+        self.__artifact_state_deferred = False  # Whether updating the artifact state has been deferred
+        self.__deferred_artifacts = None  # Candidate Artifacts for the deferred artifact state
 
         # Ensure we have loaded this class's defaults
         self.__init_defaults(project, plugin_conf, load_element.kind, load_element.first_pass)
@@ -1033,6 +1037,11 @@ class Element(Plugin):
 
         split_filter = self.__split_filter_func(include, exclude, orphans)
 
+        # Artifacts may have been pulled without their file contents,
+        # fetch the contents of the files being staged now
+        if self._get_context().pull_files_on_demand:
+            self.__fetch_staged_files(files_vdir, split_filter)
+
         result = vstagedir.import_files(files_vdir, filter_callback=split_filter, report_written=True, can_link=True)
 
         owner._overlap_collector.collect_stage_result(self, result)
@@ -1224,6 +1233,17 @@ class Element(Plugin):
             self.__cached_remotely = self.__artifacts.check_remotes_for_element(self)
         return self.__cached_remotely
 
+    # _set_cached_remotely():
+    #
+    # Record whether this element is present in a remote cache, as
+    # determined by a bulk query of the remotes.
+    #
+    # Args:
+    #    cached (bool): Whether the element is present in a remote cache
+    #
+    def _set_cached_remotely(self, cached):
+        self.__cached_remotely = cached
+
     # _get_build_result():
     #
     # Returns:
@@ -1379,7 +1399,12 @@ class Element(Plugin):
     # only update what they expect to change - this will ensure that
     # the minimum amount of work is done.
     #
-    def _initialize_state(self):
+    # Args:
+    #    defer_artifact_state (bool): Only calculate the cache keys, the
+    #                                 caller is responsible for calling
+    #                                 `_update_deferred_artifact_state()`
+    #
+    def _initialize_state(self, *, defer_artifact_state=False):
         if self.__resolved_initial_state:
             return
         self.__resolved_initial_state = True
@@ -1391,7 +1416,48 @@ class Element(Plugin):
         # elements recursively initialize anything else (because it
         # will become considered outdated after cache keys are
         # updated).
-        self.__update_cache_keys()
+        self.__update_cache_keys(defer_artifact_state=defer_artifact_state)
+
+    # _get_deferred_artifacts():
+    #
+    # Get the artifacts whose cached state is needed to complete a
+    # deferred artifact state update, this allows the caller to query
+    # the local cache for many elements at once.
+    #
+    # Returns:
+    #    (list): The candidate Artifact objects, empty if the artifact
+    #            state is not deferred
+    #
+    def _get_deferred_artifacts(self):
+        if not self.__artifact_state_deferred:
+            return []
+
+        if self.__deferred_artifacts is None:
+            context = self._get_context()
+
+            artifacts = [Artifact(self, context, strong_key=self.__strict_cache_key, weak_key=self.__weak_cache_key)]
+            if not context.get_strict():
+                artifacts.append(Artifact(self, context, weak_key=self.__weak_cache_key))
+
+            self.__deferred_artifacts = artifacts
+
+        return self.__deferred_artifacts
+
+    # _update_deferred_artifact_state():
+    #
+    # Update the artifact state which was deferred by `_initialize_state()`.
+    #
+    # This is also called on first access of the artifact or the strong
+    # cache key, see `__artifact` and `__cache_key`, for elements whose
+    # state was resolved without querying the cache, in which case the
+    # cache is queried for this element alone.
+    #
+    def _update_deferred_artifact_state(self):
+        if not self.__artifact_state_deferred:
+            return
+
+        self.__artifact_state_deferred = False
+        self.__update_artifact_state()
 
     # _get_display_key():
     #
@@ -1619,6 +1685,11 @@ class Element(Plugin):
     #     bool - Whether the element can be scheduled for a build.
     #
     def __should_schedule(self):
+        # The state of our artifact is not known before the deferred
+        # artifact state is completed, which schedules again
+        if self.__artifact_state_deferred:
+            return False
+
         # We're processing if we're already scheduled, we've
         # finished assembling or if we're waiting to pull.
         processing = self.__assemble_scheduled or self.__assemble_done or self._pull_pending()
@@ -1902,8 +1973,37 @@ class Element(Plugin):
 
         # Pull is pending if artifact remote server available
         # and pull has not been attempted yet
+        if self.__pull_available is False:
+            # No remote has the artifact
+            return False
+
         return self.__artifacts.has_fetch_remotes(plugin=self) and not self.__pull_done
 
+    # _get_pull_artifact_names()
+    #
+    # Returns:
+    #   (list): The names of the artifacts which _pull() may pull
+    #
+    def _get_pull_artifact_names(self):
+        keys = [self.__strict_cache_key]
+        if not self._get_context().get_strict():
+            keys.append(self.__weak_cache_key)
+
+        return [self.get_artifact_name(key) for key in utils._deduplicate(keys)]
+
+    # _set_pull_available()
+    #
+    # Record whether the artifacts returned by _get_pull_artifact_names()
+    # are available in a remote cache, as determined by a bulk query of
+    # the remotes. No pull is attempted for artifacts which are known not
+    # to be available.
+    #
+    # Args:
+    #   available (bool): Whether an artifact is available for pulling
+    #
+    def _set_pull_available(self, available):
+        self.__pull_available = available
+
     # _pull_done()
     #
     # Indicate that pull was attempted.
@@ -1988,6 +2088,9 @@ class Element(Plugin):
                 return True
             if not self._cached_buildtree() and self._buildtree_exists():
                 return True
+            # Artifacts pulled without all their file contents can't be pushed
+            if self._get_context().pull_files_on_demand and not self.__artifact.cached_files():
+                return True
 
         return False
 
@@ -1995,11 +2098,15 @@ class Element(Plugin):
     #
     # Push locally cached artifact to remote artifact repository.
     #
+    # Args:
+    #   push_references (bool): Whether to push the artifact references, see
+    #                           ArtifactCache.push()
+    #
     # Returns:
     #   (bool): True if the remote was updated, False if it already existed
     #           and no updated was required
     #
-    def _push(self):
+    def _push(self, *, push_references=True):
         if not self._cached():
             raise ElementError("Push failed: {} is not cached".format(self.name))
 
@@ -2013,7 +2120,7 @@ class Element(Plugin):
             return False
 
         # Push all keys used for local commit via the Artifact member
-        pushed = self.__artifacts.push(self, self.__artifact)
+        pushed = self.__artifacts.push(self, self.__artifact, push_references=push_references)
         if not pushed:
             return False
 
@@ -2467,6 +2574,41 @@ class Element(Plugin):
     #                   Private Local Methods                   #
     #############################################################
 
+    # __artifact
+    #
+    # The Artifact object of this element.
+    #
+    # The state depending on the cached artifact is completed first if
+    # its update was deferred by `_initialize_state()`, so that it is
+    # never observed half initialized.
+    #
+    @property
+    def __artifact(self):
+        self._update_deferred_artifact_state()
+        return self.__artifact_value
+
+    @__artifact.setter
+    def __artifact(self, artifact):
+        self.__artifact_value = artifact
+
+    # __cache_key
+    #
+    # The strong cache key of this element.
+    #
+    # In non-strict mode this depends on the cached artifact, if it is not
+    # known yet the deferred artifact state is completed first as for
+    # `__artifact`.
+    #
+    @property
+    def __cache_key(self):
+        if self.__cache_key_value is None:
+            self._update_deferred_artifact_state()
+        return self.__cache_key_value
+
+    @__cache_key.setter
+    def __cache_key(self, cache_key):
+        self.__cache_key_value = cache_key
+
     # __get_proxy()
     #
     # Obtain a proxy for this element for the specified `owner`.
@@ -3003,6 +3145,26 @@ class Element(Plugin):
             for domain, rules in splits.items()
         }
 
+    # __fetch_staged_files():
+    #
+    # Fetch the contents of the artifact files passing the split filter
+    # which are missing in the local cache.
+    #
+    # Args:
+    #    files_vdir (Directory): The files of the artifact
+    #    split_filter (callable): The split filter callback, or None
+    #
+    def __fetch_staged_files(self, files_vdir, split_filter):
+        cas = self.__artifacts.cas
+        digests = list(cas.required_files_for_directory(files_vdir._get_digest(), filter_callback=split_filter))
+        missing_blobs = cas.missing_files(digests)
+        if missing_blobs:
+            self.status("Fetching {} missing files of {}".format(len(missing_blobs), self._get_brief_display_key()))
+            try:
+                self.__artifacts.fetch_missing_blobs(self._get_project(), missing_blobs)
+            except (grpc.RpcError, BstError) as e:
+                raise ElementError("Failed to fetch files of artifact {}: {}".format(self.name, e)) from e
+
     # __split_filter():
     #
     # Returns True if the file with the specified `path` is included in the
@@ -3133,7 +3295,10 @@ class Element(Plugin):
     # The strict cache key is a cache key that changes if any dependencies
     # in Scope.BUILD has changed in any way.
     #
-    def __update_cache_keys(self):
+    # Args:
+    #    defer_artifact_state (bool): Whether to defer updating the artifact state
+    #
+    def __update_cache_keys(self, *, defer_artifact_state=False):
         if self.__strict_cache_key is not None:
             # Cache keys already calculated
             assert self.__weak_cache_key is not None
@@ -3185,7 +3350,10 @@ class Element(Plugin):
         # If we've newly calculated a cache key, our artifact's
         # current state will also change - after all, we can now find
         # a potential existing artifact.
-        self.__update_artifact_state()
+        if defer_artifact_state:
+            self.__artifact_state_deferred = True
+        else:
+            self.__update_artifact_state()
 
     # __update_artifact_state()
     #
@@ -3205,9 +3373,16 @@ class Element(Plugin):
 
         context = self._get_context()
 
-        strict_artifact = Artifact(self, context, strong_key=self.__strict_cache_key, weak_key=self.__weak_cache_key)
-        if context.get_strict() or strict_artifact.cached():
-            self.__artifact = strict_artifact
+        # Reuse the candidate artifacts if their cached state was queried in bulk
+        artifacts = self.__deferred_artifacts or [
+            Artifact(self, context, strong_key=self.__strict_cache_key, weak_key=self.__weak_cache_key)
+        ]
+        self.__deferred_artifacts = None
+
+        if context.get_strict() or artifacts[0].cached():
+            self.__artifact = artifacts[0]
+        elif len(artifacts) > 1:
+            self.__artifact = artifacts[1]
         else:
             self.__artifact = Artifact(self, context, weak_key=self.__weak_cache_key)
 
@@ -32,6 +32,7 @@ import signal
 import stat
 from stat import S_ISDIR
 import subprocess
+import sys
 import tempfile
 import time
 import datetime
@@ -75,6 +76,19 @@ _AWAIT_THREADS_TIMEOUT_SECONDS = 5
 _UMASK = os.umask(0o777)
 os.umask(_UMASK)
 
+# The FICLONE ioctl from <linux/fs.h>, which creates a copy-on-write
+# clone (reflink) of a file on filesystems such as btrfs and XFS.
+_FICLONE = 0x40049409
+
+# Errors from FICLONE which mean the file cannot be reflinked and
+# should be copied instead.
+_REFLINK_UNSUPPORTED_ERRNOS = frozenset(
+    (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EPERM)
+)
+
+# Device numbers of filesystems where reflinks have been found not to work
+_REFLINK_UNSUPPORTED_DEVICES = set()
+
 
 class UtilError(BstError):
     """Raised by utility functions when system calls fail.
@@ -378,6 +392,9 @@ def safe_copy(src: str, dest: str, *, copystat: bool = True, result: Optional[Fi
     This is almost the same as shutil.copy2() when copystat is True,
     except that we unlink *dest* before overwriting it if it exists, just
     incase *dest* is a hardlink to a different file.
+
+    If the filesystem supports it, the copy is made as a copy-on-write
+    clone (reflink) of *src*, which avoids copying the file contents.
     """
     # First unlink the target if it exists
     try:
@@ -387,7 +404,8 @@ def safe_copy(src: str, dest: str, *, copystat: bool = True, result: Optional[Fi
             raise UtilError("Failed to remove destination file '{}': {}".format(dest, e)) from e
 
     try:
-        shutil.copyfile(src, dest)
+        if not _reflink_file(src, dest):
+            shutil.copyfile(src, dest)
     except (OSError, shutil.Error) as e:
         raise UtilError("Failed to copy '{} -> {}': {}".format(src, dest, e)) from e
 
@@ -915,6 +933,53 @@ def _remove_path_with_parents(basedir: Union[Path, str], path: Union[Path, str])
         path = os.path.dirname(path)
 
 
+# _reflink_file()
+#
+# Try to create *dest* as a copy-on-write clone of *src* using the
+# FICLONE ioctl.
+#
+# Filesystems found not to support reflinks are remembered, so that
+# subsequent copies from them go straight to a regular copy.
+#
+# Args:
+#    src (str): The source filename
+#    dest (str): The destination filename
+#
+# Returns:
+#    (bool): True if *dest* was reflinked, False if the caller should
+#            fall back to copying the file
+#
+# Raises:
+#    (OSError): If *src* or *dest* could not be opened
+#
+def _reflink_file(src: str, dest: str) -> bool:
+    if sys.platform == "win32":
+        # Windows does not support 'fcntl', the module is unavailable there as
+        # of Python 3.7, therefore always fall back to copying.
+        return False
+
+    import fcntl
+
+    src_dev = os.stat(src).st_dev
+    if src_dev in _REFLINK_UNSUPPORTED_DEVICES:
+        return False
+
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        if os.fstat(fdst.fileno()).st_dev != src_dev:
+            # Reflinks never work across filesystems
+            return False
+
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in _REFLINK_UNSUPPORTED_ERRNOS:
+                raise
+            _REFLINK_UNSUPPORTED_DEVICES.add(src_dev)
+            return False
+
+    return True
+
+
 # Recursively remove directories, ignoring file permissions as much as
 # possible.
 def _force_rmtree(rootpath):
@@ -19,8 +19,11 @@
 # pylint: disable=redefined-outer-name
 
 import os
+import shutil
+
 import pytest
 
+from buildstream import utils
 from buildstream.element import _get_normal_name
 from buildstream.exceptions import ErrorDomain
 from buildstream.testing import cli  # pylint: disable=unused-import
@@ -259,3 +262,58 @@ def test_artifact_delete_artifact_with_deps_all_fails(cli, tmpdir, datafiles):
     result.assert_main_error(ErrorDomain.STREAM, None)
 
     assert "Error: '--deps all' is not supported for artifact refs" in result.stderr
+
+
+# Test that `--orphans` removes the artifacts whose contents were evicted
+# from the local cache, without removing the default targets
+@pytest.mark.datafiles(DATA_DIR)
+def test_artifact_delete_orphans(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    element = "target.bst"
+
+    local_cache = os.path.join(str(tmpdir), "cache")
+    cli.configure({"cachedir": local_cache})
+
+    result = cli.run(project=project, args=["build", element])
+    result.assert_success()
+
+    cache_key = cli.get_element_key(project, element)
+    artifact = os.path.join("test", os.path.splitext(element)[0], cache_key)
+    assert os.path.exists(os.path.join(local_cache, "artifacts", "refs", artifact))
+
+    # Nothing is orphaned while the contents are cached
+    result = cli.run(project=project, args=["artifact", "delete", "--orphans"])
+    result.assert_success()
+    assert os.path.exists(os.path.join(local_cache, "artifacts", "refs", artifact))
+
+    # Evict all contents from the local cache
+    shutil.rmtree(os.path.join(local_cache, "cas"))
+
+    result = cli.run(project=project, args=["artifact", "delete", "--orphans"])
+    result.assert_success()
+    assert not os.path.exists(os.path.join(local_cache, "artifacts", "refs", artifact))
+
+
+# Test that `--orphans` keeps artifacts whose file blobs are missing while
+# their directories are cached, as for artifacts pulled without files
+@pytest.mark.datafiles(DATA_DIR)
+def test_artifact_delete_orphans_without_files(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    element = "import-bin.bst"
+
+    local_cache = os.path.join(str(tmpdir), "cache")
+    cli.configure({"cachedir": local_cache})
+
+    result = cli.run(project=project, args=["build", element])
+    result.assert_success()
+
+    cache_key = cli.get_element_key(project, element)
+    artifact = os.path.join("test", os.path.splitext(element)[0], cache_key)
+
+    # Evict the file blob, keeping the directory objects
+    digest = utils.sha256sum(os.path.join(project, "files", "bin-files", "usr", "bin", "hello"))
+    os.unlink(os.path.join(local_cache, "cas", "objects", digest[:2], digest[2:]))
+
+    result = cli.run(project=project, args=["artifact", "delete", "--orphans"])
+    result.assert_success()
+    assert os.path.exists(os.path.join(local_cache, "artifacts", "refs", artifact))
@@ -53,6 +53,7 @@ ARTIFACT_COMMANDS = [
     "delete ",
     "push ",
     "pull ",
+    "prefetch ",
     "log ",
     "list-contents ",
     "show ",
@@ -0,0 +1,136 @@
+# Pylint doesn't play well with fixtures and dependency injection from pytest
+# pylint: disable=redefined-outer-name
+
+import os
+import shutil
+import pytest
+from buildstream import utils, _yaml
+from buildstream.testing import cli  # pylint: disable=unused-import
+from buildstream.testing import create_repo
+from tests.testutils import create_artifact_share, assert_shared
+
+
+# Project directory
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "project",)
+
+
+# Build the target and push all its artifacts to the share, then delete
+# the local artifact cache
+def _build_and_push(cli, project, share, target, all_elements):
+    cli.configure({"artifacts": {"url": share.repo, "push": True}})
+    result = cli.run(project=project, args=["build", target])
+    result.assert_success()
+
+    for element_name in all_elements:
+        assert_shared(cli, share, project, element_name)
+
+    shutil.rmtree(os.path.join(cli.directory, "cas"))
+    shutil.rmtree(os.path.join(cli.directory, "artifacts"))
+
+    states = cli.get_element_states(project, all_elements)
+    assert not any(states[e] == "cached" for e in all_elements)
+
+
+# Tests that:
+#
+#  * `bst artifact prefetch` pulls the artifacts of the selected dependencies
+#  * The artifacts are pulled without scheduling pull jobs
+#
+@pytest.mark.datafiles(DATA_DIR)
+@pytest.mark.parametrize(
+    "deps, expected_states",
+    [
+        (None, ("cached", "cached", "cached")),
+        ("build", ("buildable", "cached", "buildable")),
+        ("none", ("cached", "buildable", "buildable")),
+        ("run", ("cached", "buildable", "cached")),
+        ("all", ("cached", "cached", "cached")),
+    ],
+)
+def test_prefetch_deps(cli, tmpdir, datafiles, deps, expected_states):
+    project = str(datafiles)
+    target = "checkout-deps.bst"
+    build_dep = "import-dev.bst"
+    runtime_dep = "import-bin.bst"
+    all_elements = [target, build_dep, runtime_dep]
+
+    with create_artifact_share(os.path.join(str(tmpdir), "artifactshare")) as share:
+        _build_and_push(cli, project, share, target, all_elements)
+
+        args = ["artifact", "prefetch"]
+        if deps:
+            args += ["--deps", deps]
+        result = cli.run(project=project, args=args + [target])
+        result.assert_success()
+        assert not result.get_pulled_elements()
+
+        states = cli.get_element_states(project, all_elements)
+        assert (states[target], states[build_dep], states[runtime_dep]) == expected_states
+
+
+# Tests that:
+#
+#  * Artifacts whose blobs are missing from the remote are not pulled
+#  * The other artifacts are still pulled
+#
+@pytest.mark.datafiles(DATA_DIR)
+def test_prefetch_missing_blob(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    all_elements = ["target.bst", "import-bin.bst", "import-dev.bst", "compose-all.bst"]
+
+    with create_artifact_share(os.path.join(str(tmpdir), "artifactshare")) as share:
+        _build_and_push(cli, project, share, "target.bst", all_elements)
+
+        # Delete the blob of the file only imported by import-dev.bst from
+        # the remote, so that the artifacts containing it are incomplete
+        digest = utils.sha256sum(os.path.join(project, "files", "dev-files", "usr", "include", "pony.h"))
+        os.unlink(os.path.join(share.repodir, "cas", "objects", digest[:2], digest[2:]))
+
+        result = cli.run(project=project, args=["artifact", "prefetch", "target.bst"])
+        result.assert_success()
+        assert "Prefetched 2 artifacts, 2 not available" in result.stderr
+
+        states = cli.get_element_states(project, all_elements)
+        assert states["target.bst"] == "cached"
+        assert states["import-bin.bst"] == "cached"
+        assert states["import-dev.bst"] != "cached"
+        assert states["compose-all.bst"] != "cached"
+
+
+# Tests that:
+#
+#  * `bst artifact prefetch --sources` fetches the sources of elements
+#    whose artifacts are not available
+#  * Sources are not fetched without `--sources`
+#
+@pytest.mark.datafiles(DATA_DIR)
+def test_prefetch_sources(cli, tmpdir, datafiles):
+    repo = create_repo("git", str(tmpdir))
+    ref = repo.create(os.path.join(str(datafiles), "files"))
+    element_dir = os.path.join(str(tmpdir), "elements")
+    project = str(tmpdir)
+    project_config = {
+        "name": "prefetch-sources",
+        "min-version": "2.0",
+        "element-path": "elements",
+    }
+    _yaml.roundtrip_dump(project_config, os.path.join(project, "project.conf"))
+    element_config = {
+        "kind": "import",
+        "sources": [repo.source_config(ref=ref)],
+    }
+    element_name = "input.bst"
+    _yaml.roundtrip_dump(element_config, os.path.join(element_dir, element_name))
+
+    with create_artifact_share(os.path.join(str(tmpdir), "artifactshare")) as share:
+        cli.configure({"artifacts": {"url": share.repo}})
+        assert cli.get_element_state(project, element_name) == "fetch needed"
+
+        result = cli.run(project=project, args=["artifact", "prefetch", element_name])
+        result.assert_success()
+        assert "Prefetched 0 artifacts, 1 not available" in result.stderr
+        assert cli.get_element_state(project, element_name) == "fetch needed"
+
+        result = cli.run(project=project, args=["artifact", "prefetch", "--sources", element_name])
+        result.assert_success()
+        assert cli.get_element_state(project, element_name) == "buildable"
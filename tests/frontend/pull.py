@@ -383,7 +383,31 @@ def test_pull_missing_notifies_user(caplog, cli, tmpdir, datafiles):
         assert not result.get_pulled_elements(), "No elements should have been pulled since the cache was empty"
 
         assert "INFO    Remote ({}) does not have".format(share.repo) in result.stderr
-        assert "SKIPPED Pull" in result.stderr
+
+
+# Tests that:
+#
+#  * No pull jobs are scheduled for artifacts which the remote doesn't have
+#  * Pull jobs are scheduled for the artifacts which it has
+#
+@pytest.mark.datafiles(DATA_DIR)
+def test_pull_missing_no_jobs(caplog, cli, tmpdir, datafiles):
+    project = str(datafiles)
+    caplog.set_level(1)
+
+    with create_artifact_share(os.path.join(str(tmpdir), "artifactshare")) as share:
+
+        cli.configure({"artifacts": {"url": share.repo, "push": True}})
+        result = cli.run(project=project, args=["build", "import-bin.bst"])
+        result.assert_success()
+        assert_shared(cli, share, project, "import-bin.bst")
+        cli.remove_artifact_from_cache(project, "import-bin.bst")
+
+        result = cli.run(project=project, args=["build", "target.bst"])
+        result.assert_success()
+        assert result.get_pulled_elements() == ["import-bin.bst"]
+        assert result.get_start_order("pull") == ["import-bin.bst"]
+        assert "SKIPPED Pull" not in result.stderr
 
 
 @pytest.mark.datafiles(DATA_DIR)
@@ -504,3 +504,29 @@ def test_strict_dependencies(cli, datafiles, target, expected_state):
     states = cli.get_element_states(project, ["base.bst", target])
     assert states["base.bst"] == "buildable"
     assert states[target] == expected_state
+
+
+# Tests that in non-strict mode, `bst show` reports the strong cache key
+# of the cached artifact, which is reused after a dependency changed
+#
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "strict-depends"))
+def test_show_full_key_non_strict(cli, datafiles):
+    project = str(datafiles)
+    target = "non-strict-depends.bst"
+
+    cli.configure({"projects": {"test": {"strict": False}}})
+    result = cli.run(project=project, silent=True, args=["build", target])
+    result.assert_success()
+    full_key = cli.get_element_key(project, target)
+
+    # The artifact was built with the dependency of the strict build plan
+    cli.configure({"projects": {"test": {"strict": True}}})
+    assert cli.get_element_key(project, target) == full_key
+
+    # Change the cache key of the dependency
+    with open(os.path.join(project, "files", "hello.txt"), "w") as f:
+        f.write("Goodbye")
+
+    assert cli.get_element_key(project, target) != full_key
+    cli.configure({"projects": {"test": {"strict": False}}})
+    assert cli.get_element_key(project, target) == full_key
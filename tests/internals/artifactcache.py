@@ -0,0 +1,140 @@
+import os
+from concurrent.futures import Future
+from unittest.mock import MagicMock
+
+from buildstream._artifactcache import REMOTE_ASSET_ARTIFACT_URN_TEMPLATE, ArtifactCache, _RemoteMissCache
+from buildstream._artifactindex import ArtifactIndex
+from buildstream._exceptions import AssetCacheError
+from buildstream._pipeline import Pipeline
+from buildstream._protos.build.bazel.remote.asset.v1 import remote_asset_pb2
+from buildstream._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildstream._remote import RemoteSpec
+
+
+# A remote which has the given artifacts, or fails all queries
+def _remote(url, artifacts=(), *, failing=False):
+    uris = {REMOTE_ASSET_ARTIFACT_URN_TEMPLATE.format(artifact) for artifact in artifacts}
+
+    def fetch_blob_future(request_uris):
+        future = Future()
+        if failing:
+            future.set_exception(AssetCacheError("unavailable"))
+        elif uris.intersection(request_uris):
+            future.set_result(remote_asset_pb2.FetchBlobResponse(blob_digest=remote_execution_pb2.Digest(hash="a")))
+        else:
+            future.set_result(None)
+        return future
+
+    remote = MagicMock()
+    remote.spec = RemoteSpec(url, push=False)
+    remote.fetch_blob_future.side_effect = fetch_blob_future
+    remote.fetch_blob_result.side_effect = lambda future: future.result()
+    return remote
+
+
+def _artifactcache(tmpdir, remotes):
+    project = MagicMock()
+    artifactcache = ArtifactCache.__new__(ArtifactCache)
+    artifactcache._index_remotes = {project: remotes}
+    artifactcache._remote_misses = _RemoteMissCache(str(tmpdir), 60)
+    artifactcache._message = MagicMock()
+    return artifactcache, project
+
+
+def test_check_remotes_for_artifacts(tmpdir):
+    remote = _remote("https://cache.example.com", ["project/present/0123"])
+    artifactcache, project = _artifactcache(tmpdir, [remote])
+
+    queries = [
+        (project, ["project/present/0123"]),
+        (project, ["project/missing/0123"]),
+        # Alternative names, e.g. the strong and weak keys
+        (project, ["project/missing/0123", "project/present/0123"]),
+    ]
+    missing = []
+    assert artifactcache.check_remotes_for_artifacts(
+        queries, on_missing=lambda index, remote: missing.append((index, remote))
+    ) == [True, False, True]
+    assert remote.fetch_blob_future.call_count == 3
+    assert missing == [(1, remote)]
+
+    # The remote is not queried again for the artifact it doesn't have
+    remote.fetch_blob_future.reset_mock()
+    assert artifactcache.check_remotes_for_artifacts(queries[1:2]) == [False]
+    assert not remote.fetch_blob_future.called
+
+
+def test_check_remotes_for_artifacts_failed_remote(tmpdir):
+    remote = _remote("https://cache.example.com", ["project/present/0123"])
+    failing = _remote("https://mirror.example.com", failing=True)
+    artifactcache, project = _artifactcache(tmpdir, [remote, failing])
+
+    # Whether an artifact is available is unknown if a remote which
+    # may have it could not be queried
+    queries = [(project, ["project/present/0123"]), (project, ["project/missing/0123"])]
+    assert artifactcache.check_remotes_for_artifacts(queries) == [True, None]
+    artifactcache._message.assert_called_once()
+
+    # The failure is not recorded as a miss
+    assert not artifactcache._remote_misses.contains(failing, "project/missing/0123")
+
+
+def test_check_remotes_for_pull():
+    elements = []
+    for name in ["available.bst", "missing.bst", "unknown.bst", "cached.bst"]:
+        element = MagicMock()
+        element._get_pull_artifact_names.return_value = ["project/{}/0123".format(name)]
+        element._pull_pending.return_value = name != "cached.bst"
+        elements.append(element)
+    available, missing, unknown, cached = elements
+
+    artifacts = MagicMock()
+    artifacts.check_remotes_for_artifacts.return_value = [True, False, None]
+    pipeline = Pipeline(MagicMock(), MagicMock(), artifacts)
+    pipeline.check_remotes_for_pull(elements)
+
+    # Elements which don't need to be pulled are not queried
+    queries = artifacts.check_remotes_for_artifacts.call_args[0][0]
+    assert [names for _, names in queries] == [
+        ["project/available.bst/0123"],
+        ["project/missing.bst/0123"],
+        ["project/unknown.bst/0123"],
+    ]
+    assert not cached._set_pull_available.called
+
+    # No pull is attempted for the missing artifact, while the artifact
+    # whose availability is unknown is still pulled
+    available._set_pull_available.assert_called_once_with(True)
+    missing._set_pull_available.assert_called_once_with(False)
+    assert not unknown._set_pull_available.called
+
+
+def test_remove_artifacts(tmpdir):
+    refdir = os.path.join(str(tmpdir), "refs")
+    for ref in ["project/hello/1111", "project/hello/2222"]:
+        os.makedirs(os.path.join(refdir, os.path.dirname(ref)), exist_ok=True)
+        with open(os.path.join(refdir, ref), "wb"):
+            pass
+    # A ref which cannot be unlinked
+    os.makedirs(os.path.join(refdir, "project/hello/3333"))
+
+    artifactcache = ArtifactCache.__new__(ArtifactCache)
+    artifactcache._basedir = refdir
+    artifactcache._index = ArtifactIndex(os.path.join(str(tmpdir), "index.db"), refdir)
+    try:
+        assert [ref for _, ref in artifactcache._index.list_refs()] == [
+            "project/hello/1111",
+            "project/hello/2222",
+            "project/hello/3333",
+        ]
+
+        removed, failed = artifactcache.remove_artifacts(
+            ["project/hello/1111", "project/hello/3333", "project/hello/4444"]
+        )
+        assert removed == ["project/hello/1111"]
+        assert [ref for ref, _ in failed] == ["project/hello/3333", "project/hello/4444"]
+
+        # The ref which could not be removed is still listed
+        assert [ref for _, ref in artifactcache._index.list_refs()] == ["project/hello/2222", "project/hello/3333"]
+    finally:
+        artifactcache._index.close()
@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+
+from buildstream._artifactindex import ArtifactIndex
+
+
+def _write_ref(refdir, ref):
+    path = os.path.join(refdir, ref)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb"):
+        pass
+
+
+def test_artifact_index(tmpdir):
+    refdir = os.path.join(str(tmpdir), "refs")
+    path = os.path.join(str(tmpdir), "index.db")
+
+    # Refs which exist before the index are indexed on first use
+    _write_ref(refdir, "project/hello/1111")
+    index = ArtifactIndex(path, refdir)
+    assert [ref for _, ref in index.list_refs()] == ["project/hello/1111"]
+
+    for ref in ["project/hello/2222", "project/world/3333"]:
+        _write_ref(refdir, ref)
+        index.add([ref], size=42)
+
+    index.touch("project/hello/1111")
+    assert [ref for _, ref in index.list_refs()] == ["project/hello/2222", "project/world/3333", "project/hello/1111"]
+    assert [ref for _, ref in index.list_refs(glob="project/hello/*")] == ["project/hello/2222", "project/hello/1111"]
+    assert [ref for _, ref in index.list_refs(glob="*/world/*")] == ["project/world/3333"]
+    assert index.get_refs(["project/world/3333"])["project/world/3333"][:3] == ("project", "world", "3333")
+    assert index.get_refs(["project/world/3333"])["project/world/3333"][4] == 42
+
+    os.unlink(os.path.join(refdir, "project/world/3333"))
+    os.rmdir(os.path.join(refdir, "project/world"))
+    index.remove(["project/world/3333"])
+    assert [ref for _, ref in index.list_refs(glob="project/w*")] == []
+    index.close()
+
+
+def test_artifact_index_external_changes(tmpdir):
+    refdir = os.path.join(str(tmpdir), "refs")
+    index = ArtifactIndex(os.path.join(str(tmpdir), "index.db"), refdir)
+
+    _write_ref(refdir, "project/hello/1111")
+    index.add(["project/hello/1111"])
+    assert [ref for _, ref in index.list_refs()] == ["project/hello/1111"]
+
+    # Refs added and removed without updating the index are noticed
+    os.unlink(os.path.join(refdir, "project/hello/1111"))
+    _write_ref(refdir, "project/hello/2222")
+    _write_ref(refdir, "other/world/3333")
+    assert [ref for _, ref in index.list_refs(glob="project/hello/*")] == ["project/hello/2222"]
+    assert sorted(ref for _, ref in index.list_refs()) == ["other/world/3333", "project/hello/2222"]
+    index.close()
+
+
+def test_artifact_index_job_touch(tmpdir):
+    refdir = os.path.join(str(tmpdir), "refs")
+    index = ArtifactIndex(os.path.join(str(tmpdir), "index.db"), refdir)
+
+    for ref in ["project/hello/1111", "project/hello/2222"]:
+        _write_ref(refdir, ref)
+        index.add([ref])
+    index.close()
+
+    # Job processes exit without closing the index, their accesses
+    # must not be lost
+    def touch_and_exit():
+        index.touch("project/hello/1111")
+        os._exit(0)
+
+    process = multiprocessing.get_context("fork").Process(target=touch_and_exit)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert [ref for _, ref in index.list_refs()] == ["project/hello/2222", "project/hello/1111"]
+
+    # Accesses pending in the main process are kept when the index is
+    # opened again
+    index.touch("project/hello/2222")
+    index.add(["project/hello/3333"])
+    assert index.list_refs()[-2][1] == "project/hello/2222"
+    index.close()
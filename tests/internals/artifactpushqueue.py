@@ -0,0 +1,194 @@
+import collections
+import time
+from concurrent.futures import Future
+from unittest.mock import MagicMock
+
+import grpc
+import pytest
+
+from buildstream._artifactcache import ArtifactCache
+from buildstream._assetcache import AssetRemote
+from buildstream._exceptions import AssetCacheError
+from buildstream._protos.build.bazel.remote.asset.v1 import remote_asset_pb2
+from buildstream._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildstream._remote import RemoteSpec
+from buildstream._scheduler import ArtifactPushQueue, Scheduler
+from buildstream._scheduler.jobs import JobStatus
+from buildstream._scheduler.queues import artifactpushqueue
+from buildstream._scheduler.resources import ResourceType
+from buildstream._state import State
+
+
+class _RpcError(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+    def details(self):
+        return "unavailable"
+
+
+def _scheduler(window):
+    context = MagicMock(sched_push_batch_window=window, sched_builders=1, sched_fetchers=1, sched_pushers=1)
+    return Scheduler(context, time.time(), State(time.time()), None, lambda: None)
+
+
+def _elements(n):
+    elements = []
+    for i in range(n):
+        element = MagicMock()
+        element._get_full_name.return_value = "element{}.bst".format(i)
+        elements.append(element)
+    return elements
+
+
+def _push_done(queue, elements):
+    for element in elements:
+        queue.done(None, element, None, JobStatus.OK)
+
+
+def test_push_references_window():
+    scheduler = _scheduler(5)
+    scheduler.loop = MagicMock()
+    scheduler.reschedule = MagicMock()
+    queue = ArtifactPushQueue(scheduler)
+    elements = _elements(2)
+
+    # References are gathered until the window elapses
+    _push_done(queue, elements)
+    assert queue.harvest_jobs() == []
+    delay, window_elapsed = scheduler.loop.call_later.call_args[0]
+    assert delay == 5
+    assert scheduler.loop.call_later.call_count == 1
+
+    window_elapsed()
+    scheduler.reschedule.assert_called_once_with()
+    jobs = queue.harvest_jobs()
+    assert [job._elements for job in jobs] == [elements]
+    assert not scheduler.resources.reserve([ResourceType.UPLOAD])
+
+    # The resources are released when the job completes
+    jobs[0]._result = []
+    jobs[0].parent_complete(JobStatus.OK, [])
+    assert scheduler.resources.reserve([ResourceType.UPLOAD])
+    assert not queue.any_failed_elements()
+
+
+def test_push_references_batch_limit():
+    scheduler = _scheduler(5)
+    scheduler.loop = MagicMock()
+    queue = ArtifactPushQueue(scheduler)
+    elements = _elements(artifactpushqueue._MAX_REFERENCE_BATCH + 1)
+
+    # A full batch is pushed without waiting for the window, the
+    # remaining reference waits for a new window
+    _push_done(queue, elements)
+    jobs = queue.harvest_jobs()
+    assert [job._elements for job in jobs] == [elements[:-1]]
+    handle = scheduler.loop.call_later.return_value
+    handle.cancel.assert_called_once_with()
+    assert scheduler.loop.call_later.call_count == 2
+    assert queue.harvest_jobs() == []
+
+    # The remaining reference is pushed when the scheduler runs out of jobs
+    jobs[0]._result = []
+    jobs[0].parent_complete(JobStatus.OK, [])
+    assert [job._elements for job in queue.flush()] == [elements[-1:]]
+    assert queue.flush() == []
+
+
+def test_push_references_failed():
+    scheduler = _scheduler(5)
+    scheduler.loop = MagicMock()
+    queue = ArtifactPushQueue(scheduler)
+    elements = _elements(2)
+
+    _push_done(queue, elements)
+    job = queue.flush()[0]
+    job._result = [("element1.bst", "Failed to push artifact: unavailable")]
+    job.parent_complete(JobStatus.OK, job._result)
+
+    assert queue._task_group.failed_tasks == ["element1.bst"]
+
+
+def test_scheduler_flushes_queues():
+    scheduler = _scheduler(0)
+    queue = MagicMock(action_name="Push")
+    queue.harvest_jobs.return_value = []
+    queue.dequeue.return_value = []
+    queue.dequeue_ready.return_value = False
+    queue.flush.return_value = []
+    queue.any_failed_elements.return_value = False
+
+    scheduler.run([queue], MagicMock(process=None))
+    queue.flush.assert_called_once_with()
+
+    # The deferred work is dropped when the scheduler was terminated
+    def terminate():
+        scheduler.terminated = True
+        return []
+
+    queue.reset_mock()
+    queue.harvest_jobs.side_effect = terminate
+    scheduler.run([queue], MagicMock(process=None))
+    assert queue.harvest_jobs.called
+    assert not queue.flush.called
+
+
+def _future(result=None, exception=None):
+    future = Future()
+    if exception:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+def test_push_references():
+    digest = remote_execution_pb2.Digest(hash="a" * 64, size_bytes=1)
+    elements = _elements(3)
+    remote = MagicMock(push=True)
+    remote.fetch_blob_future.side_effect = lambda uris: _future(
+        remote_asset_pb2.FetchBlobResponse(blob_digest=digest) if uris == ["element0.bst"] else None
+    )
+    remote.fetch_blob_result.side_effect = lambda future: future.result()
+    remote.push_blob_future.side_effect = lambda uris, *args, **kwargs: _future(
+        exception=AssetCacheError("unavailable") if uris == ["element2.bst"] else None
+    )
+    remote.push_blob_result.side_effect = lambda future: future.result()
+
+    artifactcache = MagicMock()
+    artifactcache.cas.add_object.return_value = digest
+    artifactcache._index_remotes = collections.defaultdict(lambda: [remote])
+    artifactcache._artifact_reference.side_effect = lambda element, proto: (
+        [element._get_full_name()],
+        [element._get_full_name()],
+        [],
+        [],
+    )
+
+    # The artifact already on the remote is not pushed again
+    failed = ArtifactCache.push_references(artifactcache, elements)
+    assert [call[0][0] for call in remote.fetch_blob_future.call_args_list] == [
+        ["element0.bst"],
+        ["element1.bst"],
+        ["element2.bst"],
+    ]
+    assert [call[0][0] for call in remote.push_blob_future.call_args_list] == [["element1.bst"], ["element2.bst"]]
+    assert [element for element, _ in failed] == [elements[2]]
+
+
+def test_push_blob_future():
+    remote = AssetRemote(RemoteSpec("http://cache.example.com", True, None, None, None, None, None))
+    remote.push_service = MagicMock()
+    digest = remote_execution_pb2.Digest(hash="a" * 64, size_bytes=1)
+
+    remote.push_service.PushBlob.future.return_value = _future(exception=_RpcError())
+    future = remote.push_blob_future(["urn:example"], digest, references_directories=[digest])
+    request = remote.push_service.PushBlob.future.call_args[0][0]
+    assert list(request.uris) == ["urn:example"]
+    assert request.blob_digest == digest
+    assert list(request.references_directories) == [digest]
+
+    with pytest.raises(AssetCacheError) as exc:
+        remote.push_blob_result(future)
+    assert str(exc.value) == "PushBlob failed with status UNAVAILABLE: unavailable"
@@ -1,8 +1,16 @@
 import os
 import time
+from concurrent.futures import Future
 from unittest.mock import MagicMock
 
-from buildstream._cas.cascache import CASCache
+import grpc
+import psutil
+import pytest
+
+from buildstream import utils
+from buildstream._cas.cascache import CASCache, _RemotePresence
+from buildstream._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildstream._protos.build.buildgrid import local_cas_pb2
 from buildstream._message import MessageType
 from buildstream._messenger import Messenger
 
@@ -15,6 +23,7 @@ def test_report_when_cascache_dies_before_asked_to(tmp_path, monkeypatch):
 
     messenger = MagicMock(spec_set=Messenger)
     cache = CASCache(str(tmp_path.joinpath("casd")), casd=True, log_directory=str(tmp_path.joinpath("logs")))
+    cache.start_casd()
     time.sleep(1)
     cache.release_resources(messenger)
 
@@ -34,6 +43,7 @@ def test_report_when_cascache_exits_not_cleanly(tmp_path, monkeypatch):
 
     messenger = MagicMock(spec_set=Messenger)
     cache = CASCache(str(tmp_path.joinpath("casd")), casd=True, log_directory=str(tmp_path.joinpath("logs")))
+    cache.start_casd()
     time.sleep(1)
     cache.release_resources(messenger)
 
@@ -53,6 +63,7 @@ def test_report_when_cascache_is_forcefully_killed(tmp_path, monkeypatch):
 
     messenger = MagicMock(spec_set=Messenger)
     cache = CASCache(str(tmp_path.joinpath("casd")), casd=True, log_directory=str(tmp_path.joinpath("logs")))
+    cache.start_casd()
     time.sleep(1)
     cache.release_resources(messenger)
 
@@ -82,6 +93,7 @@ def test_casd_redirects_stderr_to_file_and_rotate(tmp_path, monkeypatch):
     # Let's create the first `n_max_log_files` log files
     for i in range(1, n_max_log_files + 1):
         cache = CASCache(str(casd_files_path), casd=True, log_directory=str(casd_parent_logs_path))
+        cache.start_casd()
         time.sleep(0.5)
         cache.release_resources()
 
@@ -94,6 +106,7 @@ def test_casd_redirects_stderr_to_file_and_rotate(tmp_path, monkeypatch):
         evicted_file = existing_log_files.pop(0)
 
         cache = CASCache(str(casd_files_path), casd=True, log_directory=str(casd_parent_logs_path))
+        cache.start_casd()
         time.sleep(0.5)
         cache.release_resources()
 
@@ -101,3 +114,297 @@ def test_casd_redirects_stderr_to_file_and_rotate(tmp_path, monkeypatch):
         assert len(existing_log_files) == n_max_log_files
         assert evicted_file not in existing_log_files
         assert existing_log_files[-1].read_text() == "hello\n"
+
+
+def test_shared_casd_is_reused(tmp_path, monkeypatch):
+    dummy_buildbox_casd = tmp_path.joinpath("buildbox-casd")
+    dummy_buildbox_casd.write_text("#!/usr/bin/env sh\nwhile :\ndo\nsleep 60\ndone")
+    dummy_buildbox_casd.chmod(0o777)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+
+    def create_cache():
+        return CASCache(
+            str(tmp_path.joinpath("casd")),
+            casd=True,
+            log_directory=str(tmp_path.joinpath("logs")),
+            shared_casd=True,
+            shared_casd_idle_timeout=0,
+        )
+
+    first = create_cache()
+    first.start_casd()
+    second = create_cache()
+    second.start_casd()
+
+    # The second session connects to the process started by the first one
+    pid = first.get_casd_process_manager()._pid
+    assert second.get_casd_process_manager()._pid == pid
+    assert len(list(tmp_path.joinpath("logs", "_casd").iterdir())) == 1
+
+    # The process is only terminated once the last session releases it
+    first.release_resources()
+    assert psutil.pid_exists(pid)
+
+    second.release_resources()
+    with pytest.raises(psutil.NoSuchProcess):
+        psutil.Process(pid).wait(timeout=5)
+
+
+# Write a blob directly into the object store of a CASCache created without casd
+def _write_object(cache, data):
+    digest = utils._message_digest(data)
+    objpath = cache.objpath(digest)
+    os.makedirs(os.path.dirname(objpath), exist_ok=True)
+    with open(objpath, "wb") as f:
+        f.write(data)
+    return digest
+
+
+@pytest.mark.parametrize("can_link", [True, False])
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_checkout(tmp_path, can_link, max_workers):
+    cache = CASCache(str(tmp_path.joinpath("cache")), casd=False)
+
+    subdir = remote_execution_pb2.Directory()
+    for i in range(1000):
+        filenode = subdir.files.add()
+        filenode.name = "file{}".format(i)
+        filenode.digest.CopyFrom(_write_object(cache, "{}\n".format(i).encode()))
+        filenode.is_executable = i % 2 == 0
+    subdir_digest = _write_object(cache, subdir.SerializeToString())
+
+    root = remote_execution_pb2.Directory()
+    dirnode = root.directories.add()
+    dirnode.name = "subdir"
+    dirnode.digest.CopyFrom(subdir_digest)
+    symlinknode = root.symlinks.add()
+    symlinknode.name = "link"
+    symlinknode.target = "subdir/file1"
+    root_digest = _write_object(cache, root.SerializeToString())
+
+    dest = tmp_path.joinpath("checkout")
+    cache.checkout(str(dest), root_digest, can_link=can_link, max_workers=max_workers)
+
+    assert sorted(os.listdir(str(dest.joinpath("subdir")))) == sorted("file{}".format(i) for i in range(1000))
+    assert dest.joinpath("link").read_text() == "1\n"
+    for i in (0, 1, 999):
+        path = dest.joinpath("subdir", "file{}".format(i))
+        assert path.read_text() == "{}\n".format(i)
+        assert os.access(str(path), os.X_OK) == (i % 2 == 0)
+
+
+class _NotFoundError(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.NOT_FOUND
+
+
+def test_contains_directories(tmp_path, monkeypatch):
+    cache = CASCache(str(tmp_path), casd=False)
+
+    available = _write_object(cache, b"available")
+    missing = _write_object(cache, b"missing")
+
+    def fetch_tree(request):
+        future = Future()
+        if request.root_digest.hash == missing.hash:
+            future.set_exception(_NotFoundError())
+        else:
+            future.set_result(None)
+        return future
+
+    local_cas = MagicMock()
+    local_cas.FetchTree.future.side_effect = fetch_tree
+    monkeypatch.setattr(cache, "get_local_cas", lambda: local_cas)
+
+    requests = [(available, True), (missing, False), (available, False)]
+    assert cache.contains_directories(requests) == [True, False, True]
+    assert [call[0][0].fetch_file_blobs for call in local_cas.FetchTree.future.call_args_list] == [True, False, False]
+
+
+def test_casd_is_started_on_first_use(tmp_path, monkeypatch):
+    dummy_buildbox_casd = tmp_path.joinpath("buildbox-casd")
+    dummy_buildbox_casd.write_text("#!/usr/bin/env sh\nwhile :\ndo\nsleep 60\ndone")
+    dummy_buildbox_casd.chmod(0o777)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+
+    cache = CASCache(str(tmp_path.joinpath("casd")), casd=True, log_directory=str(tmp_path.joinpath("logs")))
+    assert not tmp_path.joinpath("logs", "_casd").exists()
+    assert cache.get_cache_usage().used_size is None
+
+    process = cache.get_casd_process_manager().process
+    assert process.poll() is None
+
+    cache.release_resources()
+    assert process.poll() is not None
+
+
+def test_send_directory_skips_known_trees(tmp_path, monkeypatch):
+    cache = CASCache(str(tmp_path), casd=False)
+    remote = MagicMock()
+    remote.spec.url = "https://cache.example.com"
+    remote.spec.instance_name = None
+
+    sent = []
+    monkeypatch.setattr(cache, "send_blobs", lambda remote, digests, **kwargs: sent.append({d.hash for d in digests}))
+
+    shared = remote_execution_pb2.Directory()
+    for i in range(10):
+        filenode = shared.files.add()
+        filenode.name = "license{}".format(i)
+        filenode.digest.CopyFrom(_write_object(cache, "license {}\n".format(i).encode()))
+    shared_digest = _write_object(cache, shared.SerializeToString())
+    shared_bytes = shared_digest.size_bytes + sum(filenode.digest.size_bytes for filenode in shared.files)
+
+    def create_root(name):
+        root = remote_execution_pb2.Directory()
+        filenode = root.files.add()
+        filenode.name = name
+        filenode.digest.CopyFrom(_write_object(cache, name.encode()))
+        dirnode = root.directories.add()
+        dirnode.name = "licenses"
+        dirnode.digest.CopyFrom(shared_digest)
+        return _write_object(cache, root.SerializeToString())
+
+    assert cache._send_directory(remote, create_root("first")) == (0, 0)
+    assert shared_digest.hash in sent[0]
+
+    # The shared subtree is not enumerated again, also by other jobs
+    monkeypatch.setattr(cache, "_remote_presence", _RemotePresence(cache._remote_presence._basedir))
+    assert cache._send_directory(remote, create_root("second")) == (11, shared_bytes)
+    assert len(sent[1]) == 2
+
+    cache.release_resources()
+    assert not os.path.exists(cache._remote_presence._basedir)
+
+
+def test_fetch_blobs_pipelined(tmp_path, monkeypatch):
+    cache = CASCache(str(tmp_path), casd=False, batch_requests_in_flight=3)
+    remote = MagicMock()
+    remote.cascache = cache
+    remote.local_cas_instance_name = "remote"
+
+    in_flight = []
+    max_in_flight = 0
+
+    # Completes when its result is requested
+    class FakeFuture:
+        def __init__(self, request):
+            self.request = request
+
+        def result(self):
+            in_flight.remove(self)
+            # Only failed requests have responses
+            return local_cas_pb2.FetchMissingBlobsResponse()
+
+        def add_done_callback(self, callback):
+            pass
+
+        def cancel(self):
+            pass
+
+    def fetch_missing_blobs(request):
+        nonlocal max_in_flight
+        future = FakeFuture(request)
+        in_flight.append(future)
+        max_in_flight = max(max_in_flight, len(in_flight))
+        return future
+
+    local_cas = MagicMock()
+    local_cas.FetchMissingBlobs.future.side_effect = fetch_missing_blobs
+    monkeypatch.setattr(cache, "get_local_cas", lambda: local_cas)
+
+    # Ten blobs of 32 MiB, two fit into a single request
+    digests = [remote_execution_pb2.Digest(hash="{:064x}".format(i), size_bytes=32 * 1024 * 1024) for i in range(10)]
+    batches = []
+    cache.fetch_blobs(remote, digests, on_batch=lambda n_blobs, n_bytes, seconds: batches.append((n_blobs, n_bytes)))
+
+    assert local_cas.FetchMissingBlobs.future.call_count == 5
+    assert max_in_flight == 3
+    assert not in_flight
+    assert batches == [(2, 64 * 1024 * 1024)] * 5
+
+
+def test_fetch_trees_overlaps_file_downloads(tmp_path, monkeypatch):
+    cache = CASCache(str(tmp_path), casd=False)
+    remote = MagicMock()
+    remote.cascache = cache
+    remote.local_cas_instance_name = "remote"
+
+    # Objects of the remote, which have large file blobs so that each
+    # file is fetched by a separate request
+    remote_objects = {}
+
+    def add_remote_object(data, size_bytes=None):
+        digest = utils._message_digest(data)
+        if size_bytes is not None:
+            digest.size_bytes = size_bytes
+        remote_objects[digest.hash] = data
+        return digest
+
+    def create_tree(depth):
+        directory = remote_execution_pb2.Directory()
+        filenode = directory.files.add()
+        filenode.name = "file"
+        filenode.digest.CopyFrom(add_remote_object("file {}".format(depth).encode(), 48 * 1024 * 1024))
+        if depth:
+            dirnode = directory.directories.add()
+            dirnode.name = "subdir"
+            dirnode.digest.CopyFrom(create_tree(depth - 1))
+        return add_remote_object(directory.SerializeToString())
+
+    root = create_tree(3)
+    log = add_remote_object(b"log")
+    deepest_directory = remote_objects[create_tree(0).hash]
+
+    requested = []
+
+    def fetch_missing_blobs(request):
+        requested.append([remote_objects[digest.hash] for digest in request.blob_digests])
+        for digest in request.blob_digests:
+            objpath = cache.objpath(digest)
+            os.makedirs(os.path.dirname(objpath), exist_ok=True)
+            with open(objpath, "wb") as f:
+                f.write(remote_objects[digest.hash])
+        future = Future()
+        future.set_result(local_cas_pb2.FetchMissingBlobsResponse())
+        return future
+
+    local_cas = MagicMock()
+    local_cas.FetchMissingBlobs.future.side_effect = fetch_missing_blobs
+    monkeypatch.setattr(cache, "get_local_cas", lambda: local_cas)
+
+    cache._fetch_trees(remote, [root], blobs=[log])
+
+    assert all(os.path.exists(cache.objpath(utils._message_digest(data))) for data in remote_objects.values())
+
+    # Files are requested before the deepest directory has been fetched
+    assert requested.index([b"log", b"file 3"]) < requested.index([deepest_directory])
+
+
+def test_required_files_for_directory_filter(tmp_path):
+    cache = CASCache(str(tmp_path), casd=False)
+
+    def create_directory(files, directories=()):
+        directory = remote_execution_pb2.Directory()
+        for name in files:
+            filenode = directory.files.add()
+            filenode.name = name
+            filenode.digest.CopyFrom(_write_object(cache, name.encode()))
+        for name, digest in directories:
+            dirnode = directory.directories.add()
+            dirnode.name = name
+            dirnode.digest.CopyFrom(digest)
+        return _write_object(cache, directory.SerializeToString())
+
+    include = create_directory(["foo.h"])
+    lib = create_directory(["libfoo.so"])
+    root = create_directory(["README"], [("include", include), ("lib", lib)])
+
+    def runtime_only(path):
+        return not path.startswith("include/")
+
+    digests = cache.required_files_for_directory(root, filter_callback=runtime_only)
+    assert sorted(digest.hash for digest in digests) == sorted(
+        utils._message_digest(name.encode()).hash for name in ("README", "libfoo.so")
+    )
+    assert len(list(cache.required_files_for_directory(root))) == 3
@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+import psutil
+import pytest
+
+from buildstream._cas.casdprocessmanager import _spawn_detached
+from buildstream._exceptions import CASCacheError
+
+
+def test_spawn_detached():
+    pid = _spawn_detached(
+        [sys.executable, "-c", "import time; time.sleep(60)"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    proc = psutil.Process(pid)
+    try:
+        # The process is neither a child of this process nor in its session
+        assert proc.ppid() != os.getpid()
+        assert os.getsid(pid) == pid
+    finally:
+        proc.kill()
+
+
+def test_spawn_detached_failure(tmpdir):
+    with pytest.raises(CASCacheError):
+        _spawn_detached([os.path.join(str(tmpdir), "missing")])
@@ -0,0 +1,372 @@
+import asyncio
+import gc
+import threading
+import time
+import urllib.request
+from concurrent import futures
+from unittest.mock import MagicMock
+
+import grpc
+
+from buildstream._cas.casserver import (
+    _AsyncContentAddressableStorageServicer,
+    _AsyncFetchServicer,
+    _AsyncReferenceStorageServicer,
+    _ReferenceExpiry,
+    _ReferenceStorageServicer,
+    _ReplicationPeer,
+    _ResponseCompression,
+    _UpstreamRemote,
+    _is_replicated,
+)
+from buildstream._cas.refstorage import SQLiteReferenceStorage
+from buildstream._cas.servermetrics import ServerMetrics, create_interceptor, start_http_server
+from buildstream._remote import RemoteSpec
+from buildstream._protos.build.bazel.remote.asset.v1 import remote_asset_pb2, remote_asset_pb2_grpc
+from buildstream._protos.build.bazel.remote.execution.v2 import remote_execution_pb2, remote_execution_pb2_grpc
+from buildstream._protos.build.buildgrid import local_cas_pb2
+from buildstream._protos.buildstream.v2 import buildstream_pb2, buildstream_pb2_grpc
+
+
+class _NotFoundError(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.NOT_FOUND
+
+    def details(self):
+        return "not found"
+
+
+class _UnavailableError(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+    def details(self):
+        return "unavailable"
+
+
+def _digest(n):
+    return remote_execution_pb2.Digest(hash="{:064x}".format(n), size_bytes=n)
+
+
+def _casd(missing_blobs, trees, usage):
+    def find_missing_blobs(request):
+        return remote_execution_pb2.FindMissingBlobsResponse(
+            missing_blob_digests=[d for d in request.blob_digests if d in missing_blobs]
+        )
+
+    def get_tree(request):
+        if request.root_digest in missing_blobs:
+            raise _NotFoundError()
+        return iter([remote_execution_pb2.GetTreeResponse(directories=trees[request.root_digest.hash])])
+
+    casd = MagicMock()
+    casd.get_cas.return_value.FindMissingBlobs.side_effect = find_missing_blobs
+    casd.get_cas.return_value.GetTree.side_effect = get_tree
+    casd.get_local_cas.return_value.GetLocalDiskUsage.side_effect = lambda request: usage.pop(0)
+    return casd
+
+
+def _tree(file_digest):
+    return [remote_execution_pb2.Directory(files=[remote_execution_pb2.FileNode(name="file", digest=file_digest)])]
+
+
+def test_reference_expiry(tmpdir):
+    refs = SQLiteReferenceStorage(str(tmpdir))
+    try:
+        # Refs in LRU order, only the recent ref is within the grace period
+        old = time.time() - 7200
+        refs._insert(
+            [
+                ("first", _digest(50).hash, 50, old),
+                ("dangling", _digest(2).hash, 2, old + 1),
+                ("second", _digest(51).hash, 51, old + 2),
+                ("third", _digest(52).hash, 52, old + 3),
+            ]
+        )
+        refs.set(["recent"], _digest(53))
+        trees = {_digest(n).hash: _tree(_digest(150 - n)) for n in (50, 51, 52, 53)}
+
+        usage = [local_cas_pb2.GetLocalDiskUsageResponse(size_bytes=size) for size in (700, 900, 900, 700)]
+        casd = _casd([_digest(2)], trees, usage)
+        expiry = _ReferenceExpiry(casd, refs, quota=1000, interval=60, grace_period=3600)
+
+        # Refs are only expired above 80% of the quota
+        expiry.check()
+        assert sorted(key for key, _, _ in refs.list_refs()) == ["dangling", "first", "recent", "second", "third"]
+
+        # The least recently used refs are expired until the usage is at 60% of the quota,
+        # the trees of the refs which are kept are not accessed
+        expiry.check()
+        assert sorted(key for key, _, _ in refs.list_refs()) == ["recent", "third"]
+        roots = [call[0][0].root_digest for call in casd.get_cas.return_value.GetTree.call_args_list]
+        assert roots == [_digest(50), _digest(2), _digest(51)]
+
+        # The expired trees count as freed until casd evicts them
+        expiry.check()
+        expiry.check()
+        assert sorted(key for key, _, _ in refs.list_refs()) == ["recent", "third"]
+
+        stats = expiry.get_stats()
+        assert stats["scans"] == 1
+        assert stats["refs_expired"] == 3
+        assert stats["bytes_expired"] == 300
+        assert stats["disk_usage_bytes"] == 700
+
+        # Refs accessed after they were listed are not counted as expired
+        def list_lru(*, accessed_before):
+            yield from [("third", _digest(52), old + 3)]
+            refs.set(["third"], _digest(52))
+
+        refs.list_lru = list_lru
+        assert expiry.expire(1000) == 0
+        assert sorted(key for key, _, _ in refs.list_refs()) == ["recent", "third"]
+    finally:
+        refs.close()
+
+
+def test_upstream_reference(tmpdir):
+    refs = SQLiteReferenceStorage(str(tmpdir))
+    try:
+        upstream = MagicMock()
+        upstream.get_reference.side_effect = lambda key: _digest(1) if key == "upstream" else None
+        servicer = _ReferenceStorageServicer(MagicMock(), refs, upstream, None, None, enable_push=False)
+
+        assert servicer.resolve_ref("upstream") == _digest(1)
+        assert servicer.resolve_ref("missing") is None
+
+        # The ref fetched from upstream is stored locally
+        upstream.get_reference.reset_mock()
+        assert servicer.resolve_ref("upstream") == _digest(1)
+        assert not upstream.get_reference.called
+    finally:
+        refs.close()
+
+
+def test_upstream_fetches_missing_blobs():
+    casd = _casd([_digest(2)], [], [])
+    upstream = _UpstreamRemote(RemoteSpec("http://upstream.example.com", False, None, None, None, None, None), casd)
+    upstream.local_cas_instance_name = "upstream"
+    local_cas = casd.get_local_cas.return_value
+
+    upstream.fetch_missing_blobs([_digest(1)])
+    assert not local_cas.FetchMissingBlobs.called
+
+    upstream.fetch_missing_blobs([_digest(1), _digest(2)])
+    request = local_cas.FetchMissingBlobs.call_args[0][0]
+    assert request.instance_name == "upstream"
+    assert list(request.blob_digests) == [_digest(2)]
+
+
+def test_server_metrics(tmpdir):
+    refs = SQLiteReferenceStorage(str(tmpdir))
+    refs.set(["present"], _digest(1))
+    metrics = ServerMetrics()
+
+    server = grpc.server(futures.ThreadPoolExecutor(1), interceptors=[create_interceptor(metrics)])
+    buildstream_pb2_grpc.add_ReferenceStorageServicer_to_server(
+        _ReferenceStorageServicer(MagicMock(), refs, None, metrics, None, enable_push=False), server
+    )
+    port = server.add_insecure_port("localhost:0")
+    server.start()
+    http_server = start_http_server(metrics, 0)
+    try:
+        with grpc.insecure_channel("localhost:{}".format(port)) as channel:
+            stub = buildstream_pb2_grpc.ReferenceStorageStub(channel)
+            stub.GetReference(buildstream_pb2.GetReferenceRequest(key="present"))
+            try:
+                stub.GetReference(buildstream_pb2.GetReferenceRequest(key="missing"))
+            except grpc.RpcError as e:
+                assert e.code() == grpc.StatusCode.NOT_FOUND
+
+        url = "http://localhost:{}/metrics".format(http_server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            text = response.read().decode()
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+        server.stop(0)
+        refs.close()
+
+    assert 'bst_artifact_server_requests_total{method="ReferenceStorage/GetReference"} 2' in text
+    assert 'bst_artifact_server_request_duration_seconds_count{method="ReferenceStorage/GetReference"} 2' in text
+    assert 'bst_artifact_server_lookups_total{service="ReferenceStorage",result="hit"} 1' in text
+    assert 'bst_artifact_server_lookups_total{service="ReferenceStorage",result="miss"} 1' in text
+
+
+def test_replication_peer():
+    casd = MagicMock()
+    casd.get_local_cas.return_value.UploadMissingBlobs.return_value = local_cas_pb2.UploadMissingBlobsResponse()
+    peer = _ReplicationPeer(RemoteSpec("http://peer.example.com", True, None, None, None, None, None), casd)
+    peer.local_cas_instance_name = "peer"
+    peer.ref_storage = MagicMock()
+    local_cas = casd.get_local_cas.return_value
+
+    peer.replicate(("reference", (["ref"], _digest(1))))
+
+    assert list(local_cas.UploadMissingBlobs.call_args[0][0].blob_digests) == [_digest(1)]
+    assert local_cas.UploadTree.call_args[0][0].root_digest == _digest(1)
+    assert local_cas.UploadTree.call_args[0][0].instance_name == "peer"
+
+    # The peer must not replicate the update back
+    request = peer.ref_storage.UpdateReference.call_args[0][0]
+    metadata = peer.ref_storage.UpdateReference.call_args[1]["metadata"]
+    assert list(request.keys) == ["ref"]
+    assert request.digest == _digest(1)
+    context = MagicMock()
+    context.invocation_metadata.return_value = metadata
+    assert _is_replicated(context)
+
+
+def test_response_compression():
+    compression = _ResponseCompression("gzip", 4096)
+
+    context = MagicMock()
+    compression.apply(context, 4095)
+    context.set_compression.assert_not_called()
+    compression.apply(context, 4096)
+    context.set_compression.assert_called_once_with(grpc.Compression.Gzip)
+
+    context = MagicMock()
+    _ResponseCompression("none", 0).apply(context, 1 << 20)
+    context.set_compression.assert_not_called()
+
+
+# Asynchronous stubs of buildbox-casd, as in _AsyncCASDChannel
+class _AsyncCASD:
+    def __init__(self):
+        self.cas = MagicMock()
+        self.fetch = MagicMock()
+
+        async def find_missing_blobs(request):
+            return remote_execution_pb2.FindMissingBlobsResponse(missing_blob_digests=request.blob_digests[1:])
+
+        async def batch_read_blobs(request):
+            raise _UnavailableError()
+
+        async def fetch_blob(request):
+            raise _NotFoundError()
+
+        self.cas.FindMissingBlobs = find_missing_blobs
+        self.cas.BatchReadBlobs = batch_read_blobs
+        self.fetch.FetchBlob = fetch_blob
+
+
+# Run the test coroutine against an in-process asyncio server, with the
+# servicers added by `add_servicers(server)`
+def _run_async_server(add_servicers, test):
+    from grpc import aio  # pylint: disable=import-outside-toplevel
+
+    async def run():
+        server = aio.server()
+        add_servicers(server)
+        port = server.add_insecure_port("localhost:0")
+        await server.start()
+        try:
+            async with aio.insecure_channel("localhost:{}".format(port)) as channel:
+                await test(channel)
+        finally:
+            await server.stop(0)
+
+    # Blocking calls are run in the default executor, which must be shut
+    # down with the test
+    executor = futures.ThreadPoolExecutor()
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(executor)
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+        executor.shutdown()
+
+    # The gRPC poller thread only exits once the channel and server are
+    # collected, the failed RPCs keep them alive in reference cycles
+    gc.collect()
+
+
+def test_async_servicers():
+    casd = _AsyncCASD()
+    metrics = ServerMetrics()
+    upstream = MagicMock()
+    upstream.fetch_blob.return_value = remote_asset_pb2.FetchBlobResponse(blob_digest=_digest(1))
+    compression = _ResponseCompression("none", 0)
+
+    def add_servicers(server):
+        limiter = asyncio.Semaphore(1)
+        remote_execution_pb2_grpc.add_ContentAddressableStorageServicer_to_server(
+            _AsyncContentAddressableStorageServicer(casd, limiter, upstream, compression, enable_push=False), server
+        )
+        remote_asset_pb2_grpc.add_FetchServicer_to_server(
+            _AsyncFetchServicer(casd, limiter, upstream, metrics), server
+        )
+
+    async def test(channel):
+        cas = remote_execution_pb2_grpc.ContentAddressableStorageStub(channel)
+        fetch = remote_asset_pb2_grpc.FetchStub(channel)
+
+        # Responses of buildbox-casd are forwarded
+        response = await cas.FindMissingBlobs(
+            remote_execution_pb2.FindMissingBlobsRequest(blob_digests=[_digest(1), _digest(2)])
+        )
+        assert list(response.missing_blob_digests) == [_digest(2)]
+
+        # Errors of buildbox-casd abort the RPC with the same status
+        try:
+            await cas.BatchReadBlobs(remote_execution_pb2.BatchReadBlobsRequest(digests=[_digest(1)]))
+            assert False, "BatchReadBlobs should have failed"
+        except grpc.RpcError as e:
+            assert e.code() == grpc.StatusCode.UNAVAILABLE
+            assert e.details() == "unavailable"
+        assert list(upstream.fetch_missing_blobs.call_args[0][0]) == [_digest(1)]
+
+        # Assets missing in buildbox-casd are fetched from upstream
+        response = await fetch.FetchBlob(remote_asset_pb2.FetchBlobRequest(uris=["urn:example"]))
+        assert response.blob_digest == _digest(1)
+        assert list(upstream.fetch_blob.call_args[0][0].uris) == ["urn:example"]
+
+    _run_async_server(add_servicers, test)
+
+    assert 'bst_artifact_server_lookups_total{service="Fetch",result="upstream"} 1' in metrics.render()
+
+
+def test_async_reference_storage(tmpdir):
+    refs = SQLiteReferenceStorage(str(tmpdir))
+    threads = set()
+    refs_get, refs_set = refs.get, refs.set
+
+    def get(key):
+        threads.add(threading.get_ident())
+        return refs_get(key)
+
+    def set_(keys, digest):
+        threads.add(threading.get_ident())
+        return refs_set(keys, digest)
+
+    refs.get, refs.set = get, set_
+
+    def add_servicers(server):
+        buildstream_pb2_grpc.add_ReferenceStorageServicer_to_server(
+            _AsyncReferenceStorageServicer(MagicMock(), refs, None, ServerMetrics(), None, enable_push=True), server
+        )
+
+    async def test(channel):
+        stub = buildstream_pb2_grpc.ReferenceStorageStub(channel)
+
+        await stub.UpdateReference(buildstream_pb2.UpdateReferenceRequest(keys=["ref"], digest=_digest(1)))
+        response = await stub.GetReference(buildstream_pb2.GetReferenceRequest(key="ref"))
+        assert response.digest == _digest(1)
+
+        try:
+            await stub.GetReference(buildstream_pb2.GetReferenceRequest(key="missing"))
+            assert False, "GetReference should have failed"
+        except grpc.RpcError as e:
+            assert e.code() == grpc.StatusCode.NOT_FOUND
+
+    try:
+        _run_async_server(add_servicers, test)
+    finally:
+        refs.close()
+
+    # The refs are never accessed from the event loop
+    assert threads and threading.get_ident() not in threads
@@ -0,0 +1,71 @@
+import os
+import time
+
+import pytest
+
+from buildstream._cas.refstorage import FileReferenceStorage, SQLiteReferenceStorage, migrate_file_references
+from buildstream._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+
+
+def _digest(n):
+    return remote_execution_pb2.Digest(hash="{:064x}".format(n), size_bytes=n)
+
+
+@pytest.mark.parametrize("storage_class", [FileReferenceStorage, SQLiteReferenceStorage])
+def test_reference_storage(tmpdir, storage_class):
+    refs = storage_class(str(tmpdir))
+    try:
+        refs.set(["project/element/a", "project/element/b"], _digest(1))
+        refs.set(["project/element/b"], _digest(2))
+
+        assert refs.get("project/element/a") == _digest(1)
+        assert refs.get("project/element/missing") is None
+        assert refs.get_many(["project/element/a", "project/element/b", "project/element/missing"]) == {
+            "project/element/a": _digest(1),
+            "project/element/b": _digest(2),
+        }
+
+        assert refs.remove(["project/element/a", "project/element/missing"]) == 1
+        assert refs.get("project/element/a") is None
+
+        # Refs accessed since the given time are kept
+        assert refs.remove(["project/element/b"], accessed_before=time.time() - 60) == 0
+        assert [(key, digest) for key, digest, _ in refs.list_refs()] == [("project/element/b", _digest(2))]
+    finally:
+        refs.close()
+
+
+def test_sqlite_access_times_are_batched(tmpdir):
+    refs = SQLiteReferenceStorage(str(tmpdir))
+    try:
+        refs.set(["ref"], _digest(1))
+        written = refs._db.execute("SELECT atime FROM refs").fetchone()[0]
+
+        time.sleep(0.01)
+        assert refs.get("ref") == _digest(1)
+        assert refs._db.execute("SELECT atime FROM refs").fetchone()[0] == written
+
+        refs.flush()
+        assert refs._db.execute("SELECT atime FROM refs").fetchone()[0] > written
+    finally:
+        refs.close()
+
+
+def test_migrate_file_references(tmpdir):
+    root = str(tmpdir)
+    files = FileReferenceStorage(root)
+    files.set(["project/element/a"], _digest(1))
+    files.set(["project/other/b"], _digest(2))
+    os.utime(os.path.join(files.refdir, "project", "element", "a"), times=(1000, 1000))
+
+    assert migrate_file_references(root, remove_files=True) == 2
+    assert not os.listdir(files.refdir)
+
+    refs = SQLiteReferenceStorage(root)
+    try:
+        assert sorted(refs.list_refs()) == [
+            ("project/element/a", _digest(1), 1000),
+            ("project/other/b", _digest(2), pytest.approx(time.time(), abs=60)),
+        ]
+    finally:
+        refs.close()
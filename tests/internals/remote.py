@@ -0,0 +1,50 @@
+import pytest
+
+from buildstream import _yaml
+from buildstream._exceptions import LoadError
+from buildstream._remote import BaseRemote, RemoteSpec
+from buildstream.exceptions import LoadErrorReason
+
+
+class _Remote(BaseRemote):
+    def _configure_protocols(self):
+        pass
+
+
+def _spec(yaml):
+    return RemoteSpec.new_from_config_node(_yaml.load_data(yaml))
+
+
+def test_connection_config():
+    spec = _spec("url: http://cache.example.com\nconnection-config:\n  keepalive-time: 30\n  max-message-size: 1024\n")
+    options = dict(spec.connection_config.channel_options())
+    assert options["grpc.keepalive_time_ms"] == 30000
+    assert options["grpc.max_receive_message_length"] == 1024
+    assert "grpc.keepalive_timeout_ms" not in options
+
+    with pytest.raises(LoadError) as exc:
+        _spec("url: http://cache.example.com\nconnection-config:\n  keepalive-time: 0\n")
+    assert exc.value.reason == LoadErrorReason.INVALID_DATA
+
+
+def test_shared_channel():
+    first = _Remote(_spec("url: http://cache.example.com"))
+    second = _Remote(_spec("url: http://cache.example.com\npush: true"))
+    other = _Remote(_spec("url: http://cache.example.com\nconnection-config:\n  keepalive-time: 30\n"))
+
+    first.init()
+    second.init()
+    other.init()
+    assert first.channel is second.channel
+    assert other.channel is not first.channel
+
+    channel = first.channel
+    first.close()
+    second.init()
+    assert second.channel is channel
+
+    second.close()
+    other.close()
+    first.init()
+    assert first.channel is not channel
+    first.close()
@@ -0,0 +1,30 @@
+from concurrent.futures import Future
+
+from buildstream._remote import completed_futures
+
+
+def test_completed_futures_order():
+    futures = [Future() for _ in range(3)]
+
+    # Futures completing together are sorted by position
+    futures[2].set_result(None)
+    futures[1].set_result(None)
+
+    completed = completed_futures(futures)
+    assert next(completed) == [1, 2]
+
+    futures[0].set_result(None)
+    assert next(completed) == [0]
+    assert list(completed) == []
+
+
+def test_completed_futures_cancel():
+    futures = [Future() for _ in range(2)]
+    futures[1].set_result(None)
+
+    completed = completed_futures(futures)
+    assert next(completed) == [1]
+    completed.close()
+
+    # Pending futures are cancelled when the caller stops iterating
+    assert futures[0].cancelled()
@@ -0,0 +1,47 @@
+import os
+import time
+from types import SimpleNamespace
+
+from buildstream._artifactcache import _RemoteMissCache
+from buildstream._remote import RemoteSpec
+
+
+def _remote(url):
+    return SimpleNamespace(spec=RemoteSpec(url, push=False))
+
+
+def test_remote_misses(tmpdir):
+    misses = _RemoteMissCache(str(tmpdir), 60)
+    remote = _remote("https://cache.example.com")
+    other = _remote("https://mirror.example.com")
+    artifact = "project/element/0123"
+
+    assert not misses.contains(remote, artifact)
+    misses.add(remote, artifact)
+    assert misses.contains(remote, artifact)
+    assert not misses.contains(other, artifact)
+
+    misses.remove(remote, artifact)
+    assert not misses.contains(remote, artifact)
+
+
+def test_remote_misses_expire(tmpdir):
+    misses = _RemoteMissCache(str(tmpdir), 60)
+    remote = _remote("https://cache.example.com")
+    artifact = "project/element/0123"
+
+    misses.add(remote, artifact)
+    path = misses._path(remote, artifact)
+    os.utime(path, times=(time.time() - 61, time.time() - 61))
+
+    assert not misses.contains(remote, artifact)
+    assert not os.path.exists(path)
+
+
+def test_remote_misses_disabled(tmpdir):
+    misses = _RemoteMissCache(str(tmpdir), 0)
+    remote = _remote("https://cache.example.com")
+
+    misses.add(remote, "project/element/0123")
+    assert not misses.contains(remote, "project/element/0123")
+    assert os.listdir(str(tmpdir)) == []
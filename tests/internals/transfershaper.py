@@ -0,0 +1,51 @@
+import fcntl
+import os
+
+from buildstream._cas import transfershaper
+from buildstream._cas.transfershaper import PULL, PUSH, TransferShaper
+
+
+def test_bandwidth_limit(tmpdir, monkeypatch):
+    delays = []
+    monkeypatch.setattr(transfershaper.time, "time", lambda: 1000.0)
+    monkeypatch.setattr(transfershaper.time, "sleep", delays.append)
+
+    shaper = TransferShaper(str(tmpdir), push_limit=1000)
+    shaper.acquire(PUSH, 500)
+    shaper.acquire(PUSH, 1000)
+    shaper.acquire(PUSH, 1000)
+
+    # Pulls are unlimited and don't share the reservations of pushes
+    shaper.acquire(PULL, 1000)
+
+    assert delays == [0.5, 1.5]
+
+
+def test_pulls_hold_off_pushes(tmpdir):
+    shaper = TransferShaper(str(tmpdir), prioritize_pulls=True)
+
+    def pulls_active():
+        with open(os.path.join(str(tmpdir), "pulls"), "a+") as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+        return False
+
+    with shaper.transferring(PULL):
+        assert pulls_active()
+    assert not pulls_active()
+
+    with shaper.transferring(PUSH):
+        assert not pulls_active()
+
+
+def test_unconfigured(tmpdir):
+    directory = os.path.join(str(tmpdir), "shaper")
+    shaper = TransferShaper(directory)
+
+    # Without limits, no state is kept
+    with shaper.transferring(PULL):
+        shaper.acquire(PULL, 1000)
+    shaper.acquire(PUSH, 1000)
+    assert not os.path.exists(directory)
@@ -0,0 +1,37 @@
+import errno
+import os
+
+from buildstream import utils
+
+
+def test_safe_copy(tmpdir):
+    src = os.path.join(str(tmpdir), "src")
+    dest = os.path.join(str(tmpdir), "dest")
+    with open(src, "w") as f:
+        f.write("contents\n")
+
+    utils.safe_copy(src, dest)
+
+    assert not os.path.samefile(src, dest)
+    with open(dest) as f:
+        assert f.read() == "contents\n"
+
+
+def test_safe_copy_reflink_unsupported(tmpdir, monkeypatch):
+    src = os.path.join(str(tmpdir), "src")
+    dest = os.path.join(str(tmpdir), "dest")
+    with open(src, "w") as f:
+        f.write("contents\n")
+
+    def unsupported_ioctl(*args):
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+    monkeypatch.setattr("fcntl.ioctl", unsupported_ioctl)
+    monkeypatch.setattr(utils, "_REFLINK_UNSUPPORTED_DEVICES", set())
+
+    # Fall back to a regular copy and remember the filesystem
+    utils.safe_copy(src, dest)
+
+    with open(dest) as f:
+        assert f.read() == "contents\n"
+    assert os.stat(src).st_dev in utils._REFLINK_UNSUPPORTED_DEVICES